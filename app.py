@@ -1,15 +1,33 @@
 #!/usr/bin/env python
 
 from collections import defaultdict
+from datetime import datetime, timedelta
+import functools
+import hashlib
 import json
 import os
-
-from flask import Flask, flash, g, jsonify, redirect, render_template, request, session, url_for
+import sys
+import time
+import traceback
+import urllib
+import zlib
+
+from dateutil.tz import tzutc
+import dateutil.parser
+from flask import (Flask, Response, abort, flash, g, has_request_context, jsonify, redirect,
+                   render_template, request, session, stream_with_context, url_for)
 from flask.ext.github import GitHub
 import requests
+from sqlalchemy.orm.exc import NoResultFound
 
 import db
+import digest
+import downsample
+import metrics
+import responsecache
+import snapshotwriter
 import tracker
+import webhooks
 
 OWNER = 'danvk'
 REPO = 'dygraphs'
@@ -23,13 +41,111 @@ app.config['GITHUB_CLIENT_SECRET'] = os.environ.get('CLIENT_SECRET')
 
 github = GitHub(app)
 
+# Repos in incremental mode list all their open issues at least this often, to
+# catch drift in the stored issue states.
+RECONCILE_INTERVAL = timedelta(days=int(os.environ.get('RECONCILE_DAYS', 7)))
+
+# The secret which GitHub signs webhook deliveries with. Webhooks are refused without one.
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+# Repos in webhook mode store their live counts as a snapshot at most this often.
+WEBHOOK_SNAPSHOT_INTERVAL = timedelta(minutes=int(os.environ.get('WEBHOOK_SNAPSHOT_MINUTES', 60)))
+
+# If set, snapshots from /update and webhooks are written in batches, waiting at
+# most this many milliseconds to be joined by others.
+SNAPSHOT_WRITER_MS = os.environ.get('SNAPSHOT_WRITER_MS')
+snapshot_writer = (snapshotwriter.SnapshotWriter(max_delay_ms=int(SNAPSHOT_WRITER_MS))
+                   if SNAPSHOT_WRITER_MS else None)
+
+response_cache = responsecache.make_backend()
+db.WRITE_HOOKS.append(lambda owner, repo: response_cache.invalidate('%s/%s' % (owner, repo)))
+
+# The dashboard's data is stored gzipped (see refresh_dashboard), so the page's
+# /json request is a single lookup. A write to a repo's counts bumps its
+# version, which leaves the stored dashboard stale. A request which writes
+# rebuilds it after sending its response (see queue_dashboard_rebuild), and
+# update.py rebuilds it after a poll.
+#
+# The charts show every stored point, as they always have. If
+# DASHBOARD_MAX_POINTS is set, they're downsampled to at most that many points
+# per series instead (see stats_json's max_points), which makes the payload
+# smaller for repos with years of history, at the cost of detail.
+DASHBOARD_MAX_POINTS = (int(os.environ['DASHBOARD_MAX_POINTS'])
+                        if os.environ.get('DASHBOARD_MAX_POINTS') else None)
+# The query string of the dashboard's /json request.
+DASHBOARD_QUERY = 'include_labels=True' + (
+        '&max_points=%d' % DASHBOARD_MAX_POINTS if DASHBOARD_MAX_POINTS else '')
+
+# If set, each request is logged to stderr as a line of JSON, with its route,
+# status, time taken and the DB queries and GitHub API calls it made (which are
+# only timed while metrics.ENABLED).
+JSON_LOGS = os.environ.get('JSON_LOGS')
+
+response_cache_lookups = metrics.REGISTRY.counter(
+        'response_cache_lookups_total', 'Lookups in the response cache, by view and result.',
+        labels=('view', 'result'))
+
+if snapshot_writer:
+    for name, kind, key, help in (
+            ('queue_depth', 'gauge', 'queue_depth', 'Snapshots waiting to be stored.'),
+            ('max_queue_depth', 'gauge', 'max_queue_depth', 'Most snapshots ever waiting.'),
+            ('snapshots_total', 'counter', 'snapshots_done', 'Snapshots stored or failed.'),
+            ('flushes_total', 'counter', 'flushes', 'Batches of snapshots written.'),
+            ('flush_errors_total', 'counter', 'flush_errors', 'Batches which failed to be written.'),
+            ('flush_seconds_total', 'counter', 'flush_secs_total', 'Time spent writing batches.'),
+            ('flush_seconds_max', 'gauge', 'flush_secs_max', 'Longest time to write a batch.')):
+        metrics.REGISTRY.callback('snapshot_writer_' + name, help, kind,
+                                  lambda key=key: snapshot_writer.metrics()[key])
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    '''Close the request's DB session, rolling back anything it left uncommitted.'''
+    db.Session.remove()
+
 
 def format_date_column(series):
     '''Converts the first column of series to an ISO-8601 string'''
-    out = []
-    for row in series:
-        out.append([row[0].strftime('%Y-%m-%dT%H:%M:%SZ')] + list(row[1:]))
-    return out
+    return [format_date_row(row) for row in series]
+
+
+def format_date_row(row):
+    return [row[0].strftime('%Y-%m-%dT%H:%M:%SZ')] + list(row[1:])
+
+
+# Streamed responses are written in chunks of about this many bytes.
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+def stream_json(owner, repo, series):
+    '''Yields the stats_json response in chunks, one row at a time.
+
+    series is a list of (name, rows) pairs, where the rows are iterators.
+    by_label's first row is its header; every other row starts with a datetime.
+    '''
+    def pieces():
+        yield '{"owner": %s, "repo": %s' % (json.dumps(owner), json.dumps(repo))
+        for name, rows in series:
+            yield ', %s: [' % json.dumps(name)
+            sep = ''
+            for row in rows:
+                if not isinstance(row[0], basestring):
+                    row = format_date_row(row)
+                yield sep + json.dumps(row)
+                sep = ', '
+            yield ']'
+        yield '}'
+
+    chunk = []
+    size = 0
+    for piece in pieces():
+        chunk.append(piece)
+        size += len(piece)
+        if size >= STREAM_CHUNK_BYTES:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk)
 
 
 def get_current_label_counts(by_label):
@@ -39,9 +155,114 @@ def get_current_label_counts(by_label):
     return pairs
 
 
+def fetch_stats(owner, repo, token=None, mode=None, reconcile=False):
+    '''Fetch a repo's current stats using its fetch mode.'''
+    if mode is None:
+        mode = db.get_fetch_mode(owner, repo) or tracker.PAGING_MODE
+    if mode not in (tracker.INCREMENTAL_MODE, tracker.WEBHOOK_MODE):
+        return tracker.fetch_stats_from_github(owner, repo, token, mode=mode)
+
+    if mode == tracker.WEBHOOK_MODE:
+        # Webhooks keep the live counts current, so only go to GitHub to reconcile them.
+        stats, reconciled_at = db.get_live_stats(owner, repo)
+        if stats and not reconcile and datetime.utcnow() - reconciled_at <= RECONCILE_INTERVAL:
+            return stats
+        reconcile = True
+
+    states, synced_at, reconciled_at = db.get_issue_states(owner, repo)
+    states = {number: tracker.IssueState(*state) for number, state in states.iteritems()}
+    if reconciled_at is None or datetime.utcnow() - reconciled_at > RECONCILE_INTERVAL:
+        reconcile = True
+    result = tracker.fetch_incremental_stats(owner, repo, states, synced_at, token,
+                                             reconcile=reconcile)
+    if result.drift:
+        print 'Reconciled %s/%s; stored counts had drifted by %s' % (owner, repo, result.drift)
+    if mode == tracker.WEBHOOK_MODE:
+        # includes the deliveries which arrived while the repo was being listed
+        return db.store_issue_states(owner, repo, result.changes, result.synced_at,
+                                     reconciled=result.reconciled, live_stats=result.stats)
+    db.store_issue_states(owner, repo, result.changes, result.synced_at,
+                          reconciled=result.reconciled)
+    return result.stats
+
+
+def parse_time_arg(name, end_of_day=False):
+    '''Parse an optional YYYY-MM-DD or ISO-8601 query parameter as a naive UTC datetime.
+
+    With end_of_day set, a bare date means the last moment of that day.
+    '''
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        t = dateutil.parser.parse(value)
+    except (ValueError, OverflowError):
+        abort(400)
+    if t.tzinfo:
+        t = t.astimezone(tzutc()).replace(tzinfo=None)
+    if end_of_day and len(value) == len('YYYY-MM-DD'):
+        t += timedelta(days=1) - timedelta(microseconds=1)
+    return t
+
+
+def parse_max_points_arg():
+    '''Parse the optional max_points query parameter, which must be a positive integer.'''
+    value = request.args.get('max_points')
+    if value is None:
+        return None
+    try:
+        max_points = int(value)
+    except ValueError:
+        abort(400)
+    if max_points < 1:
+        abort(400)
+    return max_points
+
+
+def downsample_series(series, max_points):
+    if max_points:
+        series = downsample.lttb(series, max_points)
+    return series
+
+
+def cached_view(view):
+    '''Serve a repo's view from response_cache, with ETag / 304 support.
+
+    The key includes the signed-in user, since pages show their login.
+    Requests with flashed messages waiting to be shown skip the cache.
+    '''
+    @functools.wraps(view)
+    def wrapper(owner, repo):
+        version = db.get_repo_version(owner, repo)
+        if version is None or '_flashes' in session or request.args.get('stream'):
+            return view(owner, repo)
+
+        login = g.user.login if g.user else ''
+        args = urllib.urlencode(sorted(request.args.items(multi=True)))
+        key = responsecache.make_key(owner, repo, version,
+                                     '%s %s %s' % (view.__name__, login, args))
+        entry = response_cache.get(key)
+        if metrics.ENABLED:
+            response_cache_lookups.inc((view.__name__, 'miss' if entry is None else 'hit'))
+        if entry is None:
+            response = app.make_response(view(owner, repo))
+            if response.status_code != 200:
+                return response
+            entry = responsecache.make_entry(response.mimetype, response.get_data())
+            response_cache.put(key, '%s/%s' % (owner, repo), entry)
+
+        response = Response(entry.body, mimetype=entry.mimetype)
+        response.set_etag(entry.etag)
+        return response.make_conditional(request)
+    return wrapper
+
+
 def observe_and_add(owner, repo):
-    stats = tracker.fetch_stats_from_github(owner, repo)
-    db.store_result(owner, repo, stats)
+    stats = fetch_stats(owner, repo)
+    if snapshot_writer:
+        snapshot_writer.put(owner, repo, stats, wait=True)
+    else:
+        db.store_result(owner, repo, stats)
 
 
 
@@ -52,43 +273,210 @@ def index():
 
 
 @app.route('/<owner>/<repo>')
+@cached_view
 def stats(owner, repo):
     login = g.user.login if g.user else None
 
     if not db.is_repo_tracked(owner, repo):
         return render_template('new_repo.html', login=login, owner=owner, repo=repo)
 
-    stargazers, open_issues, open_pulls, by_label = db.get_stats_series(owner, repo, include_labels=False)
-    stargazers = format_date_column(stargazers)
-    open_issues = format_date_column(open_issues)
-    open_pulls = format_date_column(open_pulls)
-
+    # The charts' data comes from the precomputed dashboard; see dashboard_response.
     return render_template('index.html',
             login=login,
             owner=owner,
             repo=repo,
-            stargazers=stargazers,
-            open_issues=open_issues,
-            open_pulls=open_pulls)
+            dashboard_query=DASHBOARD_QUERY)
 
 
-@app.route('/<owner>/<repo>/json')
-def stats_json(owner, repo):
+def series_payload(owner, repo, include_labels=False, start=None, end=None, resolution=None,
+                   max_points=None):
+    '''The object which stats_json returns; see its docstring for the parameters.'''
+    if max_points and not resolution:
+        resolution = db.choose_resolution(owner, repo, max_points, start=start, end=end)
+
     stargazers, open_issues, open_pulls, by_label = (
-        db.get_stats_series(owner, repo, include_labels=request.args.get('include_labels')))
+        db.get_stats_series(owner, repo, include_labels=include_labels,
+                            start=start, end=end, resolution=resolution))
+    stargazers = downsample_series(stargazers, max_points)
+    open_issues = downsample_series(open_issues, max_points)
+    open_pulls = downsample_series(open_pulls, max_points)
+    by_label = [by_label[0]] + downsample_series(by_label[1:], max_points)
+
     stargazers = format_date_column(stargazers)
     open_issues = format_date_column(open_issues)
     open_pulls = format_date_column(open_pulls)
     by_label = [by_label[0]] + format_date_column(by_label[1:])
 
-    return jsonify({
+    return {
         'owner': owner,
         'repo': repo,
         'stargazers': stargazers,
         'open_issues': open_issues,
         'open_pulls': open_pulls,
         'by_label': by_label
-    })
+    }
+
+
+def build_dashboard(owner, repo):
+    '''Returns the dashboard's data: the series it charts, as gzipped JSON.'''
+    payload = series_payload(owner, repo, include_labels=True, max_points=DASHBOARD_MAX_POINTS)
+    return gzip_bytes(json.dumps(payload, separators=(',', ':')))
+
+
+def refresh_dashboard(owner, repo):
+    '''Build and store a repo's dashboard. Returns its body.'''
+    version = db.get_repo_version(owner, repo)  # before reading, so a write during the build shows
+    body = build_dashboard(owner, repo)
+    db.put_dashboard(owner, repo, version, body)
+    return body
+
+
+def refresh_stale_dashboards(owner_repos):
+    '''Rebuild the stored dashboards of those (owner, repo)s whose counts have changed.
+
+    Returns the number rebuilt. Failures are logged; the next read retries them.
+    This is done in batch jobs and after responses are sent, rather than as
+    each write commits, since a big repo's dashboard can take seconds to build.
+    '''
+    rebuilt = 0
+    for owner, repo in owner_repos:
+        try:
+            stored = db.get_dashboard(owner, repo)
+            if not stored or not stored[1]:
+                refresh_dashboard(owner, repo)
+                rebuilt += 1
+        except Exception:
+            sys.stderr.write('Unable to build the dashboard for %s/%s:\n%s' % (
+                    owner, repo, traceback.format_exc()))
+    return rebuilt
+
+
+def queue_dashboard_rebuild(owner, repo):
+    '''Rebuild a repo's dashboard once the current request's response has been sent.
+
+    This is a db.WRITE_HOOKS hook. Writes made outside a request (update.py,
+    the snapshot writer's thread) are left to refresh_stale_dashboards, or to
+    the next request for the dashboard.
+    '''
+    if has_request_context():
+        g.setdefault('stale_dashboards', set()).add((owner, repo))
+
+
+db.WRITE_HOOKS.append(queue_dashboard_rebuild)
+
+
+@app.after_request
+def rebuild_stale_dashboards(response):
+    '''Have the dashboards queued by queue_dashboard_rebuild rebuilt after the response.'''
+    owner_repos = g.pop('stale_dashboards', None)
+    if owner_repos:
+        def rebuild():
+            try:
+                refresh_stale_dashboards(sorted(owner_repos))
+            finally:
+                db.Session.remove()  # the request's teardown has already run
+        response.call_on_close(rebuild)
+    return response
+
+
+def parse_bool_arg(name):
+    '''Parse an optional true/false query parameter, which defaults to false.'''
+    value = request.args.get(name, '').lower()
+    if value in ('', '0', 'false', 'no', 'off'):
+        return False
+    if value in ('1', 'true', 'yes', 'on'):
+        return True
+    abort(400)
+
+
+def is_dashboard_request():
+    '''Whether a /json request asks for exactly what the dashboard stores.'''
+    args = ['include_labels', 'max_points'] if DASHBOARD_MAX_POINTS else ['include_labels']
+    return (set(request.args) == set(args) and
+            parse_bool_arg('include_labels') and
+            request.args.get('max_points', type=int) == DASHBOARD_MAX_POINTS)
+
+
+def dashboard_response(owner, repo):
+    '''Serve a repo's stored dashboard, building it first if there isn't one.
+
+    A stale dashboard is served as it is, and rebuilt after the response.
+    '''
+    try:
+        stored = db.get_dashboard(owner, repo)
+    except NoResultFound:
+        abort(404)
+    if stored:
+        body, fresh = stored
+        if not fresh:
+            queue_dashboard_rebuild(owner, repo)
+    else:
+        body = refresh_dashboard(owner, repo)
+
+    etag = hashlib.sha1(body).hexdigest()
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = Response(body, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+        etag += '-gzip'
+    else:
+        response = Response(zlib.decompress(body, 16 + zlib.MAX_WBITS),
+                            mimetype='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+@app.route('/<owner>/<repo>/json')
+def stats_json(owner, repo):
+    '''Returns all the series for a repo as JSON.
+
+    Optional query parameters:
+    - include_labels: include the by_label matrix (true/false, 1/0).
+    - start, end: only include points in this range (YYYY-MM-DD or ISO-8601).
+    - resolution: day, week or month; keep only the last point in each.
+    - max_points: downsample each series to at most this many points (LTTB).
+      Without a resolution, this reads from the coarsest rollup which still
+      has at least max_points points in range.
+    - stream: write rows out as they're read from the database, rather than
+      building the whole response in memory. Can't be used with max_points.
+
+    The dashboard's request (DASHBOARD_QUERY: include_labels, and max_points if
+    DASHBOARD_MAX_POINTS is set) is served from the stored dashboard.
+    '''
+    if is_dashboard_request():
+        return dashboard_response(owner, repo)
+    return series_json(owner, repo)
+
+
+@cached_view
+def series_json(owner, repo):
+    '''stats_json for any other request.'''
+    start = parse_time_arg('start')
+    end = parse_time_arg('end', end_of_day=True)
+    resolution = request.args.get('resolution')
+    max_points = parse_max_points_arg()
+    if resolution and resolution not in downsample.RESOLUTIONS:
+        abort(400)
+
+    if request.args.get('stream'):
+        if max_points:
+            abort(400)
+        stargazers, open_issues, open_pulls, by_label = (
+            db.stream_stats_series(owner, repo, include_labels=parse_bool_arg('include_labels'),
+                                   start=start, end=end, resolution=resolution))
+        # The series read from the request's session, so the request (and
+        # with it the session) lasts until the stream ends or the client goes.
+        return Response(stream_with_context(stream_json(owner, repo, [
+                            ('stargazers', stargazers),
+                            ('open_issues', open_issues),
+                            ('open_pulls', open_pulls),
+                            ('by_label', by_label)])),
+                        mimetype='application/json')
+
+    return jsonify(series_payload(owner, repo,
+                                  include_labels=parse_bool_arg('include_labels'),
+                                  start=start, end=end, resolution=resolution,
+                                  max_points=max_points))
 
 
 @app.route('/<owner>/<repo>/backfill', methods=['POST'])
@@ -97,6 +485,74 @@ def backfill(owner, repo):
     return 'OK'
 
 
+def read_json_body():
+    '''Parse the request's JSON body, which may be gzipped (Content-Encoding: gzip).'''
+    data = request.get_data()
+    if request.headers.get('Content-Encoding') == 'gzip':
+        try:
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        except zlib.error:
+            abort(400)
+    try:
+        return json.loads(data)
+    except ValueError:
+        abort(400)
+
+
+def gzip_bytes(body):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def gzip_json_response(obj):
+    '''A JSON response, gzipped if the client accepts that.'''
+    body = json.dumps(obj, separators=(',', ':'))
+    if 'gzip' not in request.headers.get('Accept-Encoding', ''):
+        return Response(body, mimetype='application/json')
+    response = Response(gzip_bytes(body), mimetype='application/json')
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+@app.route('/<owner>/<repo>/backfill/bulk', methods=['POST'])
+def bulk_backfill(owner, repo):
+    '''Store a whole backfill at once; see db.store_bulk_backfill for the format.
+
+    The JSON body may be gzipped, with Content-Encoding: gzip.
+    '''
+    num_rows = db.store_bulk_backfill(owner, repo, read_json_body())
+    return 'OK, stored %d rows' % num_rows
+
+
+@app.route('/<owner>/<repo>/backfill/digest')
+def backfill_digest(owner, repo):
+    '''Checksums of the repo's series, for backfill.py --delta; see digest.py.
+
+    ?through=YYYY-MM-DD leaves out what was polled after a backfill through that day.
+    '''
+    if not db.is_repo_tracked(owner, repo):
+        abort(404)
+    through = parse_time_arg('through')
+    through = through.strftime('%Y-%m-%d') if through else None
+    return gzip_json_response({'block_days': digest.BLOCK_DAYS,
+                               'series': db.backfill_digest(owner, repo, through)})
+
+
+@app.route('/<owner>/<repo>/backfill/delta', methods=['POST'])
+def delta_backfill(owner, repo):
+    '''Replace the changed parts of a backfill; see db.store_backfill_delta.
+
+    The JSON body may be gzipped, with Content-Encoding: gzip.
+    '''
+    payload = read_json_body()
+    try:
+        num_rows = db.store_backfill_delta(owner, repo, payload)
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    return 'OK, stored %d rows in %d ranges' % (num_rows, len(payload['ranges']))
+
+
 @app.route('/<owner>/<repo>/add', methods=['POST'])
 def add_repo(owner, repo):
     if not g.user:
@@ -123,16 +579,99 @@ def update(owner, repo):
     return redirect(url_for('stats', owner=owner, repo=repo))
 
 
+@app.route('/<owner>/<repo>/webhook', methods=['POST'])
+def webhook(owner, repo):
+    '''Receives GitHub webhook deliveries for a repo in webhook mode; see webhooks.py.
+
+    The hook should be set up with content type application/json, the
+    WEBHOOK_SECRET and the issues, pull_request, label, watch and star events.
+    '''
+    body = request.get_data()
+    if not WEBHOOK_SECRET or not webhooks.verify_signature(
+            WEBHOOK_SECRET, body, request.headers.get('X-Hub-Signature-256'),
+            request.headers.get('X-Hub-Signature')):
+        abort(403)
+    event = request.headers.get('X-GitHub-Event')
+    if event == 'ping':
+        return 'pong'
+    if event not in webhooks.EVENTS:
+        return 'Ignored %s event' % event
+    delivery_id = request.headers.get('X-GitHub-Delivery')
+    if not delivery_id:
+        abort(400)
+    try:
+        payload = json.loads(body)
+        update = webhooks.parse_event(event, payload)
+        full_name = payload['repository']['full_name']
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    if full_name.lower() != ('%s/%s' % (owner, repo)).lower():
+        abort(400)
+    if not db.is_repo_tracked(owner, repo):
+        abort(404)
+    return db.apply_webhook(owner, repo, delivery_id, update, WEBHOOK_SNAPSHOT_INTERVAL,
+                            writer=snapshot_writer)
+
+
+@app.route('/metrics')
+def metrics_page():
+    '''This process's metrics, in Prometheus' text format.'''
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
 # OAuth stuff
 
 
 @app.before_request
 def before_request():
+    g.start_secs = time.time()
+    metrics.tally.reset()
+    db.reset_query_count()
     g.user = None
     if 'user_id' in session:
         g.user = db.get_user(session['user_id'])
 
 
+@app.after_request
+def add_query_count(response):
+    '''Report the number of DB queries the request made, as X-DB-Queries.
+
+    Queries made while a streamed response is written aren't included.
+    '''
+    response.headers['X-DB-Queries'] = str(db.query_count())
+    return response
+
+
+@app.after_request
+def record_request(response):
+    '''Time the request for /metrics and, with JSON_LOGS set, log it.
+
+    As with X-DB-Queries, a streamed response is timed up to its first byte.
+    '''
+    if not metrics.ENABLED and not JSON_LOGS:
+        return response
+    elapsed = time.time() - g.get('start_secs', time.time())
+    # the route's pattern rather than its path, so that there's one series per view
+    route = request.url_rule.rule if request.url_rule else '(unmatched)'
+    if metrics.ENABLED:
+        metrics.http_requests.observe(elapsed, (route, request.method, str(response.status_code)))
+    if JSON_LOGS:
+        tally = metrics.tally
+        sys.stderr.write(json.dumps({
+            'time': datetime.utcnow().isoformat() + 'Z',
+            'method': request.method,
+            'route': route,
+            'path': request.path,
+            'status': response.status_code,
+            'ms': round(elapsed * 1000, 1),
+            'db_queries': db.query_count(),
+            'db_ms': round(tally.db_secs * 1000, 1),
+            'github_calls': tally.github_calls,
+            'github_ms': round(tally.github_secs * 1000, 1),
+        }, sort_keys=True) + '\n')
+    return response
+
+
 @github.access_token_getter
 def token_getter():
     user = g.user
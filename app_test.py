@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+import os
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from datetime import datetime
+import json
+import zlib
+
+from nose.tools import eq_
+
+import app
+import backfill
+import dates
+import db
+import tracker
+
+
+def test_stream_matches_buffered_json():
+    db.add_repo('danvk', 'streamed', 'token')
+    db.store_results([
+        ('danvk', 'streamed', tracker.RepoStats(10, 5, 1, {'bug': 3, '': 2}), datetime(2015, 1, 1)),
+        ('danvk', 'streamed', tracker.RepoStats(11, 4, 2, {'bug': 2}), datetime(2015, 1, 2)),
+    ])
+    client = app.app.test_client()
+    for query in ('', '?include_labels=1', '?include_labels=1&resolution=week'):
+        buffered = client.get('/danvk/streamed/json' + query)
+        streamed = client.get('/danvk/streamed/json' + (query or '?') + '&stream=1')
+        eq_(streamed.status_code, 200)
+        eq_(json.loads(streamed.data), json.loads(buffered.data))
+
+    eq_(client.get('/danvk/streamed/json?stream=1&max_points=10').status_code, 400)
+    for max_points in ('abc', '-5', '0', ''):
+        eq_(client.get('/danvk/streamed/json?max_points=' + max_points).status_code, 400)
+
+
+def test_stream_keeps_its_session_until_closed():
+    db.add_repo('danvk', 'stream-session', 'token')
+    db.store_results([('danvk', 'stream-session', tracker.RepoStats(10, 5, 1, {'bug': 3}),
+                       datetime(2015, 1, 1))])
+    client = app.app.test_client()
+    response = client.get('/danvk/stream-session/json?stream=1&include_labels=1',
+                          buffered=False)
+    next(iter(response.response))
+    eq_(db.Session.registry.has(), True)  # still streaming
+    response.close()  # e.g. the client went away
+    eq_(db.Session.registry.has(), False)
+
+
+def test_bulk_backfill_matches_per_series_requests():
+    objs = [
+        {'delete': 'open_issues'},
+        {'open_issues': [['2015-01-01', 3], ['2015-01-02', 4]]},
+        {'delete': 'by_label'},
+        {'by_label': {'bug': [['2015-01-01', 1], ['2015-01-02', 2]]}},
+        {'by_label': {'': [['2015-01-01', 2], ['2015-01-03', 0]]}},  # not contiguous
+        {'delete': 'stargazers'},
+        {'stargazers': [['2015-01-02', 10]]},
+    ]
+    client = app.app.test_client()
+    db.add_repo('danvk', 'per-series', 'token')
+    for obj in objs:
+        eq_(client.post('/danvk/per-series/backfill', data=json.dumps(obj),
+                        content_type='application/json').status_code, 200)
+
+    db.add_repo('danvk', 'bulk', 'token')
+    response = client.post('/danvk/bulk/backfill/bulk', data=backfill.bulk_payload(objs),
+                           headers={'Content-Encoding': 'gzip'},
+                           content_type='application/json')
+    eq_(response.status_code, 200)
+    eq_(response.data, 'OK, stored 7 rows')
+    eq_(db.get_stats_series('danvk', 'bulk', include_labels=True),
+        db.get_stats_series('danvk', 'per-series', include_labels=True))
+
+
+def test_delta_backfill_matches_full_backfill():
+    old = [
+        {'delete': 'open_issues'},
+        {'open_issues': [[dates.day_string(700000 + i), i] for i in range(300)]},
+        {'delete': 'by_label'},
+        {'by_label': {'bug': [[dates.day_string(700000 + i), 1] for i in range(300)]}},
+        {'by_label': {'gone': [[dates.day_string(700100), 1]]}},
+    ]
+    new = [
+        {'delete': 'open_issues'},
+        {'open_issues': [[dates.day_string(700000 + i), i] for i in range(305)]},
+        {'delete': 'by_label'},
+        {'by_label': {'bug': [[dates.day_string(700000 + i), 1 + (i == 50)]
+                              for i in range(305)]}},
+        {'by_label': {'new': [[dates.day_string(700301), 1]]}},
+    ]
+    client = app.app.test_client()
+    for layout, name in ((db.ROWS_LAYOUT, 'delta'), (db.WIDE_LAYOUT, 'delta-wide')):
+        db.COUNTS_LAYOUT = layout
+        for repo in (name, name + '-full'):
+            db.add_repo('danvk', repo, 'token')
+            client.post('/danvk/%s/backfill/bulk' % repo, data=backfill.bulk_payload(old),
+                        headers={'Content-Encoding': 'gzip'}, content_type='application/json')
+            # a live update on a day which the new backfill covers
+            db.store_results([('danvk', repo, tracker.RepoStats(7, 0, 2, {}),
+                               datetime.fromordinal(700303).replace(hour=12))])
+        client.post('/danvk/%s-full/backfill/bulk' % name, data=backfill.bulk_payload(new),
+                    headers={'Content-Encoding': 'gzip'}, content_type='application/json')
+
+        remote = json.loads(client.get('/danvk/%s/backfill/digest' % name).data)
+        payload = backfill.delta_payload(new, remote['series'])
+        eq_(sorted((r['series'], r.get('label')) for r in payload['ranges']),
+            [('by_label', 'bug'), ('by_label', 'bug'), ('by_label', 'gone'), ('by_label', 'new'),
+             ('open_issues', None)])
+        response = client.post('/danvk/%s/backfill/delta' % name,
+                               data=backfill.gzip_json(payload),
+                               headers={'Content-Encoding': 'gzip'},
+                               content_type='application/json')
+        eq_(response.status_code, 200)
+        for resolution in (None, 'week'):
+            eq_(db.get_stats_series('danvk', name, include_labels=True, resolution=resolution),
+                db.get_stats_series('danvk', name + '-full', include_labels=True,
+                                    resolution=resolution))
+        remote = json.loads(client.get('/danvk/%s/backfill/digest' % name).data)
+        eq_(backfill.delta_payload(new, remote['series']), {'ranges': []})
+    db.COUNTS_LAYOUT = db.ROWS_LAYOUT
+
+    bad = {'ranges': [{'series': 'open_issues', 'from': '2015-01-01', 'to': '2015-01-01',
+                       'start': '2015-01-05', 'counts': [1]}]}
+    eq_(client.post('/danvk/delta/backfill/delta', data=json.dumps(bad),
+                    content_type='application/json').status_code, 400)
+
+
+def test_delta_backfill_keeps_later_polls():
+    old = [
+        {'delete': 'open_issues'},
+        {'open_issues': [[dates.day_string(700000 + i), i] for i in range(300)]},
+    ]
+    new = [
+        {'delete': 'open_issues'},
+        {'open_issues': [[dates.day_string(700000 + i), i + 1] for i in range(305)]},
+    ]
+    through = 700304
+    eq_(backfill.backfill_through(new), dates.day_string(through))
+    client = app.app.test_client()
+    for layout, name in ((db.ROWS_LAYOUT, 'polled'), (db.WIDE_LAYOUT, 'polled-wide')):
+        db.COUNTS_LAYOUT = layout
+        db.add_repo('danvk', name, 'token')
+        client.post('/danvk/%s/backfill/bulk' % name, data=backfill.bulk_payload(old),
+                    headers={'Content-Encoding': 'gzip'}, content_type='application/json')
+        # polls after the new backfill, but in the same digest block as its last day
+        polls = [datetime.fromordinal(through).replace(hour=12),
+                 datetime.fromordinal(through + 2)]
+        for t in polls:
+            db.store_results([('danvk', name, tracker.RepoStats(7, 42, 2, {}), t)])
+
+        url = '/danvk/%s/backfill/digest?through=%s' % (name, dates.day_string(through))
+        remote = json.loads(client.get(url).data)
+        payload = backfill.delta_payload(new, remote['series'])
+        eq_(payload['through'], dates.day_string(through))
+        eq_(client.post('/danvk/%s/backfill/delta' % name, data=json.dumps(payload),
+                        content_type='application/json').status_code, 200)
+
+        open_issues = db.get_stats_series('danvk', name)[1]
+        eq_(open_issues[-3:], [(datetime.fromordinal(through), 305)] + [(t, 42) for t in polls])
+        eq_(len(open_issues), 307)
+        remote = json.loads(client.get(url).data)
+        eq_(backfill.delta_payload(new, remote['series']), {'ranges': []})
+    db.COUNTS_LAYOUT = db.ROWS_LAYOUT
+
+
+def test_query_count_header():
+    db.add_repo('danvk', 'counted', 'token')
+    db.store_results([('danvk', 'counted', tracker.RepoStats(10, 5, 1, {'bug': 3}),
+                       datetime(2015, 1, 1))])
+    client = app.app.test_client()
+    client.get('/danvk/counted')
+    # a cached page only needs the repo's version
+    eq_(client.get('/danvk/counted').headers['X-DB-Queries'], '1')
+
+
+def test_requests_remove_their_session():
+    db.add_repo('danvk', 'sessions', 'token')
+    client = app.app.test_client()
+    for url in ('/danvk/sessions', '/danvk/sessions/json', '/danvk/sessions/json?stream=1',
+                '/danvk/untracked/json'):
+        client.get(url)
+        eq_(db.Session.registry.has(), False)
+
+
+def test_dashboard_is_precomputed():
+    db.add_repo('danvk', 'dashboard', 'token')
+    client = app.app.test_client()
+    url = '/danvk/dashboard/json?' + app.DASHBOARD_QUERY
+    uncached = url + '&start=2000-01-01'  # asks for the same points, but isn't the dashboard's
+
+    db.store_results([('danvk', 'dashboard', tracker.RepoStats(10, 5, 1, {'bug': 3, '': 2}),
+                       datetime(2015, 1, 1))])
+    eq_(app.refresh_stale_dashboards([('danvk', 'dashboard')]), 1)
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    eq_(response.headers['Content-Encoding'], 'gzip')
+    eq_(response.headers['X-DB-Queries'], '1')
+    eq_(json.loads(zlib.decompress(response.data, 16 + zlib.MAX_WBITS)),
+        json.loads(client.get(uncached).data))
+    eq_(client.get(url, headers={'Accept-Encoding': 'gzip',
+                                 'If-None-Match': response.headers['ETag']}).status_code, 304)
+
+    # writes leave it stale, for a batch job to rebuild...
+    db.store_results([('danvk', 'dashboard', tracker.RepoStats(11, 4, 2, {'bug': 2}),
+                       datetime(2015, 1, 2))])
+    eq_(db.get_dashboard('danvk', 'dashboard')[1], False)
+    eq_(app.refresh_stale_dashboards([('danvk', 'dashboard')]), 1)
+    eq_(app.refresh_stale_dashboards([('danvk', 'dashboard')]), 0)
+    eq_(json.loads(client.get(url).data), json.loads(client.get(uncached).data))
+    eq_(len(json.loads(client.get(url).data)['open_issues']), 2)
+
+    # ...or the next read, after serving the stale one. (A buffered response
+    # is closed once it's read, as a server closes one once it's sent.)
+    db.store_results([('danvk', 'dashboard', tracker.RepoStats(12, 3, 2, {'bug': 1}),
+                       datetime(2015, 1, 3))])
+    eq_(len(json.loads(client.get(url, buffered=True).data)['open_issues']), 2)
+    eq_(db.get_dashboard('danvk', 'dashboard')[1], True)
+    eq_(len(json.loads(client.get(url).data)['open_issues']), 3)
+
+    # a request which writes rebuilds it once its response is sent
+    backfill = {'open_issues': [['2014-12-31', 6]]}
+    eq_(client.post('/danvk/dashboard/backfill', data=json.dumps(backfill),
+                    content_type='application/json', buffered=True).status_code, 200)
+    eq_(db.get_dashboard('danvk', 'dashboard')[1], True)
+    eq_(len(json.loads(client.get(url).data)['open_issues']), 4)
+    eq_(db.Session.registry.has(), False)
+
+    eq_(client.get('/danvk/untracked/json?' + app.DASHBOARD_QUERY).status_code, 404)
+
+    # include_labels=False isn't the dashboard's request
+    response = client.get('/danvk/dashboard/json?include_labels=False')
+    eq_(json.loads(response.data)['by_label'], [['Date']])
+    eq_(client.get('/danvk/dashboard/json?include_labels=maybe').status_code, 400)
+
+
+def test_dashboard_has_every_point():
+    db.add_repo('danvk', 'long-history', 'token')
+    db.store_results([('danvk', 'long-history',
+                       tracker.RepoStats(i, 1000 - i % 7, i % 3, {'bug': i % 5, '': 1}),
+                       datetime.fromordinal(735000 + i)) for i in range(1200)])
+    eq_(app.refresh_stale_dashboards([('danvk', 'long-history')]), 1)
+    client = app.app.test_client()
+    payload = json.loads(client.get('/danvk/long-history/json?include_labels=True').data)
+
+    # what the page embedded, and dashboard.js fetched, before it was precomputed
+    stargazers, open_issues, open_pulls, by_label = db.get_stats_series(
+            'danvk', 'long-history', include_labels=True)
+    inline = {'owner': 'danvk', 'repo': 'long-history',
+              'stargazers': app.format_date_column(stargazers),
+              'open_issues': app.format_date_column(open_issues),
+              'open_pulls': app.format_date_column(open_pulls),
+              'by_label': [by_label[0]] + app.format_date_column(by_label[1:])}
+    eq_(len(payload['open_issues']), 1200)
+    eq_(payload, json.loads(json.dumps(inline)))
+
+    # downsampling is opt-in
+    max_points, query = app.DASHBOARD_MAX_POINTS, app.DASHBOARD_QUERY
+    app.DASHBOARD_MAX_POINTS, app.DASHBOARD_QUERY = 100, 'include_labels=True&max_points=100'
+    try:
+        app.refresh_dashboard('danvk', 'long-history')
+        response = client.get('/danvk/long-history/json?include_labels=True&max_points=100')
+        eq_(response.headers['X-DB-Queries'], '1')
+        eq_(len(json.loads(response.data)['open_issues']), 100)
+    finally:
+        app.DASHBOARD_MAX_POINTS, app.DASHBOARD_QUERY = max_points, query
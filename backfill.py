@@ -3,7 +3,7 @@
 """Backfill counts for the GitHub Issue Tracker.
 
 Usage:
-  backfill.py <user> <repo> [--host HOST] [--labels-map=map.json] [--issues | --pulls | --stars | --labels ]
+  backfill.py <user> <repo> [--host HOST] [--labels-map=map.json] [--workers=N] [--wait] [--processes=N] [--source=SOURCE] [--bulk | --delta] [--issues | --pulls | --stars | --labels ]
 
 Options:
   -h --help    Show this screen.
@@ -17,23 +17,70 @@ Options:
                new labels. This is helpful (and possibly mandatory) when
                backfilling labels which have been renamed. The backfiller will
                warn on issues where it encounters this.
+  --workers=N  Number of issues to fetch events for at once [default: 8].
+  --wait       When the GitHub API quota runs low, wait for it to reset rather
+               than saving progress and exiting.
+  --processes=N  Number of processes to replay issue events with. Worth
+               raising on machines with several cores [default: 1].
+  --source=SOURCE  Where to read issue events from [default: issues]:
+               "issues" makes one request per issue, while "repo" pages through
+               the repo's whole event stream, 100 events per request. "repo" is
+               far faster for repos with many issues but few events per issue.
+  --bulk       POST everything as one gzipped, columnar request, which the
+               tracker stores in a single transaction, rather than one
+               request per series.
+  --delta      Fetch checksums of the tracker's existing series and send only
+               the ranges of days which differ, in one gzipped request. This
+               is much smaller than --bulk when re-running a backfill.
+
+Fetched issues are saved in issue-tracker-backfill-<user>-<repo>.db, so an
+interrupted backfill picks up where it left off. So are the pages of issues
+and stargazers listed so far, until the backfill is posted: a rerun resumes
+listing from the page it stopped on. A cache directory from older versions of
+this script is imported into it automatically.
 """
 
-import glob
+from cStringIO import StringIO
+import gzip
 import os
 import json
+import multiprocessing
+import Queue
 import sys
-from collections import defaultdict
-from datetime import datetime, timedelta
+import traceback
+from collections import defaultdict, deque
+from datetime import datetime
 
-import dateutil.parser
 from docopt import docopt
 import requests
 import github
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import dates
+import digest
+import fetcher
+import issuecache
 import tracker
 
-CACHE_DIR = 'issue-tracker-backfill'
+# Fetched issues are cached here (see issuecache.py), issue-tracker-backfill-<user>-<repo>.db
+CACHE_FILE = 'issue-tracker-backfill.db'
+# Issues are written to the cache in batches of this many as their events arrive.
+CACHE_BATCH_SIZE = 100
+WORKERS = 8
+# Whether to wait out an exhausted API quota; see --wait.
+WAIT = False
+# Processes which replay issue events, and how many issues they're sent at a time.
+PROCESSES = 1
+SHARD_SIZE = 500
+
+# Sources of issue events; see --source.
+ISSUES_SOURCE = 'issues'
+REPO_SOURCE = 'repo'
+SOURCE = ISSUES_SOURCE
 
 # GitHub doesn't track label renames as events in the issue.
 # If you've renamed labels, you need to let the backfiller know.
@@ -47,47 +94,6 @@ CACHE_DIR = 'issue-tracker-backfill'
 LABEL_RENAMES = {}
 
 
-# Workaround for https://github.com/PyGithub/PyGithub/issues/345
-class Stargazer(github.GithubObject.NonCompletableGithubObject):
-    @property
-    def starred_at(self):
-        """
-        :type: datetime.datetime
-        """
-        return self._starred_at.value
-
-    @property
-    def user(self):
-        """
-        :type: :class:`github.NamedUser`
-        """
-        return self._user.value
-
-    def _initAttributes(self):
-        self._starred_at = github.GithubObject.NotSet
-        self._user = github.GithubObject.NotSet
-        self._url = github.GithubObject.NotSet
-
-    def _useAttributes(self, attributes):
-        if 'starred_at' in attributes:
-            self._starred_at = self._makeDatetimeAttribute(attributes['starred_at'])
-        if 'user' in attributes:
-            self._user = self._makeClassAttribute(github.NamedUser.NamedUser, attributes['user'])
-
-
-def get_stargazers(repo):
-    return github.PaginatedList.PaginatedList(
-        Stargazer,
-        repo._requester,
-        repo.url + "/stargazers",
-        None,
-        # XXX: mainline pygithub doesn't support this:
-        headers={
-            'Accept': 'application/vnd.github.v3.star+json'
-        }
-    )
-
-
 def fetch_full_issue(issue):
     """Fills out the events field for an Issue or Pull Request."""
     print 'Fetching issue %d...' % issue.number
@@ -98,28 +104,100 @@ def fetch_full_issue(issue):
     return issue_json
 
 
-def fetch_issue_cached(repo, issue_number):
-    cache_file = os.path.join(CACHE_DIR, '%d.json' % issue_number)
-    if os.path.exists(cache_file):
-        return json.load(open(cache_file))
+def make_fetcher():
+    return fetcher.EventFetcher(workers=WORKERS,
+                                limiter=fetcher.RateLimiter(wait_for_reset=WAIT))
 
-    issue_json = fetch_issue(repo, issue_number)
-    json.dump(issue_json, open(cache_file, 'w'), indent=2, sort_keys=True)
-    return issue_json
+
+def list_issues(cache, owner, repo_name):
+    '''Record every issue and PR in a repo in the cache's listed table.
+
+    Each page is saved along with the URL of the next one, so an interrupted
+    listing resumes from the page it was on rather than from page 1.
+    '''
+    checkpoint = cache.get_checkpoint('issues') or {'next': None, 'done': False}
+    if checkpoint['done']:
+        return
+    if checkpoint['next']:
+        sys.stderr.write('Resuming the issue listing from %s\n' % checkpoint['next'])
+    for page, next_url in make_fetcher().issue_pages(owner, repo_name, checkpoint['next']):
+        cache.put_listed(page, 'issues', {'next': next_url, 'done': next_url is None})
+
+
+def fetch_all_issues_and_pulls(repo, raw=False):
+    '''Yield every issue and PR in a repo, with its events.
+
+    The repo's issues are listed into the CACHE_FILE (see list_issues). Those
+    which aren't cached yet have their events fetched WORKERS at a time, and
+    are cached as they finish. Then every issue is streamed back out of the
+    cache, so only one is in memory at a time. If raw is set, they're yielded
+    still encoded (see issuecache.encode).
+    '''
+    owner, repo_name = repo.full_name.split('/')
+    cache = issuecache.IssueCache(CACHE_FILE)
+    list_issues(cache, owner, repo_name)
+    listed = cache.listed_numbers()
+    missing = cache.unfetched()
+    num_cached = len(listed) - len(missing)
+
+    if missing and SOURCE == REPO_SOURCE:
+        sys.stderr.write('Fetching the event stream for %d issues (%d already cached)\n' % (
+                len(missing), num_cached))
+        cache.put_many(add_repo_events(owner, repo_name, missing))
+    elif missing:
+        sys.stderr.write('Fetching events for %d issues (%d already cached)\n' % (
+                len(missing), num_cached))
+        pending = []
+
+        def on_issue(issue_data):
+            pending.append(issue_data)
+            if len(pending) >= CACHE_BATCH_SIZE:
+                cache.put_many(pending)
+                del pending[:]
+
+        try:
+            make_fetcher().fetch_events(owner, repo_name, missing, on_issue)
+        finally:
+            cache.put_many(pending)  # keep what finished, even if the fetch failed
+    del missing[:]
+
+    try:
+        for number, data in cache.iter_raw():
+            if number in listed:
+                yield data if raw else issuecache.decode(data)
+    finally:
+        cache.close()
+
+
+def add_repo_events(owner, repo_name, issues):
+    '''Fill in the events of each issue from the repo's event stream.
+
+    The stream is newest first; each issue's events are put back in the
+    oldest-first order of the per-issue endpoint, which issue_events expects.
+    Event ids increase with time, and unlike timestamps they never tie.
+    '''
+    wanted = {issue['number'] for issue in issues}
+    number_to_events = defaultdict(list)
+    num_events = 0
+    for event in make_fetcher().repo_events(owner, repo_name):
+        number = event.pop('issue')['number']
+        if number in wanted:
+            number_to_events[number].append(event)
+        num_events += 1
+        if num_events % 1000 == 0:
+            sys.stderr.write('Read %d events\n' % num_events)
+
+    out = []
+    for issue in issues:
+        events = number_to_events[issue['number']]
+        events.sort(key=lambda event: event['id'])
+        out.append(dict(issue, events=events))
+    return out
 
 
 def fetch_all_issues(repo):
-    issues = []
-    for issue in repo.get_issues(state='all'):
-        cache_file = os.path.join(CACHE_DIR, '%d.json' % issue.number)
-        if os.path.exists(cache_file):
-            issue_data = json.load(open(cache_file))
-        else:
-            issue_data = fetch_full_issue(issue)
-            json.dump(issue_data, open(cache_file, 'w'), indent=2, sort_keys=True)
-        if 'pull_request' not in issue_data:
-            issues.append(issue_data)
-    return issues
+    return (issue for issue in fetch_all_issues_and_pulls(repo)
+            if 'pull_request' not in issue)
 
 
 def fetch_all_pulls(repo):
@@ -127,21 +205,12 @@ def fetch_all_pulls(repo):
 
     This returns the issue views of the PRs, which include events (unlike the PR views).
     '''
-    prs = []
-    for pr in repo.get_pulls(state='all'):
-        cache_file = os.path.join(CACHE_DIR, '%d.json' % pr.number)
-        if os.path.exists(cache_file):
-            pr_data = json.load(open(cache_file))
-        else:
-            issue = repo.get_issue(pr.number)
-            pr_data = fetch_full_issue(issue)
-            json.dump(pr_data, open(cache_file, 'w'), indent=2, sort_keys=True)
-        prs.append(pr_data)
-    return prs
+    return (issue for issue in fetch_all_issues_and_pulls(repo)
+            if 'pull_request' in issue)
 
 
 def fetch_all_issues_from_cache():
-    return [json.load(open(path)) for path in glob.glob(CACHE_DIR + '/*.json')]
+    return issuecache.IssueCache(CACHE_FILE).iter_all()
 
 
 def needs_synthetic_close(issue):
@@ -226,22 +295,115 @@ def flatten(list_of_lists):
 
 def next_date(iso_str):
     '''Given an event during a day, return the date (YYYY-MM-DD) of the next day.'''
-    dt = dateutil.parser.parse(iso_str)
-    return (dt.date() + timedelta(days=1)).strftime('%Y-%m-%d')
+    return dates.day_string(dates.day_ordinal(iso_str) + 1)
 
 
 def all_dates(start_str, last_str=None):
     '''Return a list of dates from start to today.'''
-    d = dateutil.parser.parse(start_str)
-    if not last_str:
-        last = datetime.utcnow()
-    else:
-        last = dateutil.parser.parse(last_str)
-    dates = []
-    while d.date() <= last.date():
-        dates.append(d.strftime('%Y-%m-%d'))
-        d = d + timedelta(days=1)
-    return dates
+    last = dates.day_ordinal(last_str) if last_str else dates.today_ordinal()
+    return [dates.day_string(d) for d in xrange(dates.day_ordinal(start_str), last + 1)]
+
+
+def to_column(series):
+    '''Convert a list of (YYYY-MM-DD, count) pairs to the bulk endpoint's columnar form.'''
+    days = [dates.day_ordinal(d) for d, _ in series]
+    counts = [count for _, count in series]
+    if days and days == range(days[0], days[0] + len(days)):
+        return {'start': series[0][0], 'counts': counts}
+    return {'dates': [d for d, _ in series], 'counts': counts}
+
+
+def bulk_payload(objs):
+    '''Merge a list of backfill requests into one gzipped bulk request body.'''
+    payload = {'delete': []}
+    for obj in objs:
+        for key, value in obj.iteritems():
+            if key == 'delete':
+                payload['delete'].append(value)
+            elif key == 'by_label':
+                by_label = payload.setdefault('by_label', {})
+                for label, series in value.iteritems():
+                    by_label[label] = to_column(series)
+            else:
+                payload[key] = to_column(value)
+    return gzip_json(payload)
+
+
+def gzip_json(obj):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(json.dumps(obj, separators=(',', ':')))
+    return buf.getvalue()
+
+
+def backfill_through(objs):
+    '''The last day (YYYY-MM-DD) which backfill requests have a count for, or None.'''
+    through = None
+    for obj in objs:
+        for key, value in obj.iteritems():
+            if key == 'delete':
+                continue
+            for series in (value.itervalues() if key == 'by_label' else [value]):
+                for d, _ in series:
+                    through = max(through, dates.day_string(dates.day_ordinal(d)))
+    return through
+
+
+def delta_payload(objs, remote):
+    '''Build a delta request body from backfill requests and the tracker's digest.
+
+    Only series which objs delete are compared. For by_label, that includes
+    labels the tracker has but objs don't, whose ranges are sent empty. The
+    tracker clips the ranges to the backfill's last day (see backfill_through),
+    so they don't replace anything polled since; remote should leave that out
+    too (the digest's ?through=).
+    '''
+    local = {}  # (key, label or None) --> list of (day ordinal, count)
+    for obj in objs:
+        for key, value in obj.iteritems():
+            if key == 'delete' and value == 'by_label':
+                for label in remote.get('by_label', {}):
+                    local.setdefault(('by_label', label), [])
+            elif key == 'delete':
+                local.setdefault((value, None), [])
+            elif key == 'by_label':
+                for label, series in value.iteritems():
+                    local[(key, label)] = [(dates.day_ordinal(d), c) for d, c in series]
+            else:
+                local[(key, None)] = [(dates.day_ordinal(d), c) for d, c in value]
+
+    ranges = []
+    for (key, label), days in sorted(local.iteritems()):
+        if label is None:
+            checksums = remote.get(key, {})
+        else:
+            checksums = remote.get('by_label', {}).get(label, {})
+        for first, last, points in digest.changed_ranges(days, checksums):
+            r = {'series': key, 'from': dates.day_string(first), 'to': dates.day_string(last)}
+            if label is not None:
+                r['label'] = label
+            r.update(to_column([(dates.day_string(d), c) for d, c in points]))
+            ranges.append(r)
+    through = backfill_through(objs)
+    if ranges and through:
+        return {'ranges': ranges, 'through': through}
+    return {'ranges': ranges}
+
+
+def post_gzipped(url, body):
+    print 'POSTing %d bytes to %s...' % (len(body), url)
+    r = requests.post(url, data=body,
+                      headers={'Content-Type': 'application/json',
+                               'Content-Encoding': 'gzip'})
+    print r.text
+    r.raise_for_status()
+
+
+def clear_checkpoints():
+    '''Forget a posted backfill's listings, so that the next one lists afresh.'''
+    cache = issuecache.IssueCache(CACHE_FILE)
+    cache.clear_checkpoints()
+    cache.close()
 
 
 def summarize_rate_limit(g):
@@ -255,29 +417,229 @@ def summarize_rate_limit(g):
     sys.stderr.write('\n')
 
 
+class DayDeltas(object):
+    '''Net changes to each label's open issue count, by the day they take effect.
+
+    Issues are added one at a time, so they can be streamed in and dropped as
+    soon as they're counted: memory is O(labels x days), however many issues
+    and events there are. Label None is all open issues.
+    '''
+
+    def __init__(self, last_day=None):
+        self.last_day = last_day or dates.today_ordinal()
+        self.first_day = None
+        self.num_issues = 0
+        self.by_label = defaultdict(lambda: defaultdict(int))  # label --> day ordinal --> delta
+
+    def add(self, events):
+        '''Add one issue's (time, label, delta) events, as from issue_events.'''
+        self.num_issues += 1
+        for time_str, label, delta in events:
+            day = dates.day_ordinal(time_str)
+            if self.first_day is None or day < self.first_day:
+                self.first_day = day
+            # Changes take effect the next day, and aren't counted until after today.
+            if day + 1 < self.last_day:
+                self.by_label[label][day + 1] += delta
+
+    def merge(self, other):
+        '''Add in the deltas of another DayDeltas, e.g. from a different shard of issues.'''
+        self.num_issues += other.num_issues
+        if other.first_day is not None and (self.first_day is None or
+                                            other.first_day < self.first_day):
+            self.first_day = other.first_day
+        for label, day_to_delta in other.by_label.iteritems():
+            mine = self.by_label[label]
+            for day, delta in day_to_delta.iteritems():
+                mine[day] += delta
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['by_label'] = {label: dict(d) for label, d in self.by_label.iteritems()}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        by_label = state['by_label']
+        self.by_label = defaultdict(lambda: defaultdict(int))
+        for label, day_to_delta in by_label.iteritems():
+            self.by_label[label].update(day_to_delta)
+
+
+def accumulate_deltas(issues, backfill_labels=False):
+    '''Returns the DayDeltas of an iterable of issues, which may be a generator.'''
+    deltas = DayDeltas()
+    for issue in issues:
+        deltas.add(issue_events(issue, track_labels=backfill_labels))
+    return deltas
+
+
+def replay_worker(index, shard_queue, result_queue, pulls, backfill_labels, last_day,
+                  label_renames):
+    '''Runs in a worker process: replays shards of encoded issues until it gets
+    None, then sends back (index, DayDeltas, None), or (index, None, traceback)
+    if it failed.'''
+    global LABEL_RENAMES
+    LABEL_RENAMES = label_renames
+    try:
+        deltas = DayDeltas(last_day)
+        for shard in iter(shard_queue.get, None):
+            for data in shard:
+                issue = issuecache.decode(data)
+                if ('pull_request' in issue) == pulls:
+                    deltas.add(issue_events(issue, track_labels=backfill_labels))
+        result_queue.put((index, deltas, None))
+    except Exception:
+        result_queue.put((index, None, traceback.format_exc()))
+
+
+def shards(items, shard_size):
+    '''Split an iterable into lists of up to shard_size items.'''
+    shard = []
+    for item in items:
+        shard.append(item)
+        if len(shard) >= shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+def parallel_accumulate_deltas(encoded_issues, pulls=False, backfill_labels=False,
+                               processes=None, shard_size=SHARD_SIZE):
+    '''Like accumulate_deltas, but decodes and replays issues in several processes.
+
+    encoded_issues are issues and PRs as stored in the cache (see
+    issuecache.encode), which are much cheaper to send to another process
+    than the decoded JSON. Only PRs are counted if pulls is set, and only
+    issues otherwise.
+
+    Shards of whole issues (so each issue's events stay together) are handed
+    to whichever worker is free. Each worker keeps one DayDeltas for every
+    shard it replays, and these are added together at the end (deltas
+    commute). At most two shards per worker are queued at once, so issues can
+    still be streamed.
+    '''
+    processes = processes or multiprocessing.cpu_count()
+    total = DayDeltas()
+    shard_queue = multiprocessing.Queue(2 * processes)
+    result_queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(
+                    target=replay_worker,
+                    args=(index, shard_queue, result_queue, pulls, backfill_labels,
+                          total.last_day, LABEL_RENAMES))
+               for index in range(processes)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    reported = set()  # indexes of the workers which have sent their DayDeltas
+
+    def collect():
+        '''Merge whatever results have arrived; raise if a worker failed.'''
+        while True:
+            try:
+                index, deltas, error = result_queue.get(timeout=0.1)
+            except Queue.Empty:
+                break
+            if error:
+                raise RuntimeError('Event replay failed in a worker:\n%s' % error)
+            total.merge(deltas)
+            reported.add(index)
+        for index, worker in enumerate(workers):
+            if index not in reported and not worker.is_alive():
+                raise RuntimeError('An event replay worker exited early')
+
+    def put(item):
+        # A worker which fails stops taking shards, so don't wait forever for room.
+        while True:
+            try:
+                return shard_queue.put(item, timeout=1)
+            except Queue.Full:
+                collect()
+
+    try:
+        for shard in shards(encoded_issues, shard_size):
+            put(shard)
+        for _ in workers:
+            put(None)
+        while len(reported) < len(workers):
+            collect()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+    return total
+
+
 def backfill_core(issues, backfill_labels=False):
-    '''Shared backfilling logic between issues and pull requests.'''
-    all_events = flatten((issue_events(issue, track_labels=backfill_labels)
-                         for issue in issues))
-    if len(all_events) == 0:
+    '''Shared backfilling logic between issues and pull requests.
+
+    Returns (open_issues, by_label). This uses NumPy if it's installed, which
+    is much faster for repos with long histories and many labels.
+    '''
+    return cumulative_counts(accumulate_deltas(issues, backfill_labels=backfill_labels))
+
+
+def cumulative_counts(deltas):
+    '''Returns (open_issues, by_label) from DayDeltas.'''
+    if np is not None:
+        return numpy_cumulative_counts(deltas)
+    return python_cumulative_counts(deltas)
+
+
+def python_backfill_core(issues, backfill_labels=False):
+    return python_cumulative_counts(accumulate_deltas(issues, backfill_labels=backfill_labels))
+
+
+def numpy_backfill_core(issues, backfill_labels=False):
+    return numpy_cumulative_counts(accumulate_deltas(issues, backfill_labels=backfill_labels))
+
+
+def python_cumulative_counts(deltas):
+    if deltas.first_day is None:
         return [], {}
-    first_date = find_first_date(all_events)
-    dates = all_dates(first_date)
-    last_date = max(dates)
-
-    label_to_deltas = defaultdict(lambda: {date: 0 for date in dates})
-    for time_str, label, delta in all_events:
-        yyyy_mm_dd = next_date(time_str)
-        if yyyy_mm_dd < last_date:
-            label_to_deltas[label][yyyy_mm_dd] += delta
-    labels = label_to_deltas.keys()
-
-    label_to_count = {label: 0 for label in labels}
+    days = range(deltas.first_day, deltas.last_day + 1)
+    date_strs = [dates.day_string(day) for day in days]
+
     by_label = defaultdict(list)
-    for date in dates:
-        for label in labels:
-            label_to_count[label] += label_to_deltas[label][date]
-            by_label[label].append((date, label_to_count[label]))
+    for label, day_to_delta in deltas.by_label.iteritems():
+        count = 0
+        points = by_label[label]
+        for day, date in zip(days, date_strs):
+            count += day_to_delta.get(day, 0)
+            points.append((date, count))
+
+    open_issues = by_label[None]
+    del by_label[None]
+
+    return open_issues, by_label
+
+
+def numpy_cumulative_counts(deltas):
+    '''Same output as python_cumulative_counts, from a labels x days matrix of deltas.
+
+    Days are integer ordinals (see dates.py) and counts are cumulative sums
+    along them, so no per-(label, day) Python objects are built until the
+    output.
+    '''
+    if deltas.first_day is None:
+        return [], {}
+    num_days = deltas.last_day - deltas.first_day + 1
+    labels = list(deltas.by_label)
+    matrix = np.zeros((len(labels), num_days), dtype=np.int64)
+    for i, label in enumerate(labels):
+        day_to_delta = deltas.by_label[label]
+        days = np.fromiter(day_to_delta.iterkeys(), dtype=np.int64, count=len(day_to_delta))
+        matrix[i, days - deltas.first_day] = np.fromiter(
+                day_to_delta.itervalues(), dtype=np.int64, count=len(day_to_delta))
+    counts = np.cumsum(matrix, axis=1)
+
+    date_strs = [dates.day_string(deltas.first_day + i) for i in xrange(num_days)]
+    by_label = defaultdict(list)
+    for i, label in enumerate(labels):
+        by_label[label] = zip(date_strs, counts[i].tolist())
 
     open_issues = by_label[None]
     del by_label[None]
@@ -287,34 +649,57 @@ def backfill_core(issues, backfill_labels=False):
 
 def backfill_issues(g, owner, repo_name, backfill_labels=False):
     repo = g.get_user(owner).get_repo(repo_name)
-    issues = fetch_all_issues(repo)
+    if PROCESSES > 1:
+        deltas = parallel_accumulate_deltas(fetch_all_issues_and_pulls(repo, raw=True),
+                                            backfill_labels=backfill_labels,
+                                            processes=PROCESSES)
+    else:
+        deltas = accumulate_deltas(fetch_all_issues(repo), backfill_labels=backfill_labels)
 
-    sys.stderr.write('Loaded %d issues\n' % len(issues))
-    return backfill_core(issues, backfill_labels=backfill_labels)
+    sys.stderr.write('Loaded %d issues\n' % deltas.num_issues)
+    return cumulative_counts(deltas)
 
 
 def backfill_pulls(g, owner, repo_name):
     repo = g.get_user(owner).get_repo(repo_name)
-    pulls = fetch_all_pulls(repo)
-    sys.stderr.write('Loaded %d pull requests\n' % len(pulls))
-    return backfill_core(pulls, backfill_labels=False)[0]
+    if PROCESSES > 1:
+        deltas = parallel_accumulate_deltas(fetch_all_issues_and_pulls(repo, raw=True),
+                                            pulls=True, processes=PROCESSES)
+    else:
+        deltas = accumulate_deltas(fetch_all_pulls(repo), backfill_labels=False)
+    sys.stderr.write('Loaded %d pull requests\n' % deltas.num_issues)
+    return cumulative_counts(deltas)[0]
 
 
 def backfill_stars(g, owner, repo_name):
-    repo = g.get_user(owner).get_repo(repo_name)
-    deltas = defaultdict(int)
-    for stargazer in get_stargazers(repo):
-        dt = stargazer.starred_at
-        d = (dt.date() + timedelta(days=1)).strftime('%Y-%m-%d')
-        deltas[d] += 1
+    '''Returns cumulative stargazer counts by day.
+
+    The count of new stars on each day is checkpointed in the CACHE_FILE with
+    every page of stargazers, so an interrupted run resumes from the page it
+    was on.
+    '''
+    cache = issuecache.IssueCache(CACHE_FILE)
+    try:
+        checkpoint = cache.get_checkpoint('stargazers') or {
+                'next': None, 'done': False, 'deltas': {}}
+        deltas = defaultdict(int, checkpoint['deltas'])
+        if not checkpoint['done']:
+            pages = make_fetcher().stargazer_pages(owner, repo_name, checkpoint['next'])
+            for page, next_url in pages:
+                for stargazer in page:
+                    deltas[next_date(stargazer['starred_at'])] += 1
+                cache.set_checkpoint('stargazers', {
+                        'next': next_url, 'done': next_url is None, 'deltas': deltas})
+    finally:
+        cache.close()
     if len(deltas) == 0:
         return []
 
     first_date = min(deltas.keys())
-    dates = all_dates(first_date)
+    days = all_dates(first_date)
     count = 0
     counts = []
-    for date in dates:
+    for date in days:
         count += deltas[date]
         counts.append((date, count))
 
@@ -331,11 +716,19 @@ if __name__ == '__main__':
         print 'Using label mapping:\n%s\n' % json.dumps(LABEL_RENAMES, indent=2)
 
     host = arguments['--host']
-
-    CACHE_DIR += '-%s-%s' % (owner, repo_name)
-
-    if not os.path.exists(CACHE_DIR):
-        os.mkdir(CACHE_DIR)
+    WORKERS = int(arguments['--workers'])
+    WAIT = arguments['--wait']
+    PROCESSES = int(arguments['--processes'])
+    SOURCE = arguments['--source']
+    if SOURCE not in (ISSUES_SOURCE, REPO_SOURCE):
+        sys.stderr.write('Unknown --source %s\n' % SOURCE)
+        sys.exit(1)
+
+    CACHE_FILE = 'issue-tracker-backfill-%s-%s.db' % (owner, repo_name)
+    old_cache_dir = 'issue-tracker-backfill-%s-%s' % (owner, repo_name)
+    if os.path.isdir(old_cache_dir) and not os.path.exists(CACHE_FILE):
+        num_issues = issuecache.import_dir(old_cache_dir, issuecache.IssueCache(CACHE_FILE))
+        print 'Imported %d issues from %s into %s' % (num_issues, old_cache_dir, CACHE_FILE)
     g = tracker.get_github()
 
     open_issues = []
@@ -361,6 +754,9 @@ if __name__ == '__main__':
         if do_pulls:
             open_pulls = backfill_pulls(g, owner, repo_name)
 
+    except fetcher.RateLimitExhausted as e:
+        sys.stderr.write('%s. Progress is saved: rerun this command then, or pass --wait.\n' % e)
+        sys.exit(1)
     except github.GithubException as e:
         if e.status == 403 and 'rate limit' in e.data['message']:
             summarize_rate_limit(g)
@@ -387,6 +783,36 @@ if __name__ == '__main__':
             {'stargazers': stargazers}
         ])
 
+    if arguments['--bulk']:
+        print 'Successfully generated backfill data.'
+        post_gzipped('http://%s/%s/%s/backfill/bulk' % (host, owner, repo_name),
+                     bulk_payload(objs))
+        clear_checkpoints()
+        print 'Success! Now visit http://%s/%s/%s' % (host, owner, repo_name)
+        sys.exit(0)
+
+    if arguments['--delta']:
+        print 'Successfully generated backfill data.'
+        url = 'http://%s/%s/%s/backfill/digest' % (host, owner, repo_name)
+        through = backfill_through(objs)
+        r = requests.get(url, params={'through': through} if through else None)
+        r.raise_for_status()
+        remote = r.json()
+        if remote['block_days'] != digest.BLOCK_DAYS:
+            sys.stderr.write('%s uses %d-day blocks, but this script uses %d; try --bulk\n' % (
+                    url, remote['block_days'], digest.BLOCK_DAYS))
+            sys.exit(1)
+        payload = delta_payload(objs, remote['series'])
+        if not payload['ranges']:
+            clear_checkpoints()
+            print 'Nothing has changed.'
+            sys.exit(0)
+        post_gzipped('http://%s/%s/%s/backfill/delta' % (host, owner, repo_name),
+                     gzip_json(payload))
+        clear_checkpoints()
+        print 'Success! Now visit http://%s/%s/%s' % (host, owner, repo_name)
+        sys.exit(0)
+
     url = 'http://%s/%s/%s/backfill' % (host, owner, repo_name)
     print 'Successfully generated backfill data.'
     print 'POSTing to %s...' % url
@@ -397,4 +823,5 @@ if __name__ == '__main__':
         print r.text
         r.raise_for_status()
 
+    clear_checkpoints()
     print 'Success! Now visit http://%s/%s/%s' % (host, owner, repo_name)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""Time the backfill engines and parallel event replay on a synthetic history.
+
+Usage:
+  backfill_bench.py [--issues=N] [--labels=N] [--years=N] [--seed=N] [--processes=LIST]
+
+Options:
+  -h --help    Show this screen.
+  --issues=N   Number of issues [default: 20000].
+  --labels=N   Number of distinct labels [default: 300].
+  --years=N    Length of the history, ending today [default: 10].
+  --seed=N     Random seed [default: 0].
+  --processes=LIST  Pool sizes to replay events with [default: 2,4,8].
+
+Both engines are run on the same issues and their outputs are checked for
+equality. Then decoding cached issues and replaying their events is timed
+serially and with each pool size (parallel_accumulate_deltas), and the
+results are checked against the serial one.
+Speedups are bounded by the number of cores.
+"""
+
+from datetime import datetime, timedelta
+import multiprocessing
+import random
+import time
+
+from docopt import docopt
+
+import backfill
+import issuecache
+
+
+def iso(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def make_issues(num_issues, num_labels, num_years):
+    '''Issues which are opened, labeled, unlabeled, and usually closed.'''
+    start = datetime.utcnow() - timedelta(days=365 * num_years)
+    span_secs = 365 * num_years * 86400
+    issues = []
+    for number in range(1, num_issues + 1):
+        t = start + timedelta(seconds=random.randrange(span_secs))
+        events = []
+        labels = set()
+        for _ in range(random.randint(0, 4)):
+            t += timedelta(hours=random.randint(1, 24 * 30))
+            label = 'label-%d' % random.randrange(num_labels)
+            if label in labels:
+                labels.remove(label)
+                events.append({'event': 'unlabeled', 'created_at': iso(t), 'label': {'name': label}})
+            else:
+                labels.add(label)
+                events.append({'event': 'labeled', 'created_at': iso(t), 'label': {'name': label}})
+        closed_at = None
+        if random.random() < 0.8:
+            t += timedelta(days=random.randint(1, 365))
+            closed_at = iso(t)
+            events.append({'event': 'closed', 'created_at': closed_at})
+        issues.append({
+            'number': number,
+            'created_at': iso(start + timedelta(seconds=random.randrange(span_secs)))
+                          if not events else events[0]['created_at'],
+            'state': 'closed' if closed_at else 'open',
+            'closed_at': closed_at,
+            'labels': [{'name': label} for label in labels],
+            'events': events,
+        })
+    return issues
+
+
+def timed(fn, *args, **kwargs):
+    start_secs = time.time()
+    result = fn(*args, **kwargs)
+    return result, time.time() - start_secs
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    random.seed(int(arguments['--seed']))
+    issues = make_issues(int(arguments['--issues']), int(arguments['--labels']),
+                         int(arguments['--years']))
+
+    python_result, python_secs = timed(backfill.python_backfill_core, issues, backfill_labels=True)
+    numpy_result, numpy_secs = timed(backfill.numpy_backfill_core, issues, backfill_labels=True)
+    assert numpy_result == python_result
+
+    print 'python: %7.2f secs' % python_secs
+    print 'numpy:  %7.2f secs (%.1fx)' % (numpy_secs, python_secs / numpy_secs)
+
+    # The parallel replay reads issues as they're stored in the cache, so the
+    # serial baseline decodes them too.
+    encoded = [issuecache.encode(issue) for issue in issues]
+    serial, serial_secs = timed(backfill.accumulate_deltas,
+                                (issuecache.decode(data) for data in encoded),
+                                backfill_labels=True)
+    print 'decode and replay, %d cores:' % multiprocessing.cpu_count()
+    print '  serial:      %7.2f secs' % serial_secs
+    expected = backfill.cumulative_counts(serial)
+    for processes in [int(n) for n in arguments['--processes'].split(',')]:
+        deltas, secs = timed(backfill.parallel_accumulate_deltas, encoded,
+                             backfill_labels=True, processes=processes)
+        assert backfill.cumulative_counts(deltas) == expected
+        print '  %d processes: %7.2f secs (%.1fx)' % (processes, secs, serial_secs / secs)
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
 import backfill
+import issuecache
 from nose.tools import eq_
 
 import json
+import weakref
 
 closed_issue = json.loads('''
 {
@@ -125,3 +127,55 @@ def test_all_dates():
     all_dates = backfill.all_dates
     eq_(all_dates('2015-09-29', '2015-10-03 12:34:56'),
         ['2015-09-29', '2015-09-30', '2015-10-01', '2015-10-02', '2015-10-03'])
+
+
+def test_numpy_backfill_core_matches_python():
+    reopened_issue = dict(tortured_history_issue, number=700, events=[
+        {'created_at': '2015-01-01T10:00:00Z', 'event': 'labeled', 'label': {'name': 'bug'}},
+        {'created_at': '2015-01-03T10:00:00Z', 'event': 'closed'},
+        {'created_at': '2015-01-05T10:00:00Z', 'event': 'reopened'},
+    ], labels=[{'name': 'bug'}], state='open', closed_at=None)
+    for issues in ([closed_issue], [tortured_history_issue],
+                   [closed_issue, tortured_history_issue, reopened_issue]):
+        for backfill_labels in (False, True):
+            expected = backfill.python_backfill_core(issues, backfill_labels=backfill_labels)
+            eq_(backfill.numpy_backfill_core(issues, backfill_labels=backfill_labels), expected)
+    eq_(backfill.numpy_backfill_core([]), ([], {}))
+
+
+def test_backfill_core_streams_issues():
+    class Issue(dict):
+        pass  # plain dicts can't be weakly referenced
+
+    refs = []
+    max_alive = []
+
+    def issues():
+        for number in range(1, 101):
+            max_alive.append(sum(1 for ref in refs if ref() is not None))
+            issue = Issue(tortured_history_issue, number=number)
+            refs.append(weakref.ref(issue))
+            yield issue
+
+    open_issues, by_label = backfill.backfill_core(issues(), backfill_labels=True)
+    eq_(open_issues, [(date, 100 * count) for date, count in
+                      backfill.backfill_core([tortured_history_issue])[0]])
+    # the consumer only ever holds on to the issue it's counting
+    eq_(max(max_alive), 1)
+
+
+def test_parallel_replay_matches_serial():
+    pull = dict(closed_issue, number=1000, pull_request={})
+    issues = [dict(issue, number=number) for number in range(50)
+              for issue in (closed_issue, tortured_history_issue)]
+    encoded = [issuecache.encode(issue) for issue in issues + [pull]]
+    serial = backfill.accumulate_deltas(issues, backfill_labels=True)
+    parallel = backfill.parallel_accumulate_deltas(iter(encoded), backfill_labels=True,
+                                                   processes=2, shard_size=7)
+    eq_(parallel.num_issues, 100)
+    eq_(parallel.first_day, serial.first_day)
+    eq_(backfill.cumulative_counts(parallel), backfill.cumulative_counts(serial))
+
+    pulls = backfill.parallel_accumulate_deltas(encoded, pulls=True, processes=2)
+    eq_(backfill.cumulative_counts(pulls), backfill.cumulative_counts(
+            backfill.accumulate_deltas([pull])))
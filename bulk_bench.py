@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Compare backfill ingest throughput: one request per series vs the bulk endpoint.
+
+Usage:
+  bulk_bench.py [--labels=N] [--days=N] [--later=N]
+
+Options:
+  -h --help   Show this screen.
+  --labels=N  Number of labels to backfill, besides the base series [default: 300].
+  --days=N    Days of history per series [default: 3650].
+  --later=N   Days until the backfill is re-run with --delta [default: 3].
+
+This adds repos named bench/per-series and bench/bulk to the database in
+DATABASE_URL (the bulk path uses COPY on Postgres and chunked executemany
+elsewhere). If DATABASE_URL isn't set, a temporary SQLite file is used.
+Requests go through Flask's test client, so request parsing is included but
+the network isn't.
+
+Finally the backfill is re-run against bench/bulk as if --later days had
+passed, sending only what changed (backfill.py --delta), and the bytes sent
+each way are compared with re-sending everything.
+"""
+
+from datetime import date, timedelta
+import json
+import os
+import random
+import tempfile
+import time
+import zlib
+
+from docopt import docopt
+
+import dates
+
+
+def make_objs(num_labels, num_days):
+    '''The list of requests backfill.py would send.'''
+    start = date.today() - timedelta(days=num_days)
+    days = [(start + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(num_days)]
+
+    def series():
+        return [[d, random.randint(0, 100)] for d in days]
+
+    objs = [{'delete': 'open_issues'}, {'open_issues': series()}, {'delete': 'by_label'}]
+    objs.extend({'by_label': {'label-%d' % i: series()}} for i in range(num_labels))
+    objs.extend([{'delete': 'stargazers'}, {'stargazers': series()}])
+    return objs
+
+
+def extend_objs(objs, num_days):
+    '''The requests backfill.py would send num_days later, if nothing else changed.'''
+    def extend(series):
+        last = dates.day_ordinal(series[-1][0])
+        return series + [[dates.day_string(last + i + 1), series[-1][1]]
+                         for i in range(num_days)]
+
+    later = []
+    for obj in objs:
+        if 'by_label' in obj:
+            later.append({'by_label': {label: extend(series)
+                                       for label, series in obj['by_label'].iteritems()}})
+        elif 'delete' in obj:
+            later.append(obj)
+        else:
+            later.append({key: extend(series) for key, series in obj.iteritems()})
+    return later
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    if 'DATABASE_URL' not in os.environ:
+        os.environ['DATABASE_URL'] = 'sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'bench.db')
+    import app
+    import backfill
+    import db
+
+    objs = make_objs(int(arguments['--labels']), int(arguments['--days']))
+    num_rows = sum(len(series) for obj in objs for key, series in obj.iteritems()
+                   if key not in ('delete', 'by_label'))
+    num_rows += sum(len(series) for obj in objs for series in obj.get('by_label', {}).values())
+    client = app.app.test_client()
+
+    for repo in ('per-series', 'bulk'):
+        if not db.is_repo_tracked('bench', repo):
+            db.add_repo('bench', repo, None)
+
+    start_secs = time.time()
+    for obj in objs:
+        client.post('/bench/per-series/backfill', data=json.dumps(obj),
+                    content_type='application/json')
+    per_series_secs = time.time() - start_secs
+
+    start_secs = time.time()
+    body = backfill.bulk_payload(objs)
+    response = client.post('/bench/bulk/backfill/bulk', data=body,
+                           headers={'Content-Encoding': 'gzip'}, content_type='application/json')
+    assert response.status_code == 200, response.data
+    bulk_secs = time.time() - start_secs
+
+    print 'per-series: %4d requests  %8.2f secs  %9.0f rows/sec' % (
+            len(objs), per_series_secs, num_rows / per_series_secs)
+    print 'bulk:       %4d request   %8.2f secs  %9.0f rows/sec  (%.1f MB gzipped)' % (
+            1, bulk_secs, num_rows / bulk_secs, len(body) / 1e6)
+
+    later = extend_objs(objs, int(arguments['--later']))
+    start_secs = time.time()
+    response = client.get('/bench/bulk/backfill/digest', headers={'Accept-Encoding': 'gzip'})
+    digest_bytes = len(response.data)
+    remote = json.loads(zlib.decompress(response.data, 16 + zlib.MAX_WBITS))
+    payload = backfill.delta_payload(later, remote['series'])
+    body = backfill.gzip_json(payload)
+    response = client.post('/bench/bulk/backfill/delta', data=body,
+                           headers={'Content-Encoding': 'gzip'}, content_type='application/json')
+    assert response.status_code == 200, response.data
+    delta_secs = time.time() - start_secs
+    print 're-run %d days later:' % int(arguments['--later'])
+    print '  bulk:  %10d bytes up' % len(backfill.bulk_payload(later))
+    print '  delta: %10d bytes up, %d down (digest), %d ranges, %.2f secs' % (
+            len(body), digest_bytes, len(payload['ranges']), delta_secs)
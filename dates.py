@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+'''Fast parsing of the fixed-format dates which GitHub and backfill.py produce.
+
+Nearly every date the tracker handles is either a GitHub timestamp
+(YYYY-MM-DDTHH:MM:SSZ) or a backfill day (YYYY-MM-DD), and the same days
+come up over and over. Parsing these with dateutil is the main cost of a
+backfill, so these functions slice the fields out directly, memoize by day,
+and only hand unusual strings to dateutil.
+
+Days are represented as proleptic Gregorian ordinals (date.toordinal()), so
+day arithmetic is integer arithmetic.
+'''
+
+from datetime import date, datetime
+
+from dateutil.tz import tzutc
+import dateutil.parser
+
+# The memos are cleared when they reach this many entries.
+MAX_MEMO_SIZE = 100000
+
+_day_ordinals = {}  # 'YYYY-MM-DD' --> ordinal
+_day_strings = {}  # ordinal --> 'YYYY-MM-DD'
+
+
+def _remember(memo, key, value):
+    if len(memo) >= MAX_MEMO_SIZE:
+        memo.clear()
+    memo[key] = value
+    return value
+
+
+def _is_day_prefix(s):
+    return len(s) >= 10 and s[4] == '-' and s[7] == '-' and s[:4].isdigit()
+
+
+def day_ordinal(s):
+    '''The ordinal of the day in an ISO-8601 string, like dateutil's parse(s).date().
+
+    Any offset is ignored, just as .date() ignores it.
+    '''
+    day = s[:10]
+    ordinal = _day_ordinals.get(day)
+    if ordinal is not None:
+        return ordinal
+    if _is_day_prefix(s) and (len(s) == 10 or s[10] in 'T '):
+        try:
+            return _remember(_day_ordinals, day,
+                             date(int(day[:4]), int(day[5:7]), int(day[8:10])).toordinal())
+        except ValueError:
+            pass
+    return dateutil.parser.parse(s).date().toordinal()
+
+
+def day_string(ordinal):
+    '''The YYYY-MM-DD string for a day ordinal.'''
+    s = _day_strings.get(ordinal)
+    if s is None:
+        s = _remember(_day_strings, ordinal, date.fromordinal(ordinal).strftime('%Y-%m-%d'))
+    return s
+
+
+def today_ordinal():
+    return datetime.utcnow().date().toordinal()
+
+
+def parse_datetime(s):
+    '''Parse an ISO-8601 string as a naive UTC datetime.
+
+    YYYY-MM-DD and YYYY-MM-DDTHH:MM:SSZ take the fast path; anything else goes
+    through dateutil, with offsets converted to UTC.
+    '''
+    if _is_day_prefix(s):
+        try:
+            if len(s) == 10:
+                return datetime.fromordinal(day_ordinal(s))
+            if len(s) == 20 and s[10] == 'T' and s[19] == 'Z':
+                return datetime(int(s[:4]), int(s[5:7]), int(s[8:10]),
+                                int(s[11:13]), int(s[14:16]), int(s[17:19]))
+        except ValueError:
+            pass
+    t = dateutil.parser.parse(s)
+    if t.tzinfo:
+        t = t.astimezone(tzutc()).replace(tzinfo=None)
+    return t
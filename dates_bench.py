@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Microbenchmarks for dates.py against the dateutil code it replaced.
+
+Usage:
+  dates_bench.py [--number=N] [--days=N]
+
+Options:
+  -h --help   Show this screen.
+  --number=N  Timestamps to parse per case [default: 100000].
+  --days=N    Distinct days the timestamps fall on [default: 3650].
+"""
+
+from datetime import datetime, timedelta
+import random
+import time
+
+from dateutil.tz import tzutc
+import dateutil.parser
+from docopt import docopt
+
+import dates
+
+
+def old_next_date(iso_str):
+    dt = dateutil.parser.parse(iso_str)
+    return (dt.date() + timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def new_next_date(iso_str):
+    return dates.day_string(dates.day_ordinal(iso_str) + 1)
+
+
+def timed(fn, inputs):
+    start_secs = time.time()
+    for s in inputs:
+        fn(s)
+    return time.time() - start_secs
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    number = int(arguments['--number'])
+    num_days = int(arguments['--days'])
+    start = datetime(2010, 1, 1)
+    times = [start + timedelta(seconds=random.randrange(num_days * 86400)) for _ in range(number)]
+    github_times = [t.strftime('%Y-%m-%dT%H:%M:%SZ') for t in times]
+    days = [t.strftime('%Y-%m-%d') for t in times]
+
+    cases = [
+        ('next_date(YYYY-MM-DDTHH:MM:SSZ)', old_next_date, new_next_date, github_times),
+        ('parse(YYYY-MM-DD)', dateutil.parser.parse, dates.parse_datetime, days),
+        ('parse(YYYY-MM-DDTHH:MM:SSZ)', dateutil.parser.parse, dates.parse_datetime,
+         github_times),
+    ]
+    for name, old, new, inputs in cases:
+        for s in inputs[:100]:
+            expected = old(s)
+            if getattr(expected, 'tzinfo', None):
+                expected = expected.astimezone(tzutc()).replace(tzinfo=None)
+            assert new(s) == expected, s
+        old_secs = timed(old, inputs)
+        new_secs = timed(new, inputs)
+        print '%-34s dateutil %6.2f us  dates.py %6.2f us  (%.0fx)' % (
+                name, old_secs / number * 1e6, new_secs / number * 1e6, old_secs / new_secs)
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+
+from datetime import datetime
+
+import dateutil.parser
+from nose.tools import eq_
+
+import dates
+
+
+def test_day_ordinal_matches_dateutil():
+    for s in ('2015-09-29T15:14:05Z', '2015-09-29', '2015-10-03 12:34:56',
+              '2015-10-03T23:30:00-05:00', 'Oct 3, 2015', '2016-02-29T00:00:00Z'):
+        eq_(dates.day_ordinal(s), dateutil.parser.parse(s).date().toordinal())
+
+
+def test_day_string():
+    eq_(dates.day_string(dates.day_ordinal('2015-12-31T23:59:59Z') + 1), '2016-01-01')
+
+
+def test_parse_datetime():
+    eq_(dates.parse_datetime('2015-09-29'), datetime(2015, 9, 29))
+    eq_(dates.parse_datetime('2015-09-29T15:14:05Z'), datetime(2015, 9, 29, 15, 14, 5))
+    eq_(dates.parse_datetime('2015-09-29T10:14:05-05:00'), datetime(2015, 9, 29, 15, 14, 5))
+    eq_(dates.parse_datetime('2015-09-29 15:14'), datetime(2015, 9, 29, 15, 14))
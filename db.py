@@ -1,26 +1,101 @@
 #!/usr/bin/env python
 
-from sqlalchemy import create_engine, or_
+from sqlalchemy import create_engine, and_, bindparam, event, func, inspect, or_
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Sequence, DateTime, ForeignKey
-from sqlalchemy.orm import sessionmaker, relationship, backref
+from sqlalchemy import Column, Integer, String, Sequence, DateTime, ForeignKey, Boolean, Text, Index, LargeBinary
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import scoped_session, sessionmaker, relationship, backref
 from sqlalchemy.orm.exc import NoResultFound
-import dateutil.parser
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import CreateIndex
 
-from collections import defaultdict
-from datetime import datetime
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+import csv
+import itertools
+import json
 import os
+import threading
 import time
 
+import dates
+import digest
+import metrics
+from downsample import RESOLUTIONS, bucket_start, iter_resample, resample
+import tracker
+import webhooks
 
 DATABASE_URL = os.environ.get('DATABASE_URL', 'postgres:///issue-tracker')
 #engine = create_engine(DATABASE_URL, echo=True)
-engine = create_engine(DATABASE_URL)
-Session = sessionmaker(bind=engine)
+if DATABASE_URL in ('sqlite://', 'sqlite:///:memory:'):
+    # An in-memory database only lives as long as its connection, so share one
+    # between threads rather than giving each thread (and GC) its own.
+    engine = create_engine(DATABASE_URL, poolclass=StaticPool,
+                           connect_args={'check_same_thread': False})
+elif DATABASE_URL.startswith('sqlite:'):
+    # SQLite files get a NullPool, which doesn't take the pool settings below.
+    engine = create_engine(DATABASE_URL)
+else:
+    # Every process has a pool of its own. gunicorn's sync workers serve one
+    # request at a time, so the web process can set these low to keep
+    # (workers x connections) under the database's limit; update.py fetches
+    # --workers repos at once and needs at least that many.
+    engine = create_engine(DATABASE_URL,
+                           pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+                           max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+                           pool_recycle=3600)
+
+# Each thread has a session of its own, and in app.py so does each request:
+# its teardown calls Session.remove(). The functions below take the thread's
+# session with session_scope, which closes it (returning its connection to
+# the pool) when they're done, even if they raise. label_ids commits while
+# its callers' transactions are open, so it uses a separate make_session().
+make_session = sessionmaker(bind=engine)
+Session = scoped_session(make_session)
+if metrics.ENABLED:
+    metrics.instrument_engine(engine)
+
+_query_counts = threading.local()
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    _query_counts.count = getattr(_query_counts, 'count', 0) + 1
+
+
+def query_count():
+    '''Returns the number of queries this thread has sent since reset_query_count.'''
+    return getattr(_query_counts, 'count', 0)
+
+
+def reset_query_count():
+    _query_counts.count = 0
+
+
+@contextmanager
+def session_scope():
+    '''The thread's session, closed (rolling back anything uncommitted) on the way out.'''
+    session = Session()
+    try:
+        yield session
+    finally:
+        session.close()
 
 STARS_LABEL = '__STARS'
 ALL_ISSUES_LABEL = '__ALL'
 PULL_REQUESTS_LABEL = '__PRS'
+BASE_LABELS = (ALL_ISSUES_LABEL, PULL_REQUESTS_LABEL, STARS_LABEL)
+
+# How counts are stored:
+# - rows: one CountsByLabel row per (repo, label, time). The original layout.
+# - wide: one Snapshots row per (repo, time) holding every label's count, with
+#   label names interned in LabelNames. Far fewer, larger rows.
+# Run migrate_counts.py to copy existing rows before switching to wide.
+ROWS_LAYOUT = 'rows'
+WIDE_LAYOUT = 'wide'
+COUNTS_LAYOUT = os.environ.get('COUNTS_LAYOUT', ROWS_LAYOUT)
 
 
 Base = declarative_base()
@@ -45,6 +120,7 @@ class Repos(Base):
 
 class CountsByLabel(Base):
     __tablename__ = 'counts_by_label'
+    __table_args__ = (Index('ix_counts_by_label_repo_id_label_time', 'repo_id', 'label', 'time'),)
     id = Column(Integer, primary_key=True, nullable=False)
     repo_id = Column(Integer, ForeignKey('repos.id'))
     repo = relationship("Repos")
@@ -53,104 +129,936 @@ class CountsByLabel(Base):
     count = Column(Integer)
 
 
+class LabelNames(Base):
+    '''Dictionary of label names, so that snapshots can refer to labels by id.'''
+    __tablename__ = 'label_names'
+    id = Column(Integer, primary_key=True, nullable=False)
+    name = Column(String(50), unique=True)
+
+
+class Snapshots(Base):
+    '''Every count for a repo at one instant, for the wide layout.'''
+    __tablename__ = 'snapshots'
+    __table_args__ = (Index('ix_snapshots_repo_id_time', 'repo_id', 'time'),)
+    id = Column(Integer, primary_key=True, nullable=False)
+    repo_id = Column(Integer, ForeignKey('repos.id'))
+    time = Column(DateTime)
+    counts = Column(Text)  # JSON list of [label id, count] pairs
+
+
+class Rollups(Base):
+    '''Each label's last count in each day, week and month.
+
+    These are maintained as counts are written, so that coarse views of long
+    histories don't need to read every raw count. bucket is the start of the
+    day, week (Monday) or month; time is when its count was observed.
+    '''
+    __tablename__ = 'rollups'
+    __table_args__ = (Index('ix_rollups_repo_id_resolution_bucket_label',
+                            'repo_id', 'resolution', 'bucket', 'label', unique=True),)
+    id = Column(Integer, primary_key=True, nullable=False)
+    repo_id = Column(Integer, ForeignKey('repos.id'))
+    resolution = Column(String(5))  # one of downsample.RESOLUTIONS
+    label = Column(String(50))
+    bucket = Column(DateTime)
+    time = Column(DateTime)
+    count = Column(Integer)
+
+
+class RollupRebuilds(Base):
+    '''When a repo's rollups were rebuilt from all its raw counts (or it was added).
+
+    Rollups are only maintained as counts are written, so for a repo tracked
+    before they existed they cover recent history alone until rebuild_rollups
+    runs. Reads use the raw counts until then.
+    '''
+    __tablename__ = 'rollup_rebuilds'
+    repo_id = Column(Integer, ForeignKey('repos.id'), primary_key=True, nullable=False)
+    rebuilt_at = Column(DateTime)
+
+
+class RepoSettings(Base):
+    '''Optional per-repo settings. Repos without a row use the defaults.'''
+    __tablename__ = 'repo_settings'
+    repo_id = Column(Integer, ForeignKey('repos.id'), primary_key=True, nullable=False)
+    fetch_mode = Column(String(20))  # one of tracker.FETCH_MODES
+
+
+class OpenIssues(Base):
+    '''Last-seen labels of every open issue and PR, for incremental fetching.
+
+    Issues which aren't listed here are closed (or were never seen).
+    '''
+    __tablename__ = 'open_issues'
+    repo_id = Column(Integer, ForeignKey('repos.id'), primary_key=True, nullable=False)
+    number = Column(Integer, primary_key=True, nullable=False)
+    is_pull = Column(Boolean)
+    labels = Column(Text)  # JSON list of label names
+
+
+class IssueSyncs(Base):
+    '''When the open_issues rows for a repo were last brought up to date.'''
+    __tablename__ = 'issue_syncs'
+    repo_id = Column(Integer, ForeignKey('repos.id'), primary_key=True, nullable=False)
+    synced_at = Column(DateTime)  # pass as `since` on the next poll
+    reconciled_at = Column(DateTime)  # last time every open issue was listed
+
+
+class LiveCounts(Base):
+    '''The current counts of a repo in webhook mode, kept up to date by apply_webhook.'''
+    __tablename__ = 'live_counts'
+    repo_id = Column(Integer, ForeignKey('repos.id'), primary_key=True, nullable=False)
+    label = Column(String(50), primary_key=True, nullable=False)  # or one of BASE_LABELS
+    count = Column(Integer)
+
+
+class LiveSnapshots(Base):
+    '''When a webhook repo's live counts were last stored as a snapshot.'''
+    __tablename__ = 'live_snapshots'
+    repo_id = Column(Integer, ForeignKey('repos.id'), primary_key=True, nullable=False)
+    snapshot_at = Column(DateTime)
+
+
+class WebhookDeliveries(Base):
+    '''The X-GitHub-Delivery ids of applied webhooks, so that redeliveries are ignored.'''
+    __tablename__ = 'webhook_deliveries'
+    __table_args__ = (Index('ix_webhook_deliveries_received_at', 'received_at'),)
+    id = Column(String(64), primary_key=True, nullable=False)
+    repo_id = Column(Integer, ForeignKey('repos.id'))
+    received_at = Column(DateTime)
+    changes = Column(Text)  # the WebhookUpdate, as webhooks.encode_update JSON
+
+
+class RepoVersions(Base):
+    '''Bumped whenever a repo's counts change, so cached responses can tell they're stale.'''
+    __tablename__ = 'repo_versions'
+    repo_id = Column(Integer, ForeignKey('repos.id'), primary_key=True, nullable=False)
+    version = Column(Integer)
+
+
+class Dashboards(Base):
+    '''Each repo's dashboard payload, gzipped JSON, as of a RepoVersions version.'''
+    __tablename__ = 'dashboards'
+    repo_id = Column(Integer, ForeignKey('repos.id'), primary_key=True, nullable=False)
+    version = Column(Integer)
+    body = Column(LargeBinary)
+
+
+def create_missing_indexes():
+    '''create_all only creates indexes along with their tables, so add any new ones.
+
+    This is run by migrate_indexes.py rather than at startup, since building an
+    index on a big table takes a while. On Postgres each index is built with
+    CREATE INDEX CONCURRENTLY, which doesn't block writes to the table. If that
+    fails it leaves an invalid index behind, which needs to be dropped before
+    re-running. Returns the names of the indexes created.
+    '''
+    inspector = inspect(engine)
+    concurrently = engine.dialect.name == 'postgresql'
+    created = []
+    for table in Base.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+            if concurrently:
+                # CONCURRENTLY can't be used inside a transaction.
+                ddl = ddl.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1)
+                conn = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+            else:
+                conn = engine.connect()
+            try:
+                conn.execute(ddl)
+            finally:
+                conn.close()
+            created.append(index.name)
+    return created
+
+
+def create_missing_columns():
+    '''create_all only creates columns along with their tables, so add any new ones.
+
+    New columns are nullable, so adding one doesn't rewrite the table.
+    '''
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                        table.name, column.name, column.type.compile(dialect=engine.dialect)))
+
+
 Base.metadata.create_all(engine)
+create_missing_columns()
+
+
+_label_ids = {}
+_label_names = {}
+
+
+class TTLCache(object):
+    '''A thread-safe dict whose entries expire ttl seconds after they're set.'''
+
+    def __init__(self, ttl, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = {}  # key --> (value, expiry time)
+
+    def get(self, key):
+        '''Returns the value for key, or None if there isn't one or it has expired.'''
+        with self.lock:
+            value, expires = self.entries.get(key, (None, None))
+            if expires is not None and expires <= self.clock():
+                del self.entries[key]
+                return None
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, self.clock() + self.ttl)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+# Repo and user lookups are cached in each process for this many seconds.
+# Repos are never removed and add_user invalidates its user here, so this only
+# bounds how long other processes can see a user's old token.
+LOOKUP_CACHE_SECS = float(os.environ.get('LOOKUP_CACHE_SECS', 300))
+_repo_refs = TTLCache(LOOKUP_CACHE_SECS)  # (owner, repo) --> RepoRef
+_users = TTLCache(LOOKUP_CACHE_SECS)  # user id --> detached Users
+_rollups_complete = TTLCache(LOOKUP_CACHE_SECS)  # repo id --> whether rollups cover all history
+
+# What get_repo returns: enough to identify a tracked repo.
+RepoRef = namedtuple('RepoRef', ['id', 'owner', 'repo'])
+
+# Functions called with (owner, repo) after a write to that repo's counts commits.
+WRITE_HOOKS = []
+
+# Webhook delivery ids are remembered this long. GitHub only redelivers recent ones.
+DELIVERY_RETENTION = timedelta(days=7)
+
+
+def bump_version(session, repo_id):
+    row = session.query(RepoVersions).get(repo_id)
+    if row:
+        row.version += 1
+    else:
+        session.add(RepoVersions(repo_id=repo_id, version=1))
+
+
+def notify_write(owner, repo):
+    for hook in WRITE_HOOKS:
+        hook(owner, repo)
+
+
+def get_repo_version(owner, repo):
+    '''Returns a number which changes whenever the repo's counts do, or None if it's untracked.'''
+    with session_scope() as session:
+        try:
+            repo = get_repo(session, owner, repo)
+        except NoResultFound:
+            return None
+        version = (session.query(RepoVersions.version)
+                   .filter(RepoVersions.repo_id == repo.id).scalar())
+    return version or 0
+
+
+def get_dashboard(owner, repo):
+    '''Returns a repo's stored dashboard as (body, is_current), or None if it has none.
+
+    is_current is False if the repo's counts have changed since it was stored.
+    Raises NoResultFound if the repo isn't tracked.
+    '''
+    with session_scope() as session:
+        repo = get_repo(session, owner, repo)
+        row = (session.query(Dashboards.body, Dashboards.version, RepoVersions.version)
+               .outerjoin(RepoVersions, RepoVersions.repo_id == Dashboards.repo_id)
+               .filter(Dashboards.repo_id == repo.id)).first()
+    if row is None:
+        return None
+    body, version, current_version = row
+    return body, version == (current_version or 0)
+
+
+def put_dashboard(owner, repo, version, body):
+    '''Store a repo's dashboard, built from its counts as of get_repo_version's version.'''
+    with session_scope() as session:
+        repo = get_repo(session, owner, repo)
+        session.merge(Dashboards(repo_id=repo.id, version=version, body=body))
+        try:
+            session.commit()
+        except IntegrityError:
+            pass  # another process stored one first; the next read checks its version
+
+
+def label_ids(names):
+    '''Returns a dict of label name --> LabelNames id, adding any new names.'''
+    missing = set(name for name in names if name not in _label_ids)
+    if missing:
+        session = make_session()
+        try:
+            for name in missing:
+                try:
+                    session.add(LabelNames(name=name))
+                    session.commit()
+                except IntegrityError:
+                    session.rollback()  # it's already there
+            for row in session.query(LabelNames).filter(LabelNames.name.in_(missing)):
+                _label_ids[row.name] = row.id
+                _label_names[row.id] = row.name
+        finally:
+            session.close()
+    return {name: _label_ids[name] for name in names}
+
+
+def label_names(session, ids):
+    '''Returns a dict of LabelNames id --> label name.'''
+    missing = set(i for i in ids if i not in _label_names)
+    if missing:
+        for row in session.query(LabelNames).filter(LabelNames.id.in_(missing)):
+            _label_ids[row.name] = row.id
+            _label_names[row.id] = row.name
+    return {i: _label_names[i] for i in ids}
+
+
+def pack_counts(id_to_count):
+    '''Pack a dict of label id --> count into a Snapshots.counts value.'''
+    return json.dumps(sorted(id_to_count.iteritems()), separators=(',', ':'))
+
+
+def unpack_counts(counts):
+    '''Unpack Snapshots.counts into a dict of label id --> count.'''
+    return dict(json.loads(counts))
+
+
+def encode_counts(label_to_count):
+    '''Pack a dict of label name --> count into a Snapshots.counts value.'''
+    ids = label_ids(label_to_count.keys())
+    return pack_counts({ids[label]: count for label, count in label_to_count.iteritems()})
+
+
+def stats_label_counts(stats):
+    '''Returns a dict of label --> count for every series in a RepoStats.'''
+    label_to_count = dict(stats.label_to_count)
+    label_to_count[ALL_ISSUES_LABEL] = stats.open_issues
+    label_to_count[PULL_REQUESTS_LABEL] = stats.open_pulls
+    label_to_count[STARS_LABEL] = stats.stargazers
+    return label_to_count
+
+
+def merge_rollups(session, repo_id, observations):
+    '''Fold a list of (label, time, count) observations into a repo's rollups.'''
+    merge_rollup_batch(session, [(repo_id, label, t, count) for label, t, count in observations])
+
+
+def merge_rollup_batch(session, observations, snapshots=()):
+    '''Fold a list of (repo id, label, time, count) observations into the rollups.
+
+    snapshots lists the (repo id, time) of complete snapshots among them, i.e.
+    every count the repo had at that time. A label which is missing from one
+    has dropped to zero, just as the by_label rows' pivot has it. A snapshot
+    without any labels has no by_label row, though, so it zeroes nothing.
+
+    The existing rollups are read with one query per resolution, however many
+    repos and snapshots there are.
+    '''
+    latest = {}  # (repo id, resolution, label, bucket) --> (time, count)
+    for repo_id, label, t, count in observations:
+        for resolution in RESOLUTIONS:
+            key = (repo_id, resolution, label, bucket_start(t, resolution))
+            if key not in latest or t >= latest[key][0]:
+                latest[key] = (t, count)
+    if not latest:
+        return
+
+    # (repo id, resolution, bucket) --> [(time, labels)] of the complete snapshots in it
+    complete = defaultdict(list)
+    if snapshots:
+        snapshots = set(snapshots)
+        snapshot_labels = defaultdict(set)
+        for repo_id, label, t, _ in observations:
+            if (repo_id, t) in snapshots:
+                snapshot_labels[(repo_id, t)].add(label)
+        for (repo_id, t), labels in snapshot_labels.iteritems():
+            if not labels.issubset(BASE_LABELS):
+                for resolution in RESOLUTIONS:
+                    complete[(repo_id, resolution, bucket_start(t, resolution))].append(
+                            (t, labels))
+
+    def last_count(key, t, count):
+        '''A label's (time, count) at the end of its bucket, given its last observation.'''
+        repo_id, resolution, label, bucket = key
+        if label not in BASE_LABELS:
+            for snapshot_time, labels in complete.get((repo_id, resolution, bucket), ()):
+                if snapshot_time > t and label not in labels:
+                    t, count = snapshot_time, 0
+        return t, count
+
+    repo_ids = set(key[0] for key in latest)
+    labels = set(key[2] for key in latest)
+    updates = []
+    for resolution in RESOLUTIONS:
+        # one query per resolution, so that each can use the rollups index
+        buckets = [key[3] for key in latest if key[1] == resolution]
+        existing = (session.query(Rollups.id, Rollups.repo_id, Rollups.label, Rollups.bucket,
+                                  Rollups.time)
+            .filter(Rollups.repo_id.in_(repo_ids))
+            .filter(Rollups.resolution == resolution)
+            .filter(Rollups.bucket.between(min(buckets), max(buckets))))
+        if not complete:
+            existing = existing.filter(Rollups.label.in_(labels))
+
+        for row_id, repo_id, label, bucket, row_time in existing:
+            key = (repo_id, resolution, label, bucket)
+            if key in latest:
+                t, count = last_count(key, *latest.pop(key))
+            else:
+                t, count = last_count(key, row_time, None)
+                if count is None:
+                    continue  # no snapshot since has dropped the label
+            if t >= row_time:
+                updates.append({'row_id': row_id, 'new_time': t, 'new_count': count})
+
+    # Core statements, rather than ORM objects, since a snapshot touches a row
+    # per label and resolution.
+    if updates:
+        session.execute(Rollups.__table__.update()
+                            .where(Rollups.id == bindparam('row_id'))
+                            .values(time=bindparam('new_time'), count=bindparam('new_count')),
+                        updates)
+    if latest:
+        rows = []
+        for key, (t, count) in latest.iteritems():
+            repo_id, resolution, label, bucket = key
+            t, count = last_count(key, t, count)
+            rows.append({'repo_id': repo_id, 'resolution': resolution, 'label': label,
+                         'bucket': bucket, 'time': t, 'count': count})
+        session.execute(Rollups.__table__.insert(), rows)
+
+
+def rollup_observations(session, repo_id, start=None):
+    '''Returns the (label, time, count) observations a repo's rollups are built from.
+
+    These are its raw counts (from start on, if set), pivoted so that a label
+    without a count in a by_label row has a zero there.
+    '''
+    read_series = snapshot_series if COUNTS_LAYOUT == WIDE_LAYOUT else row_series
+    series, labels, by_label = read_series(session, repo_id, include_labels=True, start=start)
+
+    observations = [(label, t, count)
+                    for label, points in series.iteritems() for t, count in points]
+    for row in by_label:
+        # a label without a count in a row had dropped to zero
+        observations.extend((label, row[0], count) for label, count in zip(labels, row[1:]))
+    return observations
+
+
+def rebuild_rollups(owner, repo_name):
+    '''Recompute a repo's rollups from its raw counts.'''
+    with session_scope() as session:
+        repo = get_repo(session, owner, repo_name)
+        observations = rollup_observations(session, repo.id)
+        session.query(Rollups).filter(Rollups.repo_id == repo.id).delete()
+        merge_rollups(session, repo.id, observations)
+        session.merge(RollupRebuilds(repo_id=repo.id, rebuilt_at=datetime.utcnow()))
+        bump_version(session, repo.id)
+        session.commit()
+    _rollups_complete.invalidate(repo.id)
+    notify_write(owner, repo_name)
+
+
+def add_stats(session, repo_id, now, stats):
+    '''Add the rows recording stats at time now to the session.'''
+    insert_stats(session, [(repo_id, now, stats)])
+
+
+def insert_stats(session, snapshots):
+    '''Insert many (repo id, time, tracker.RepoStats) snapshots with one multi-row insert.'''
+    wide = COUNTS_LAYOUT == WIDE_LAYOUT
+    rows = []
+    observations = []
+    for repo_id, now, stats in snapshots:
+        label_to_count = stats_label_counts(stats)
+        observations.extend((repo_id, label, now, count)
+                            for label, count in label_to_count.iteritems())
+        if wide:
+            rows.append({'repo_id': repo_id, 'time': now,
+                         'counts': encode_counts(label_to_count)})
+        else:
+            rows.extend({'repo_id': repo_id, 'time': now, 'label': label, 'count': count}
+                        for label, count in label_to_count.iteritems())
+    merge_rollup_batch(session, observations,
+                       [(repo_id, now) for repo_id, now, _ in snapshots])
+    if rows:
+        table = Snapshots.__table__ if wide else CountsByLabel.__table__
+        session.execute(table.insert(), rows)
 
 
 def store_result(owner, repo, stats):
     '''stats is a tracker.RepoStats object'''
-    now = datetime.utcnow()
+    store_results([(owner, repo, stats, datetime.utcnow())])
 
-    session = Session()
-    repo = get_repo(session, owner, repo)
-
-    session.add(CountsByLabel(repo_id=repo.id, time=now, label=ALL_ISSUES_LABEL, count=stats.open_issues))
-    session.add(CountsByLabel(repo_id=repo.id, time=now, label=PULL_REQUESTS_LABEL, count=stats.open_pulls))
-    session.add(CountsByLabel(repo_id=repo.id, time=now, label=STARS_LABEL, count=stats.stargazers))
 
-    for label, count in stats.label_to_count.iteritems():
-        session.add(CountsByLabel(repo_id=repo.id,
-                                  time=now,
-                                  label=label,
-                                  count=count))
+def store_results(results):
+    '''Store many observations in a single transaction.
 
-    session.commit()
+    results is a list of (owner, repo, tracker.RepoStats, time) tuples. Their
+    counts are written with a single multi-row insert.
+    '''
+    if not results:
+        return
+    with session_scope() as session:
+        ids = repo_ids(session, set((owner, repo_name) for owner, repo_name, _, _ in results))
+        insert_stats(session, [(ids[(owner, repo_name)], now, stats)
+                               for owner, repo_name, stats, now in results])
+        for repo_id in set(ids.itervalues()):
+            bump_version(session, repo_id)
+        session.commit()
+    for owner, repo_name in ids:
+        notify_write(owner, repo_name)
 
 
-def ordered_labels(label_counts):
-    '''Given time, label, count tuples, return a sorted list of unique labels.'''
-    return list(sorted(set(label for _, label, _ in label_counts)))
+def repo_ids(session, owner_repos):
+    '''Returns a dict of (owner, repo) --> repo id. Raises NoResultFound if any are untracked.'''
+    ids = {}
+    owners = set(owner for owner, _ in owner_repos)
+    names = set(repo for _, repo in owner_repos)
+    for owner, repo, repo_id in (session.query(Repos.owner, Repos.repo, Repos.id)
+                                        .filter(Repos.owner.in_(owners))
+                                        .filter(Repos.repo.in_(names))):
+        if (owner, repo) in owner_repos:
+            ids[(owner, repo)] = repo_id
+    missing = set(owner_repos) - set(ids)
+    if missing:
+        raise NoResultFound('Untracked repos: %s' % ', '.join(
+                '%s/%s' % owner_repo for owner_repo in sorted(missing)))
+    return ids
 
 
 def get_repo(session, owner, repo):
-    return (session.query(Repos).filter(Repos.owner == owner).filter(Repos.repo == repo)).one()
+    '''Returns a tracked repo's RepoRef. Raises NoResultFound if it isn't tracked.'''
+    ref = _repo_refs.get((owner, repo))
+    if ref is None:
+        row = (session.query(Repos.id)
+            .filter(Repos.owner == owner)
+            .filter(Repos.repo == repo)
+            .order_by(Repos.id)).first()
+        if row is None:
+            raise NoResultFound('%s/%s is not tracked' % (owner, repo))
+        ref = RepoRef(id=row.id, owner=owner, repo=repo)
+        _repo_refs.put((owner, repo), ref)
+    return ref
 
 
 def is_repo_tracked(owner, repo):
-    session = Session()
-    count = (session.query(Repos).filter(Repos.owner == owner).filter(Repos.repo == repo)).count()
-    return count > 0
+    with session_scope() as session:
+        try:
+            get_repo(session, owner, repo)
+            return True
+        except NoResultFound:
+            return False
 
 
 def tracked_repos():
-    session = Session()
-    return session.query(Repos)
+    '''Returns a list of every tracked repo's (detached) Repos row.'''
+    with session_scope() as session:
+        return session.query(Repos).all()
+
+
+def pivot(labels, counts):
+    '''Build by_label rows from (time, label, count) tuples in time order.
+
+    Each row is [time] + one count per label, with 0 for labels that had no
+    count at that time.
+    '''
+    return list(iter_pivot(labels, counts))
 
 
-def get_stats_series(owner, repo_name, include_labels=False):
+def iter_pivot(labels, counts):
+    '''Like pivot, but yields each row as soon as it's complete.'''
+    column = {label: i + 1 for i, label in enumerate(labels)}
+    width = len(labels) + 1
+    row = None
+    for t, label, count in counts:
+        if row is None or row[0] != t:
+            if row is not None:
+                yield row
+            row = [t] + [0] * (width - 1)
+        row[column[label]] = count
+    if row is not None:
+        yield row
+
+
+def time_range(column, start, end):
+    '''A clause restricting column to [start, end]. Either end may be None.'''
+    clause = and_()
+    if start:
+        clause = and_(clause, column >= start)
+    if end:
+        clause = and_(clause, column <= end)
+    return clause
+
+
+def table_series(session, label_column, time_column, count_column, where, include_labels):
+    '''Returns (dict of base label --> series, labels, by_label rows) from a table
+    with one row per (label, time), such as counts_by_label or rollups.'''
+    series = {label: [] for label in BASE_LABELS}
+    base_counts = (session.query(label_column, time_column, count_column)
+        .filter(where)
+        .filter(label_column.in_(BASE_LABELS))
+        .order_by(label_column, time_column))
+    for label, t, count in base_counts:
+        series[label].append((t, count))
+
+    if not include_labels:
+        return series, [], []
+
+    is_label = and_(where, ~label_column.in_(BASE_LABELS))
+    labels = [label for label, in (session.query(label_column)
+        .filter(is_label)
+        .distinct()
+        .order_by(label_column))]
+    counts = (session.query(time_column, label_column, count_column)
+        .filter(is_label)
+        .order_by(time_column))
+    return series, labels, pivot(labels, counts)
+
+
+def row_series(session, repo_id, include_labels, start=None, end=None):
+    '''Returns (dict of base label --> series, labels, by_label rows) from the rows layout.'''
+    return table_series(session, CountsByLabel.label, CountsByLabel.time, CountsByLabel.count,
+                        and_(CountsByLabel.repo_id == repo_id,
+                             time_range(CountsByLabel.time, start, end)),
+                        include_labels)
+
+
+def rollup_series(session, repo_id, include_labels, resolution, start=None, end=None):
+    '''Returns (dict of base label --> series, labels, by_label rows) from the rollups.
+
+    Each point is timestamped with the start of its bucket.
+    '''
+    if start:
+        start = bucket_start(start, resolution)
+    return table_series(session, Rollups.label, Rollups.bucket, Rollups.count,
+                        and_(Rollups.repo_id == repo_id,
+                             Rollups.resolution == resolution,
+                             time_range(Rollups.bucket, start, end)),
+                        include_labels)
+
+
+def rollups_complete(session, repo_id):
+    '''Whether a repo's rollups cover all its history; see RollupRebuilds.'''
+    complete = _rollups_complete.get(repo_id)
+    if complete is None:
+        complete = session.query(RollupRebuilds.repo_id).filter(
+                RollupRebuilds.repo_id == repo_id).first() is not None
+        _rollups_complete.put(repo_id, complete)
+    return complete
+
+
+def choose_resolution(owner, repo_name, max_points, start=None, end=None):
+    '''Returns the coarsest resolution with at least max_points buckets in range.
+
+    Returns None if even daily rollups would have too few points (or the repo's
+    rollups aren't complete), in which case raw counts should be used.
+    '''
+    with session_scope() as session:
+        repo = get_repo(session, owner, repo_name)
+        if not rollups_complete(session, repo.id):
+            return None
+        num_buckets = dict(session.query(Rollups.resolution, func.count(Rollups.id))
+            .filter(Rollups.repo_id == repo.id)
+            .filter(Rollups.label == ALL_ISSUES_LABEL)
+            .filter(time_range(Rollups.bucket, start, end))
+            .group_by(Rollups.resolution))
+    for resolution in reversed(RESOLUTIONS):
+        if num_buckets.get(resolution, 0) >= max_points:
+            return resolution
+    return None
+
+
+def snapshot_series(session, repo_id, include_labels, start=None, end=None):
+    '''Returns (dict of base label --> series, labels, by_label rows) from the wide layout.'''
+    snapshots = [(t, unpack_counts(counts)) for t, counts in
+                 (session.query(Snapshots.time, Snapshots.counts)
+                    .filter(Snapshots.repo_id == repo_id)
+                    .filter(time_range(Snapshots.time, start, end))
+                    .order_by(Snapshots.time))]
+    names = label_names(session, set(i for _, counts in snapshots for i in counts))
+    ids = {name: label_id for label_id, name in names.iteritems()}
+
+    series = {}
+    for label in BASE_LABELS:
+        label_id = ids.get(label)
+        series[label] = [(t, counts[label_id]) for t, counts in snapshots if label_id in counts]
+
+    if not include_labels:
+        return series, [], []
+
+    labels = sorted(name for name in ids if name not in BASE_LABELS)
+    return series, labels, list(snapshot_rows(snapshots, [ids[label] for label in labels]))
+
+
+def snapshot_rows(snapshots, columns):
+    '''Yields by_label rows from (time, dict of label id --> count) snapshots.'''
+    for t, counts in snapshots:
+        if any(label_id in counts for label_id in columns):
+            yield [t] + [counts.get(label_id, 0) for label_id in columns]
+
+
+def get_stats_series(owner, repo_name, include_labels=False, start=None, end=None,
+                     resolution=None):
+    '''Returns the stargazers, open_issues, open_pulls and by_label series.
+
+    If start or end is set, only points in [start, end] are returned. If
+    resolution is set, only the last point in each day, week or month is
+    returned, timestamped with the start of that period.
+    '''
+    with session_scope() as session:
+        repo = get_repo(session, owner, repo_name)
+
+        use_rollups = resolution and rollups_complete(session, repo.id)
+        if use_rollups:
+            series, labels, by_label = rollup_series(session, repo.id, include_labels,
+                                                     resolution, start, end)
+        elif COUNTS_LAYOUT == WIDE_LAYOUT:
+            series, labels, by_label = snapshot_series(session, repo.id, include_labels,
+                                                       start, end)
+        else:
+            series, labels, by_label = row_series(session, repo.id, include_labels, start, end)
+
+    if resolution and not use_rollups:
+        series = {label: resample(points, resolution) for label, points in series.iteritems()}
+        by_label = resample(by_label, resolution)
+
+    by_label = [label_header(labels)] + by_label
+
+    return series[STARS_LABEL], series[ALL_ISSUES_LABEL], series[PULL_REQUESTS_LABEL], by_label
+
+
+def label_header(labels):
+    '''The first row of a by_label matrix.'''
+    return ['Date'] + ['(unlabeled)' if label == '' else label for label in labels]
+
+
+def stream(query):
+    '''Iterate over a query's rows using a server-side cursor, where the driver has them.'''
+    return query.execution_options(stream_results=True).yield_per(1000)
+
+
+def stream_stats_series(owner, repo_name, include_labels=False, start=None, end=None,
+                        resolution=None):
+    '''Like get_stats_series, but the series are iterators over DB cursors.
+
+    Only one row per series (or a snapshot, in the wide layout) is held in
+    memory at a time, however long the history. Consume the series in order:
+    stargazers, open_issues, open_pulls, by_label. by_label's first item is
+    the header row.
+
+    The series read from the thread's Session, which is left open for them.
+    Whoever consumes them removes it afterwards: app.py streams them with
+    stream_with_context, so the request's teardown does.
+    '''
     session = Session()
     repo = get_repo(session, owner, repo_name)
 
-    if include_labels:
-        clause = or_()
+    use_rollups = resolution and rollups_complete(session, repo.id)
+    if use_rollups:
+        if start:
+            start = bucket_start(start, resolution)
+        series, labels, by_label = stream_table_series(
+                session, Rollups.label, Rollups.bucket, Rollups.count,
+                and_(Rollups.repo_id == repo.id,
+                     Rollups.resolution == resolution,
+                     time_range(Rollups.bucket, start, end)),
+                include_labels)
+    elif COUNTS_LAYOUT == WIDE_LAYOUT:
+        series, labels, by_label = stream_snapshot_series(session, repo.id, include_labels,
+                                                          start, end)
     else:
-        clause = or_(CountsByLabel.label == ALL_ISSUES_LABEL,
-                     CountsByLabel.label == PULL_REQUESTS_LABEL,
-                     CountsByLabel.label == STARS_LABEL)
-
-
-    counts = (session.query(CountsByLabel)
-        .filter(CountsByLabel.repo_id == repo.id)
-        .filter(clause)
-        .order_by(CountsByLabel.label, CountsByLabel.time))
-
-    open_issues = []
-    stargazers = []
-    open_pulls = []
-    label_counts = []
-
-    for row in counts:
-        label = row.label
-        pair = (row.time, row.count)
-        if label == ALL_ISSUES_LABEL:
-            open_issues.append(pair)
-        elif label == PULL_REQUESTS_LABEL:
-            open_pulls.append(pair)
-        elif label == STARS_LABEL:
-            stargazers.append(pair)
-        else:
-            label_counts.append((row.time, label, row.count))
+        series, labels, by_label = stream_table_series(
+                session, CountsByLabel.label, CountsByLabel.time, CountsByLabel.count,
+                and_(CountsByLabel.repo_id == repo.id,
+                     time_range(CountsByLabel.time, start, end)),
+                include_labels)
 
-    # Group by label
-    date_to_label_to_count = defaultdict(dict)
-    for time, label, count in label_counts:
-        date_to_label_to_count[time][label] = count
+    if resolution and not use_rollups:
+        series = {label: iter_resample(points, resolution) for label, points in series.iteritems()}
+        by_label = iter_resample(by_label, resolution)
 
-    labels = ordered_labels(label_counts)
+    by_label = itertools.chain([label_header(labels)], by_label)
+    return series[STARS_LABEL], series[ALL_ISSUES_LABEL], series[PULL_REQUESTS_LABEL], by_label
 
-    by_label = []
-    for date in sorted(date_to_label_to_count.keys()):
-        label_to_count = date_to_label_to_count[date]
-        row = [date] + [label_to_count.get(label, 0) for label in labels]
-        by_label.append(row)
 
-    try:
-        blank_idx = labels.index('')
-        labels[blank_idx] = '(unlabeled)'
-    except ValueError:
-        pass
-    by_label = [['Date'] + labels] + by_label
+def stream_table_series(session, label_column, time_column, count_column, where, include_labels):
+    '''The streaming counterpart of table_series.'''
+    def points(label):
+        for row in stream(session.query(time_column, count_column)
+                .filter(where)
+                .filter(label_column == label)
+                .order_by(time_column)):
+            yield tuple(row)
+
+    series = {label: points(label) for label in BASE_LABELS}
+    if not include_labels:
+        return series, [], iter([])
+
+    is_label = and_(where, ~label_column.in_(BASE_LABELS))
+    labels = [label for label, in (session.query(label_column)
+        .filter(is_label)
+        .distinct()
+        .order_by(label_column))]
+    counts = stream(session.query(time_column, label_column, count_column)
+        .filter(is_label)
+        .order_by(time_column))
+    return series, labels, iter_pivot(labels, counts)
+
+
+def stream_snapshot_series(session, repo_id, include_labels, start=None, end=None):
+    '''The streaming counterpart of snapshot_series.
+
+    This reads the snapshots once per series (and once more to find the
+    labels), trading repeated reads for constant memory.
+    '''
+    def snapshots():
+        for t, counts in stream(session.query(Snapshots.time, Snapshots.counts)
+                .filter(Snapshots.repo_id == repo_id)
+                .filter(time_range(Snapshots.time, start, end))
+                .order_by(Snapshots.time)):
+            yield t, unpack_counts(counts)
+
+    base_ids = {row.name: row.id for row in
+                session.query(LabelNames).filter(LabelNames.name.in_(BASE_LABELS))}
+
+    def points(label_id):
+        for t, counts in snapshots():
+            if label_id in counts:
+                yield t, counts[label_id]
+
+    series = {label: points(base_ids.get(label)) for label in BASE_LABELS}
+    if not include_labels:
+        return series, [], iter([])
+
+    ids = set()
+    for _, counts in snapshots():
+        ids.update(counts)
+    names = label_names(session, ids)
+    labels = sorted(name for name in names.itervalues() if name not in BASE_LABELS)
+    label_to_id = {name: label_id for label_id, name in names.iteritems()}
+    columns = [label_to_id[label] for label in labels]
+    return series, labels, snapshot_rows(snapshots(), columns)
 
-    return stargazers, open_issues, open_pulls, by_label
+
+class SnapshotEditor(object):
+    '''Applies per-label backfill edits to a repo's wide-layout snapshots.
+
+    Snapshots are loaded as the edits reach them: those in the range of a
+    delete, and those at the times of a fill's points. So a request which
+    fills one label reads as many snapshots as it has points, not the repo's
+    whole history. They're edited in memory and written back by save().
+    '''
+
+    # Times per query when loading the snapshots at a fill's points.
+    LOAD_CHUNK_SIZE = 500
+
+    def __init__(self, session, repo_id):
+        self.session = session
+        self.repo_id = repo_id
+        self.by_time = {}  # time --> (Snapshots row, dict of label id --> count)
+        self.ranges = []  # [start, end] ranges which have been loaded; None is unbounded
+        self.absent = set()  # times which have been looked up, and have no snapshot
+        self.dirty = set()
+
+    def is_loaded(self, t):
+        return t in self.by_time or t in self.absent or any(
+                (start is None or start <= t) and (end is None or t <= end)
+                for start, end in self.ranges)
+
+    def add_rows(self, rows):
+        for row in rows:
+            if row.time not in self.by_time:  # a loaded snapshot may have been edited
+                self.by_time[row.time] = (row, unpack_counts(row.counts))
+
+    def load_range(self, start=None, end=None):
+        '''Load the snapshots in [start, end], where either may be None.'''
+        if any((s is None or (start is not None and s <= start)) and
+               (e is None or (end is not None and end <= e)) for s, e in self.ranges):
+            return
+        self.add_rows(self.session.query(Snapshots)
+                .filter(Snapshots.repo_id == self.repo_id)
+                .filter(time_range(Snapshots.time, start, end)))
+        self.ranges.append((start, end))
+
+    def load_times(self, times):
+        '''Load the snapshots at a list of times.'''
+        wanted = sorted(set(t for t in times if not self.is_loaded(t)))
+        for i in xrange(0, len(wanted), self.LOAD_CHUNK_SIZE):
+            chunk = wanted[i:i + self.LOAD_CHUNK_SIZE]
+            self.add_rows(self.session.query(Snapshots)
+                    .filter(Snapshots.repo_id == self.repo_id)
+                    .filter(Snapshots.time.in_(chunk)))
+            self.absent.update(t for t in chunk if t not in self.by_time)
+
+    def delete(self, should_delete, start=None, end=None):
+        '''Drop every label for which should_delete(label name) is true.
+
+        If start and end are set, only counts at times in [start, end) are dropped.
+        '''
+        self.load_range(start, end)
+        snapshots = [(t, counts) for t, (_, counts) in self.by_time.iteritems()
+                     if not start or start <= t < end]
+        # look each label up once, rather than once per snapshot
+        names = label_names(self.session, set(itertools.chain.from_iterable(
+                counts for _, counts in snapshots)))
+        doomed = set(label_id for label_id, name in names.iteritems() if should_delete(name))
+        if not doomed:
+            return
+        for t, counts in snapshots:
+            dropped = False
+            for label_id in doomed.intersection(counts):
+                del counts[label_id]
+                dropped = True
+            if dropped:
+                self.dirty.add(t)
+
+    def fill(self, label, points):
+        '''Set a label's count at each of a list of (time, count) pairs.'''
+        label_id = label_ids([label])[label]
+        self.load_times([t for t, _ in points])
+        for t, count in points:
+            if t not in self.by_time:
+                row = Snapshots(repo_id=self.repo_id, time=t)
+                self.session.add(row)
+                self.by_time[t] = (row, {})
+                self.absent.discard(t)
+            self.by_time[t][1][label_id] = int(count)
+            self.dirty.add(t)
+
+    def save(self):
+        for t in self.dirty:
+            row, counts = self.by_time[t]
+            if counts:
+                row.counts = pack_counts(counts)
+            elif row.id is not None:
+                self.session.delete(row)
+            else:
+                self.session.expunge(row)
+
+
+# backfill keys for the base series, and the labels they're stored under.
+BACKFILL_SERIES = (
+    ('open_issues', ALL_ISSUES_LABEL),
+    ('stargazers', STARS_LABEL),
+    ('open_pulls', PULL_REQUESTS_LABEL),
+)
+
+# Rows per INSERT statement when bulk loading without COPY.
+BULK_CHUNK_SIZE = 10000
 
 
 def store_backfill(owner, repo, backfill_data):
@@ -167,75 +1075,567 @@ def store_backfill(owner, repo, backfill_data):
     request are atomic, but can be chunked into multiple requests to keep the
     backfill from taking too long.
     '''
-    session = Session()
+    deletes = [backfill_data['delete']] if 'delete' in backfill_data else []
+    series = backfill_series(backfill_data,
+                             lambda data: [(dates.parse_datetime(d), int(c)) for d, c in data])
+    write_backfill(owner, repo, deletes, series)
 
-    repo = get_repo(session, owner, repo)
 
-    def delete_for_label(label):
-        session.query(CountsByLabel).filter(CountsByLabel.repo_id == repo.id).filter(CountsByLabel.label == label).delete()
+def store_bulk_backfill(owner, repo, payload):
+    '''Store a whole backfill in one transaction. Returns the number of rows written.
+
+    payload has the same keys as store_backfill's backfill_data, except that
+    'delete' is a list, and each series is a column: either
+    {'start': 'YYYY-MM-DD', 'counts': [...]} for one count per day, or
+    {'dates': [...], 'counts': [...]}. Every delete happens before any series
+    is written.
+    '''
+    series = backfill_series(payload, expand_column)
+    write_backfill(owner, repo, payload.get('delete', []), series, bulk=True)
+    return sum(len(points) for _, points in series)
+
+
+def expand_column(column):
+    '''Returns a list of (time, count) pairs from a columnar series.'''
+    counts = [int(count) for count in column['counts']]
+    if 'start' in column:
+        start = dates.day_ordinal(column['start'])
+        times = [datetime.fromordinal(start + i) for i in xrange(len(counts))]
+    else:
+        times = [dates.parse_datetime(d) for d in column['dates']]
+    return zip(times, counts)
+
+
+def backfill_series(backfill_data, parse):
+    '''Returns a list of (label, list of (time, count)) from backfill data.'''
+    series = [(label, parse(backfill_data[key]))
+              for key, label in BACKFILL_SERIES if key in backfill_data]
+    for label, data in backfill_data.get('by_label', {}).iteritems():
+        series.append((label, parse(data)))
+    return series
+
+
+def copy_counts(session, repo_id, series):
+    '''Load rows into counts_by_label with Postgres's COPY, inside the session's transaction.'''
+    buf = StringIO()
+    writer = csv.writer(buf, quoting=csv.QUOTE_NONNUMERIC)  # so '' isn't read as NULL
+    for label, points in series:
+        label = label.encode('utf8')
+        for t, count in points:
+            writer.writerow((repo_id, label, t.isoformat(), count))
+    buf.seek(0)
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert('COPY counts_by_label (repo_id, label, time, count) '
+                       'FROM STDIN WITH CSV', buf)
+
+
+def insert_counts(session, repo_id, series, chunk_size=BULK_CHUNK_SIZE):
+    '''Load rows into counts_by_label with one executemany per chunk_size rows.'''
+    insert = CountsByLabel.__table__.insert()
+    chunk = []
+    for label, points in series:
+        for t, count in points:
+            chunk.append({'repo_id': repo_id, 'label': label, 'time': t, 'count': count})
+            if len(chunk) >= chunk_size:
+                session.execute(insert, chunk)
+                chunk = []
+    if chunk:
+        session.execute(insert, chunk)
+
+
+def write_backfill(owner, repo, deletes, series, bulk=False):
+    '''Apply a list of deletes (see store_backfill), then write a list of
+    (label, list of (time, count)) series, in one transaction.'''
+    with session_scope() as session:
+        repo = get_repo(session, owner, repo)
+
+        editor = None
+        if COUNTS_LAYOUT == WIDE_LAYOUT:
+            editor = SnapshotEditor(session, repo.id)
+        rollups = session.query(Rollups).filter(Rollups.repo_id == repo.id)
+
+        def delete_for_label(label):
+            if editor:
+                editor.delete(lambda name: name == label)
+            else:
+                session.query(CountsByLabel).filter(CountsByLabel.repo_id == repo.id).filter(CountsByLabel.label == label).delete()
+            rollups.filter(Rollups.label == label).delete(synchronize_session=False)
+
+        def delete_by_label():
+            if editor:
+                editor.delete(lambda name: name not in BASE_LABELS)
+            else:
+                (session.query(CountsByLabel)
+                        .filter(CountsByLabel.repo_id == repo.id)
+                        .filter(CountsByLabel.label != ALL_ISSUES_LABEL,
+                                CountsByLabel.label != STARS_LABEL,
+                                CountsByLabel.label != PULL_REQUESTS_LABEL)
+                        .delete())
+            rollups.filter(~Rollups.label.in_(BASE_LABELS)).delete(synchronize_session=False)
+
+        for t in deletes:
+            if t == 'by_label':
+                delete_by_label()
+            else:
+                for key, label in BACKFILL_SERIES:
+                    if t == key:
+                        delete_for_label(label)
 
-    def fill_for_label(label, data):
         start_secs = time.time()
-        session.execute(CountsByLabel.__table__.insert(), [
-            {
-                'repo_id': repo.id,
-                'label': label,
-                'time': dateutil.parser.parse(row[0]),
-                'count': int(row[1])
-            } for row in data])
-        stop_secs = time.time()
-        print 'Inserted %d rows in %f secs' % (len(data), stop_secs - start_secs)
-
-    if 'delete' in backfill_data:
-        t = backfill_data['delete']
-        if t == 'open_issues':
-            delete_for_label(ALL_ISSUES_LABEL)
-        elif t == 'stargazers':
-            delete_for_label(STARS_LABEL)
-        elif t == 'open_pulls':
-            delete_for_label(PULL_REQUESTS_LABEL)
-        elif t == 'by_label':
-            (session.query(CountsByLabel)
+        if editor:
+            for label, points in series:
+                editor.fill(label, points)
+        elif bulk and engine.dialect.name == 'postgresql':
+            copy_counts(session, repo.id, series)
+        elif bulk:
+            insert_counts(session, repo.id, series)
+        else:
+            for label, points in series:
+                insert_counts(session, repo.id, [(label, points)])
+                print 'Inserted %d rows in %f secs' % (len(points), time.time() - start_secs)
+                start_secs = time.time()
+        merge_rollups(session, repo.id,
+                      [(label, t, count) for label, points in series for t, count in points])
+        if bulk:
+            num_rows = sum(len(points) for _, points in series)
+            secs = time.time() - start_secs
+            print 'Bulk inserted %d rows in %f secs (%.0f rows/sec)' % (
+                    num_rows, secs, num_rows / max(secs, 1e-6))
+
+        if editor:
+            editor.save()
+        bump_version(session, repo.id)
+        session.commit()
+    notify_write(owner, repo.repo)
+
+
+def label_points(session, repo_id, labels=None, since=None):
+    '''Returns a dict of label --> list of (time, count) in time order.
+
+    Unlike the by_label rows, a label only has points at the times it was
+    recorded. labels and since restrict which labels and times are read.
+    '''
+    points = defaultdict(list)
+    if COUNTS_LAYOUT == WIDE_LAYOUT:
+        snapshots = (session.query(Snapshots.time, Snapshots.counts)
+            .filter(Snapshots.repo_id == repo_id)
+            .filter(time_range(Snapshots.time, since, None))
+            .order_by(Snapshots.time))
+        for t, counts in snapshots:
+            counts = unpack_counts(counts)
+            names = label_names(session, counts.keys())
+            for label_id, count in counts.iteritems():
+                if labels is None or names[label_id] in labels:
+                    points[names[label_id]].append((t, count))
+        return points
+
+    rows = (session.query(CountsByLabel.label, CountsByLabel.time, CountsByLabel.count)
+        .filter(CountsByLabel.repo_id == repo_id)
+        .filter(time_range(CountsByLabel.time, since, None)))
+    if labels is not None:
+        rows = rows.filter(CountsByLabel.label.in_(labels))
+    for label, t, count in rows.order_by(CountsByLabel.label, CountsByLabel.time):
+        points[label].append((t, count))
+    return points
+
+
+def refresh_rollups(session, repo_id, since):
+    '''Recompute rollups after counts changed, given a dict of label --> the
+    earliest time at which its counts changed.
+
+    Whether a label dropped to zero depends on the snapshots around it, not
+    just its own points, so every label's buckets from the earliest change on
+    are rebuilt, the way rebuild_rollups builds them.
+    '''
+    if not since:
+        return
+    t = min(since.itervalues())
+    for resolution in RESOLUTIONS:
+        (session.query(Rollups)
+            .filter(Rollups.repo_id == repo_id)
+            .filter(Rollups.resolution == resolution)
+            .filter(Rollups.bucket >= bucket_start(t, resolution))
+            .delete(synchronize_session=False))
+    earliest = min(bucket_start(t, resolution) for resolution in RESOLUTIONS)
+    merge_rollups(session, repo_id, rollup_observations(session, repo_id, start=earliest))
+
+
+def backfill_end(through):
+    '''The end (exclusive) of what a backfill through a day (YYYY-MM-DD) covers.
+
+    A backfill has one point per day, at midnight, so the counts polled later
+    on its last day (typically today) are newer than it, and aren't its to replace.
+    '''
+    return datetime.fromordinal(dates.day_ordinal(through)) + timedelta(microseconds=1)
+
+
+def backfill_digest(owner, repo_name, through=None):
+    '''Returns checksums of a repo's series (see digest.py), keyed like store_backfill's data.
+
+    Each series maps block start days to checksums of its last count on each day.
+    If through (YYYY-MM-DD) is set, only the points a backfill through that
+    day covers are included (see backfill_end).
+    '''
+    with session_scope() as session:
+        repo = get_repo(session, owner, repo_name)
+        series = label_points(session, repo.id)
+    end = backfill_end(through) if through else None
+    keys = {label: key for key, label in BACKFILL_SERIES}
+    out = {'by_label': {}}
+    for label, points in series.iteritems():
+        if end:
+            points = [(t, count) for t, count in points if t < end]
+            if not points:
+                continue
+        checksums = digest.block_checksums(digest.last_per_day(points))
+        if label in keys:
+            out[keys[label]] = checksums
+        else:
+            out['by_label'][label] = checksums
+    return out
+
+
+def store_backfill_delta(owner, repo_name, payload):
+    '''Replace parts of a repo's series. Returns the number of rows written.
+
+    payload['ranges'] lists the parts to replace. Each range has a 'series'
+    (one of store_backfill's keys; 'by_label' ranges also have a 'label'),
+    'from' and 'to' days (YYYY-MM-DD, inclusive) and the series' points in
+    that range as a column (see store_bulk_backfill), whose counts may be
+    empty. Whatever the series had in the range is replaced by the points.
+
+    payload['through'], if set, is the last day (YYYY-MM-DD) the backfill
+    covers. Digest blocks run past it, but the ranges are clipped to it (see
+    backfill_end), so counts polled after the backfill are kept.
+
+    Raises KeyError or ValueError, without writing anything, if a range is
+    malformed.
+    '''
+    series_labels = dict(BACKFILL_SERIES)
+    through_end = backfill_end(payload['through']) if payload.get('through') else None
+    edits = []
+    for r in payload['ranges']:
+        label = r['label'] if r['series'] == 'by_label' else series_labels[r['series']]
+        start = datetime.fromordinal(dates.day_ordinal(r['from']))
+        end = datetime.fromordinal(dates.day_ordinal(r['to']) + 1)
+        if through_end:
+            end = min(end, through_end)
+        points = expand_column(r) if r['counts'] else []
+        if not all(start <= t < end for t, _ in points):
+            raise ValueError('%s has points outside %s..%s' % (label, r['from'], r['to']))
+        if start < end:
+            edits.append((label, start, end, points))
+
+    with session_scope() as session:
+        repo = get_repo(session, owner, repo_name)
+        editor = None
+        if COUNTS_LAYOUT == WIDE_LAYOUT:
+            editor = SnapshotEditor(session, repo.id)
+
+        since = {}
+        for label, start, end, points in edits:
+            if editor:
+                editor.delete(lambda name: name == label, start, end)
+                editor.fill(label, points)
+            else:
+                (session.query(CountsByLabel)
                     .filter(CountsByLabel.repo_id == repo.id)
-                    .filter(CountsByLabel.label != ALL_ISSUES_LABEL,
-                            CountsByLabel.label != STARS_LABEL,
-                            CountsByLabel.label != PULL_REQUESTS_LABEL)
-                    .delete())
+                    .filter(CountsByLabel.label == label)
+                    .filter(CountsByLabel.time >= start, CountsByLabel.time < end)
+                    .delete(synchronize_session=False))
+                insert_counts(session, repo.id, [(label, points)])
+            since[label] = min(start, since.get(label, start))
+        if editor:
+            editor.save()
+
+        refresh_rollups(session, repo.id, since)
+        bump_version(session, repo.id)
+        session.commit()
+    notify_write(owner, repo.repo)
+    return sum(len(points) for _, _, _, points in edits)
+
+
+def get_fetch_mode(owner, repo):
+    '''Returns the repo's fetch mode, or None to use the default.'''
+    with session_scope() as session:
+        repo = get_repo(session, owner, repo)
+        return (session.query(RepoSettings.fetch_mode)
+                .filter(RepoSettings.repo_id == repo.id).scalar())
 
-    if 'open_issues' in backfill_data:
-        fill_for_label(ALL_ISSUES_LABEL, backfill_data['open_issues'])
 
-    if 'stargazers' in backfill_data:
-        fill_for_label(STARS_LABEL, backfill_data['stargazers'])
+def fetch_modes():
+    '''Returns a dict mapping (owner, repo) --> fetch mode for repos which set one.'''
+    with session_scope() as session:
+        rows = (session.query(Repos.owner, Repos.repo, RepoSettings.fetch_mode)
+                       .join(RepoSettings, RepoSettings.repo_id == Repos.id))
+        return {(owner, repo): mode for owner, repo, mode in rows if mode}
 
-    if 'open_pulls' in backfill_data:
-        fill_for_label(PULL_REQUESTS_LABEL, backfill_data['open_pulls'])
 
-    if 'by_label' in backfill_data:
-        for label, data in backfill_data['by_label'].iteritems():
-            fill_for_label(label, data)
+def set_fetch_mode(owner, repo, mode):
+    with session_scope() as session:
+        repo = get_repo(session, owner, repo)
+        session.merge(RepoSettings(repo_id=repo.id, fetch_mode=mode))
+        session.commit()
 
-    session.commit()
+
+def get_issue_states(owner, repo):
+    '''Returns (states, synced_at, reconciled_at) for incremental fetching.
+
+    states maps issue number --> (is_open, is_pull, labels) for every open
+    issue. The times are None if the repo has never been synced.
+    '''
+    with session_scope() as session:
+        repo = get_repo(session, owner, repo)
+        states = {row.number: (True, row.is_pull, tuple(json.loads(row.labels)))
+                  for row in session.query(OpenIssues).filter(OpenIssues.repo_id == repo.id)}
+        sync = session.query(IssueSyncs).get(repo.id)
+    if not sync:
+        return states, None, None
+    return states, sync.synced_at, sync.reconciled_at
+
+
+def store_issue_states(owner, repo, changes, synced_at, reconciled=False, live_stats=None):
+    '''Record the issues fetched by an incremental poll.
+
+    changes maps issue number --> (is_open, is_pull, labels). If reconciled is
+    set, changes is the complete set of open issues and replaces what's stored.
+    For a repo in webhook mode, live_stats is the tracker.RepoStats they add up
+    to, which replaces its live counts.
+
+    The webhook deliveries received since synced_at may be newer than what
+    the poll saw, so they're applied again on top of it (see apply_update).
+    Returns the live counts which result, or None if live_stats isn't given.
+
+    Called from update.py's worker threads, each of which has a session of its own.
+    '''
+    with session_scope() as session:
+        repo_id = get_repo(session, owner, repo).id
+    with issue_state_lock(repo_id), session_scope() as session:
+        sync = lock_issue_sync(session, repo_id) or IssueSyncs(repo_id=repo_id)
+        rows = session.query(OpenIssues).filter(OpenIssues.repo_id == repo_id)
+        if reconciled:
+            rows.delete()
+        elif changes:
+            (rows.filter(OpenIssues.number.in_(changes.keys()))
+                 .delete(synchronize_session=False))
+
+        for number, (is_open, is_pull, labels) in changes.iteritems():
+            if is_open:
+                session.add(OpenIssues(repo_id=repo_id, number=number, is_pull=is_pull,
+                                       labels=json.dumps(list(labels))))
+
+        sync.synced_at = synced_at
+        if reconciled:
+            sync.reconciled_at = synced_at
+        session.add(sync)
+
+        if live_stats is not None:
+            session.query(LiveCounts).filter(LiveCounts.repo_id == repo_id).delete()
+            for label, count in stats_label_counts(live_stats).iteritems():
+                session.add(LiveCounts(repo_id=repo_id, label=label, count=count))
+        session.flush()
+
+        for changes, in (session.query(WebhookDeliveries.changes)
+                .filter(WebhookDeliveries.repo_id == repo_id)
+                .filter(WebhookDeliveries.received_at >= synced_at)
+                .filter(WebhookDeliveries.changes != None)
+                .order_by(WebhookDeliveries.received_at)).all():
+            apply_update(session, repo_id, webhooks.decode_update(changes))
+        stats = load_live_stats(session, repo_id) if live_stats is not None else None
+        session.commit()
+    return stats
+
+
+def load_live_stats(session, repo_id):
+    '''Returns a webhook repo's live counts as a tracker.RepoStats, or None if it has none.'''
+    counts = dict(session.query(LiveCounts.label, LiveCounts.count)
+                         .filter(LiveCounts.repo_id == repo_id))
+    if not counts:
+        return None
+    return tracker.RepoStats(stargazers=counts.pop(STARS_LABEL, 0),
+                             open_issues=counts.pop(ALL_ISSUES_LABEL, 0),
+                             open_pulls=counts.pop(PULL_REQUESTS_LABEL, 0),
+                             label_to_count={label: count
+                                             for label, count in counts.iteritems() if count})
+
+
+def get_live_stats(owner, repo):
+    '''Returns (tracker.RepoStats, reconciled_at) for a webhook repo, or (None, None).'''
+    with session_scope() as session:
+        repo = get_repo(session, owner, repo)
+        stats = load_live_stats(session, repo.id)
+        sync = session.query(IssueSyncs).get(repo.id)
+    if stats is None or not sync:
+        return None, None
+    return stats, sync.reconciled_at
+
+
+# Deliveries and reconciles which change a repo's issue states take this lock
+# (within a process) and a row lock on its issue_syncs row (across processes),
+# so that each reads the states the last one stored.
+_issue_state_locks = {}  # repo id --> threading.Lock
+_issue_state_locks_lock = threading.Lock()
+
+
+def issue_state_lock(repo_id):
+    with _issue_state_locks_lock:
+        return _issue_state_locks.setdefault(repo_id, threading.Lock())
+
+
+def lock_issue_sync(session, repo_id):
+    '''Returns a repo's IssueSyncs row, locked until the session's transaction ends, or None.'''
+    return (session.query(IssueSyncs)
+        .filter(IssueSyncs.repo_id == repo_id)
+        .with_for_update()).first()
+
+
+def stored_issue_state(row):
+    return tracker.IssueState(True, row.is_pull, tuple(json.loads(row.labels)))
+
+
+def update_issue_state(session, repo_id, number, row, old, new, deltas):
+    '''Replace an issue's stored state, adding the change to its counts to deltas.'''
+    for state, sign in ((old, -1), (new, +1)):
+        if state and state.is_open:
+            tracker.add_issue_counts(deltas, state, sign)
+            deltas[ALL_ISSUES_LABEL] += sign
+            if state.is_pull:
+                deltas[PULL_REQUESTS_LABEL] += sign
+    if not new.is_open:
+        if row:
+            session.delete(row)
+    elif row:
+        row.is_pull = new.is_pull
+        row.labels = json.dumps(list(new.labels))
+    else:
+        session.add(OpenIssues(repo_id=repo_id, number=number, is_pull=new.is_pull,
+                               labels=json.dumps(list(new.labels))))
+
+
+def rename_label(session, repo_id, old_name, new_name, deltas):
+    '''Rename (or if new_name is None, remove) a label on every open issue.'''
+    rows = (session.query(OpenIssues)
+        .filter(OpenIssues.repo_id == repo_id)
+        .filter(OpenIssues.labels.like('%' + json.dumps(old_name) + '%')))
+    for row in rows.all():
+        old = stored_issue_state(row)
+        if old_name not in old.labels:
+            continue
+        labels = set(old.labels) - {old_name}
+        if new_name is not None:
+            labels.add(new_name)
+        new = old._replace(labels=tuple(sorted(labels)))
+        update_issue_state(session, repo_id, row.number, row, old, new, deltas)
+
+
+def apply_update(session, repo_id, update):
+    '''Apply a webhooks.WebhookUpdate to a repo's issue states and live counts.'''
+    deltas = defaultdict(int)
+    for old_name, new_name in update.renames.iteritems():
+        rename_label(session, repo_id, old_name, new_name, deltas)
+    if update.changes:
+        rows = {row.number: row for row in (session.query(OpenIssues)
+                    .filter(OpenIssues.repo_id == repo_id)
+                    .filter(OpenIssues.number.in_(update.changes.keys())))}
+        for number, state in update.changes.iteritems():
+            row = rows.get(number)
+            update_issue_state(session, repo_id, number, row,
+                               stored_issue_state(row) if row else None, state, deltas)
+
+    counts = session.query(LiveCounts).filter(LiveCounts.repo_id == repo_id)
+    for label, delta in deltas.iteritems():
+        if delta and not counts.filter(LiveCounts.label == label).update(
+                {LiveCounts.count: LiveCounts.count + delta}, synchronize_session=False):
+            session.add(LiveCounts(repo_id=repo_id, label=label, count=delta))
+    if update.stargazers is not None:
+        counts.filter(LiveCounts.label == STARS_LABEL).update(
+                {LiveCounts.count: update.stargazers}, synchronize_session=False)
+
+
+def apply_webhook(owner, repo_name, delivery_id, update, snapshot_interval, now=None,
+                  writer=None):
+    '''Apply a webhooks.WebhookUpdate to a webhook repo's live counts.
+
+    Only the counts of the labels it touches are changed. If the repo's last
+    snapshot is more than snapshot_interval old, the live counts are stored as
+    a new one, in the same transaction, or if a snapshotwriter.SnapshotWriter
+    is given, queued with it once the transaction commits.
+
+    Returns 'duplicate' if delivery_id has been applied before, 'unsynced' if
+    the repo has no live counts yet (its next reconcile will set them), and
+    otherwise 'applied' or 'snapshot'.
+    '''
+    now = now or datetime.utcnow()
+    with session_scope() as session:
+        repo_id = get_repo(session, owner, repo_name).id
+    # GitHub sends several deliveries at once for one action (e.g. opened and
+    # labeled), so they're applied one at a time. The session is closed, which
+    # rolls back the early returns, before the lock is released.
+    with issue_state_lock(repo_id), session_scope() as session:
+        if (lock_issue_sync(session, repo_id) is None or
+                session.query(LiveCounts.label).filter(LiveCounts.repo_id == repo_id).first()
+                is None):
+            return 'unsynced'
+        session.add(WebhookDeliveries(id=delivery_id, repo_id=repo_id, received_at=now,
+                                      changes=webhooks.encode_update(update)))
+        try:
+            session.flush()
+        except IntegrityError:
+            return 'duplicate'
+
+        apply_update(session, repo_id, update)
+
+        last = session.query(LiveSnapshots).get(repo_id)
+        snapshot = last is None or now - last.snapshot_at >= snapshot_interval
+        if snapshot:
+            stats = load_live_stats(session, repo_id)
+            if writer is None:
+                add_stats(session, repo_id, now, stats)
+                bump_version(session, repo_id)
+            session.merge(LiveSnapshots(repo_id=repo_id, snapshot_at=now))
+            (session.query(WebhookDeliveries)
+                .filter(WebhookDeliveries.received_at < now - DELIVERY_RETENTION)
+                .delete(synchronize_session=False))
+        session.commit()
+
+    if snapshot and writer:
+        writer.put(owner, repo_name, stats, now)
+    elif snapshot:
+        notify_write(owner, repo_name)
+    return 'snapshot' if snapshot else 'applied'
 
 
 def add_repo(owner, repo, token):
     '''Add a new repo to the list of tracked repos.'''
-    session = Session()
-    session.add(Repos(owner=owner, repo=repo, token=token))
-    session.commit()
+    with session_scope() as session:
+        row = Repos(owner=owner, repo=repo, token=token)
+        session.add(row)
+        session.flush()
+        # a new repo has no history for its rollups to miss
+        session.add(RollupRebuilds(repo_id=row.id, rebuilt_at=datetime.utcnow()))
+        session.commit()
+    _repo_refs.invalidate((owner, repo))
 
 
 def add_user(login, token):
-    session = Session()
-    try:
-        user = session.query(Users).filter(Users.login==login).one()
-    except NoResultFound:
-        user = Users(login=login, token=token)
-    user = session.merge(user)
-    session.commit()
-    return user.id
+    with session_scope() as session:
+        try:
+            user = session.query(Users).filter(Users.login==login).one()
+        except NoResultFound:
+            user = Users(login=login, token=token)
+        user = session.merge(user)
+        session.commit()
+        user_id = user.id
+    _users.invalidate(user_id)
+    return user_id
 
 
 def get_user(user_id):
-    session = Session()
-    return session.query(Users).get(user_id)
+    '''Returns a (detached) Users row, or None.'''
+    user = _users.get(user_id)
+    if user is None:
+        with session_scope() as session:
+            user = session.query(Users).get(user_id)
+        if user is not None:
+            _users.put(user_id, user)
+    return user
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+import os
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from datetime import datetime
+
+from nose.tools import eq_
+
+import db
+import downsample
+import migrate_counts
+import tracker
+
+
+def setup_module():
+    db.add_repo('danvk', 'dygraphs', 'token')
+    db.add_repo('danvk', 'other', 'token')
+
+
+def teardown_module():
+    db.COUNTS_LAYOUT = db.ROWS_LAYOUT
+
+
+def store_history(owner, repo):
+    db.store_results([
+        (owner, repo, tracker.RepoStats(10, 5, 1, {'bug': 3, '': 2}), datetime(2015, 1, 1)),
+        (owner, repo, tracker.RepoStats(11, 4, 2, {'bug': 2, 'docs': 1}), datetime(2015, 1, 2)),
+    ])
+    db.store_backfill(owner, repo, {'delete': 'stargazers'})
+    db.store_backfill(owner, repo, {'stargazers': [['2014-12-30', 8], ['2014-12-31', 9]]})
+    db.store_backfill(owner, repo, {'by_label': {'docs': [['2014-12-31', 4]]}})
+
+
+def test_wide_layout_matches_rows_layout():
+    db.COUNTS_LAYOUT = db.ROWS_LAYOUT
+    store_history('danvk', 'dygraphs')
+    rows = [db.get_stats_series('danvk', 'dygraphs', include_labels=include)
+            for include in (False, True)]
+
+    eq_(rows[1][0], [(datetime(2014, 12, 30), 8), (datetime(2014, 12, 31), 9)])
+    eq_(rows[1][3], [
+        ['Date', '(unlabeled)', 'bug', 'docs'],
+        [datetime(2014, 12, 31), 0, 0, 4],
+        [datetime(2015, 1, 1), 2, 3, 0],
+        [datetime(2015, 1, 2), 0, 2, 1],
+    ])
+
+    db.COUNTS_LAYOUT = db.WIDE_LAYOUT
+    store_history('danvk', 'other')
+    for include, expected in zip((False, True), rows):
+        eq_(db.get_stats_series('danvk', 'other', include_labels=include), expected)
+
+
+def test_snapshot_editor_loads_only_what_it_edits():
+    db.COUNTS_LAYOUT = db.WIDE_LAYOUT
+    db.add_repo('danvk', 'edited', 'token')
+    db.store_results([('danvk', 'edited', tracker.RepoStats(1, 1, 0, {'bug': n}),
+                       datetime(2015, 1, n)) for n in range(1, 29)])
+    session = db.Session()
+    editor = db.SnapshotEditor(session, db.get_repo(session, 'danvk', 'edited').id)
+    editor.fill('docs', [(datetime(2015, 1, 3), 5), (datetime(2015, 2, 1), 6)])
+    eq_(sorted(editor.by_time), [datetime(2015, 1, 3), datetime(2015, 2, 1)])
+    editor.delete(lambda name: name == 'bug', datetime(2015, 1, 10), datetime(2015, 1, 12))
+    eq_(len(editor.by_time), 5)  # Jan 10-12
+    editor.save()
+    session.commit()
+    session.close()
+
+    by_label = db.get_stats_series('danvk', 'edited', include_labels=True)[3]
+    eq_(by_label[0], ['Date', 'bug', 'docs'])
+    eq_(by_label[3], [datetime(2015, 1, 3), 3, 5])
+    eq_(by_label[9:11], [[datetime(2015, 1, 9), 9, 0], [datetime(2015, 1, 12), 12, 0]])
+    eq_(by_label[-1], [datetime(2015, 2, 1), 0, 6])
+
+
+def test_migrate_counts():
+    db.COUNTS_LAYOUT = db.ROWS_LAYOUT
+    expected = db.get_stats_series('danvk', 'dygraphs', include_labels=True)
+    repo = db.get_repo(db.Session(), 'danvk', 'dygraphs')
+    migrate_counts.migrate_repo(repo, batch_size=2)
+    migrate_counts.migrate_repo(repo, batch_size=2)  # re-running is harmless
+
+    db.COUNTS_LAYOUT = db.WIDE_LAYOUT
+    eq_(db.get_stats_series('danvk', 'dygraphs', include_labels=True), expected)
+
+
+def test_create_missing_indexes():
+    eq_(db.create_missing_indexes(), [])
+    db.engine.execute('DROP INDEX ix_webhook_deliveries_received_at')
+    eq_(db.create_missing_indexes(), ['ix_webhook_deliveries_received_at'])
+    names = [index['name'] for index in db.inspect(db.engine).get_indexes('webhook_deliveries')]
+    assert 'ix_webhook_deliveries_received_at' in names
+
+
+def test_pivot():
+    t1, t2 = datetime(2015, 1, 1), datetime(2015, 1, 2)
+    eq_(db.pivot(['a', 'b'], [(t1, 'a', 1), (t1, 'b', 2), (t2, 'b', 3)]),
+        [[t1, 1, 2], [t2, 0, 3]])
+    eq_(db.pivot([], []), [])
+
+
+def test_time_range():
+    db.COUNTS_LAYOUT = db.ROWS_LAYOUT
+    stars, _, _, by_label = db.get_stats_series('danvk', 'dygraphs', include_labels=True,
+                                                start=datetime(2014, 12, 31),
+                                                end=datetime(2015, 1, 1))
+    eq_(stars, [(datetime(2014, 12, 31), 9)])
+    eq_([row[0] for row in by_label[1:]], [datetime(2014, 12, 31), datetime(2015, 1, 1)])
+
+
+def test_rollups_match_resampled_counts():
+    db.COUNTS_LAYOUT = db.ROWS_LAYOUT
+    db.add_repo('danvk', 'rollups', 'token')
+    store_history('danvk', 'rollups')
+    db.store_results([('danvk', 'rollups', tracker.RepoStats(12, 3, 2, {'docs': 2}),
+                       datetime(2015, 1, 2, 12))])
+    for resolution in downsample.RESOLUTIONS:
+        rollups = db.get_stats_series('danvk', 'rollups', include_labels=True,
+                                      resolution=resolution)
+        raw = db.get_stats_series('danvk', 'rollups', include_labels=True)
+        eq_(rollups[:3], tuple(downsample.resample(s, resolution) for s in raw[:3]))
+        eq_(rollups[3], [raw[3][0]] + downsample.resample(raw[3][1:], resolution))
+
+    daily = db.get_stats_series('danvk', 'rollups', include_labels=True, resolution='day')
+    db.rebuild_rollups('danvk', 'rollups')
+    eq_(db.get_stats_series('danvk', 'rollups', include_labels=True, resolution='day'), daily)
+    eq_(db.choose_resolution('danvk', 'rollups', max_points=2), 'day')
+    eq_(db.choose_resolution('danvk', 'rollups', max_points=5), None)
+
+
+def test_rollups_match_raw_counts_when_labels_disappear():
+    for layout, name in ((db.ROWS_LAYOUT, 'vanishing-rows'), (db.WIDE_LAYOUT, 'vanishing-wide')):
+        db.COUNTS_LAYOUT = layout
+        db.add_repo('danvk', name, 'token')
+        db.store_results([
+            ('danvk', name, tracker.RepoStats(1, 2, 0, {'x': 2}), datetime(2015, 1, 1, 1)),
+            # no labels, so no by_label row: the day still ends with x at 2
+            ('danvk', name, tracker.RepoStats(1, 0, 0, {}), datetime(2015, 1, 1, 5)),
+            ('danvk', name, tracker.RepoStats(1, 2, 0, {'x': 1, 'y': 1}), datetime(2015, 1, 2, 1)),
+        ])
+        # a later flush, in which x disappears
+        db.store_results([
+            ('danvk', name, tracker.RepoStats(1, 3, 0, {'y': 3}), datetime(2015, 1, 2, 5)),
+        ])
+        raw = db.get_stats_series('danvk', name, include_labels=True)
+        for resolution in downsample.RESOLUTIONS:
+            rollups = db.get_stats_series('danvk', name, include_labels=True,
+                                          resolution=resolution)
+            eq_(rollups[:3], tuple(downsample.resample(s, resolution) for s in raw[:3]))
+            eq_(rollups[3], [raw[3][0]] + downsample.resample(raw[3][1:], resolution))
+        eq_(db.get_stats_series('danvk', name, include_labels=True, resolution='day')[3],
+            [['Date', 'x', 'y'], [datetime(2015, 1, 1), 2, 0], [datetime(2015, 1, 2), 0, 3]])
+    db.COUNTS_LAYOUT = db.ROWS_LAYOUT
+
+
+def test_rollups_are_merged_once_per_batch():
+    db.COUNTS_LAYOUT = db.ROWS_LAYOUT
+    db.add_repo('danvk', 'batched', 'token')
+    queries = []
+    for n in (1, 10):
+        db.reset_query_count()
+        db.store_results([('danvk', 'batched', tracker.RepoStats(1, 1, 0, {'bug': i}),
+                           datetime(2015, n, 1, i)) for i in range(n)])
+        queries.append(db.query_count())
+    eq_(queries[0], queries[1])
+
+
+def test_rollups_are_only_read_once_rebuilt():
+    db.COUNTS_LAYOUT = db.ROWS_LAYOUT
+    db.add_repo('danvk', 'predates-rollups', 'token')
+    store_history('danvk', 'predates-rollups')
+    # as if it had been tracked before rollups: only the latest snapshot has any
+    session = db.Session()
+    repo_id = db.get_repo(session, 'danvk', 'predates-rollups').id
+    session.query(db.Rollups).filter(db.Rollups.repo_id == repo_id).delete()
+    session.query(db.RollupRebuilds).filter(db.RollupRebuilds.repo_id == repo_id).delete()
+    session.commit()
+    session.close()
+    db._rollups_complete.invalidate(repo_id)
+    db.store_results([('danvk', 'predates-rollups', tracker.RepoStats(12, 3, 2, {'docs': 2}),
+                       datetime(2015, 1, 2, 12))])
+    raw = db.get_stats_series('danvk', 'predates-rollups', include_labels=True)
+
+    expected = tuple(downsample.resample(s, 'day') for s in raw[:3])
+    eq_(db.get_stats_series('danvk', 'predates-rollups', resolution='day')[:3], expected)
+    eq_(db.choose_resolution('danvk', 'predates-rollups', max_points=1), None)
+    db.rebuild_rollups('danvk', 'predates-rollups')
+    eq_(db.get_stats_series('danvk', 'predates-rollups', resolution='day')[:3], expected)
+    eq_(db.choose_resolution('danvk', 'predates-rollups', max_points=1), 'month')
+
+
+def test_delta_keeps_rollups_in_step_with_raw_counts():
+    for layout, name in ((db.ROWS_LAYOUT, 'refreshed-rows'), (db.WIDE_LAYOUT, 'refreshed-wide')):
+        db.COUNTS_LAYOUT = layout
+        db.add_repo('danvk', name, 'token')
+        # x is missing from the later snapshot on the same day, so it dropped to zero
+        db.store_results([
+            ('danvk', name, tracker.RepoStats(1, 2, 0, {'x': 2}), datetime(2015, 1, 1, 1)),
+            ('danvk', name, tracker.RepoStats(1, 2, 0, {'y': 2}), datetime(2015, 1, 1, 5)),
+        ])
+        db.store_backfill_delta('danvk', name, {'ranges': [
+            {'series': 'by_label', 'label': 'x', 'from': '2014-12-31', 'to': '2014-12-31',
+             'start': '2014-12-31', 'counts': [1]}]})
+        raw = db.get_stats_series('danvk', name, include_labels=True)
+        for resolution in downsample.RESOLUTIONS:
+            rollups = db.get_stats_series('danvk', name, include_labels=True,
+                                          resolution=resolution)
+            eq_(rollups[3], [raw[3][0]] + downsample.resample(raw[3][1:], resolution))
+        eq_(rollups[3][-1], [datetime(2015, 1, 1), 0, 2])
+    db.COUNTS_LAYOUT = db.ROWS_LAYOUT
+
+
+def test_stream_stats_series():
+    for layout, repo in ((db.ROWS_LAYOUT, 'dygraphs'), (db.WIDE_LAYOUT, 'other')):
+        db.COUNTS_LAYOUT = layout
+        for kwargs in ({}, {'include_labels': True},
+                       {'include_labels': True, 'resolution': 'month',
+                        'start': datetime(2014, 12, 31)}):
+            expected = db.get_stats_series('danvk', repo, **kwargs)
+            streamed = db.stream_stats_series('danvk', repo, **kwargs)
+            eq_(tuple(list(series) for series in streamed), expected)
+
+
+def test_ttl_cache():
+    now = [100.0]
+    cache = db.TTLCache(10, clock=lambda: now[0])
+    cache.put('a', 1)
+    now[0] += 9
+    eq_(cache.get('a'), 1)
+    now[0] += 1
+    eq_(cache.get('a'), None)
+    cache.put('b', 2)
+    cache.invalidate('b')
+    eq_(cache.get('b'), None)
+
+
+def test_lookups_are_cached():
+    user_id = db.add_user('cached-user', 'token')
+    db.get_user(user_id)
+    db.get_repo_version('danvk', 'dygraphs')
+    db.reset_query_count()
+    eq_(db.get_user(user_id).login, 'cached-user')
+    eq_(db.is_repo_tracked('danvk', 'dygraphs'), True)
+    eq_(db.query_count(), 0)
+    db.get_repo_version('danvk', 'dygraphs')
+    eq_(db.query_count(), 1)
+
+    eq_(db.is_repo_tracked('danvk', 'added-later'), False)
+    db.add_repo('danvk', 'added-later', 'token')
+    eq_(db.is_repo_tracked('danvk', 'added-later'), True)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+'''Checksums over blocks of days, for sending only the changed parts of a backfill.
+
+The tracker publishes a digest of each series it has: one checksum per block
+of BLOCK_DAYS consecutive days. backfill.py computes the same checksums over
+the series it generated and uploads only the blocks whose checksums differ.
+
+A series here is a list of (day ordinal, count) pairs in day order, with at
+most one count per day (see dates.py for ordinals). Blocks are aligned to
+multiples of BLOCK_DAYS, so both sides agree on where they start.
+'''
+
+import zlib
+
+import dates
+
+BLOCK_DAYS = 64
+
+
+def block_of(day):
+    '''Returns the first day of the block containing day.'''
+    return day - day % BLOCK_DAYS
+
+
+def last_per_day(points):
+    '''Reduce (datetime, count) pairs in time order to the last count on each day.'''
+    days = []
+    for t, count in points:
+        day = t.toordinal()
+        if days and days[-1][0] == day:
+            days[-1] = (day, count)
+        else:
+            days.append((day, count))
+    return days
+
+
+def block_checksums(days):
+    '''Returns a dict of block start (YYYY-MM-DD) --> checksum for a series.'''
+    parts = {}  # block start ordinal --> list of 'day:count' strings
+    for day, count in days:
+        parts.setdefault(block_of(day), []).append('%d:%d' % (day, count))
+    return {dates.day_string(block): '%08x' % (zlib.crc32(','.join(values)) & 0xffffffff)
+            for block, values in parts.iteritems()}
+
+
+def changed_ranges(days, checksums):
+    '''Find the parts of a local series which differ from a remote digest.
+
+    days is the local series and checksums the remote block_checksums for the
+    same series. Returns a list of (first day, last day, local points in that
+    range), merging adjacent blocks. A range with no local points means the
+    remote series has data there which should be removed.
+    '''
+    local = block_checksums(days)
+    blocks = sorted(dates.day_ordinal(block) for block in set(local) | set(checksums)
+                    if local.get(block) != checksums.get(block))
+    ranges = []
+    for block in blocks:
+        if ranges and ranges[-1][1] + 1 == block:
+            ranges[-1][1] = block + BLOCK_DAYS - 1
+        else:
+            ranges.append([block, block + BLOCK_DAYS - 1])
+    return [(first, last, [(day, count) for day, count in days if first <= day <= last])
+            for first, last in ranges]
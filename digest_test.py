@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+from datetime import datetime
+
+from nose.tools import eq_
+
+import dates
+import digest
+
+
+def test_last_per_day():
+    eq_(digest.last_per_day([(datetime(2015, 1, 1), 1), (datetime(2015, 1, 1, 12), 2),
+                             (datetime(2015, 1, 2), 3)]),
+        [(datetime(2015, 1, 1).toordinal(), 2), (datetime(2015, 1, 2).toordinal(), 3)])
+
+
+def test_changed_ranges():
+    start = digest.block_of(dates.day_ordinal('2015-01-01'))
+    days = [(start + i, i) for i in range(3 * digest.BLOCK_DAYS)]
+    remote = digest.block_checksums(days)
+    eq_(digest.changed_ranges(days, remote), [])
+
+    # a change in the middle block, and a new day past the end
+    edited = list(days)
+    edited[digest.BLOCK_DAYS + 5] = (start + digest.BLOCK_DAYS + 5, -1)
+    edited.append((start + 3 * digest.BLOCK_DAYS, 0))
+    eq_([(first - start, last - start, len(points))
+         for first, last, points in digest.changed_ranges(edited, remote)],
+        [(digest.BLOCK_DAYS, 2 * digest.BLOCK_DAYS - 1, digest.BLOCK_DAYS),
+         (3 * digest.BLOCK_DAYS, 4 * digest.BLOCK_DAYS - 1, 1)])
+
+    # adjacent changed blocks are merged; remote-only blocks come back empty
+    eq_(digest.changed_ranges([], remote), [(start, start + 3 * digest.BLOCK_DAYS - 1, [])])
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+'''Reduce the number of points in a series before sending it to the browser.
+
+A series is a list of rows in time order, where row[0] is a datetime and the
+remaining entries are counts: either (time, count) pairs or the
+[time, count, count, ...] rows of a by_label matrix. Every function here makes
+a single pass over its input.
+'''
+
+from datetime import datetime, timedelta
+import calendar
+
+RESOLUTIONS = ('day', 'week', 'month')
+
+
+def bucket_start(t, resolution):
+    '''Returns the start of the day, week (Monday) or month containing t.'''
+    day = datetime(t.year, t.month, t.day)
+    if resolution == 'day':
+        return day
+    elif resolution == 'week':
+        return day - timedelta(days=day.weekday())
+    elif resolution == 'month':
+        return datetime(t.year, t.month, 1)
+    raise ValueError('Unknown resolution %s' % resolution)
+
+
+def resample(series, resolution):
+    '''Keep only the last row in each day, week or month.
+
+    Counts are levels rather than events, so the last observation in a bucket
+    is the best summary of it. Rows are re-timestamped with the start of their
+    bucket, which matches what the rollup tables in db store.
+    '''
+    return list(iter_resample(series, resolution))
+
+
+def iter_resample(series, resolution):
+    '''Like resample, but yields each row once its bucket is complete.'''
+    last = None
+    for row in series:
+        row = type(row)([bucket_start(row[0], resolution)]) + row[1:]
+        if last is not None and row[0] != last[0]:
+            yield last
+        last = row
+    if last is not None:
+        yield last
+
+
+def row_value(row):
+    '''The y-value LTTB uses for a row: the count, or the sum of all counts.'''
+    return sum(row[1:])
+
+
+def lttb(series, max_points, value=row_value):
+    '''Largest-Triangle-Three-Buckets downsampling to at most max_points rows.
+
+    This keeps the first and last rows and, from each bucket in between, the
+    row which forms the largest triangle with its neighbors. That preserves
+    the visual shape of the series (peaks, troughs and steps) far better than
+    taking every nth row. See Sveinn Steinarsson's 2013 thesis.
+    '''
+    n = len(series)
+    if max_points >= n or max_points < 3:
+        return list(series)
+
+    xs = [calendar.timegm(row[0].timetuple()) for row in series]
+    ys = [value(row) for row in series]
+
+    out = [series[0]]
+    bucket_size = float(n - 2) / (max_points - 2)
+    a = 0  # index of the previously selected row
+    for i in xrange(max_points - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+
+        # The average of the next bucket is the triangle's third vertex.
+        next_start = end
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        if next_start >= next_end:
+            next_start, next_end = n - 1, n
+        count = next_end - next_start
+        avg_x = float(sum(xs[next_start:next_end])) / count
+        avg_y = float(sum(ys[next_start:next_end])) / count
+
+        best_area = -1
+        best = start
+        for j in xrange(start, end):
+            area = abs((xs[a] - avg_x) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (avg_y - ys[a]))
+            if area > best_area:
+                best_area = area
+                best = j
+        out.append(series[best])
+        a = best
+    out.append(series[-1])
+    return out
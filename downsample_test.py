@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+from datetime import datetime, timedelta
+
+from nose.tools import eq_
+
+import downsample
+
+
+def test_bucket_start():
+    t = datetime(2015, 10, 1, 13, 45)  # a Thursday
+    eq_(downsample.bucket_start(t, 'day'), datetime(2015, 10, 1))
+    eq_(downsample.bucket_start(t, 'week'), datetime(2015, 9, 28))
+    eq_(downsample.bucket_start(t, 'month'), datetime(2015, 10, 1))
+
+
+def test_resample():
+    series = [
+        (datetime(2015, 9, 30, 1), 1),
+        (datetime(2015, 9, 30, 9), 2),
+        (datetime(2015, 10, 1, 9), 3),
+        (datetime(2015, 10, 31, 9), 4),
+        (datetime(2015, 11, 2, 9), 5),
+    ]
+    eq_([count for _, count in downsample.resample(series, 'day')], [2, 3, 4, 5])
+    eq_([count for _, count in downsample.resample(series, 'week')], [3, 4, 5])
+    eq_([count for _, count in downsample.resample(series, 'month')], [2, 4, 5])
+    eq_([t for t, _ in downsample.resample(series, 'week')],
+        [datetime(2015, 9, 28), datetime(2015, 10, 26), datetime(2015, 11, 2)])
+
+
+def test_lttb():
+    start = datetime(2015, 1, 1)
+    series = [[start + timedelta(days=i), 0, 0] for i in range(100)]
+    series[37][1] = 50  # a spike which every-nth sampling would miss
+
+    out = downsample.lttb(series, 10)
+    eq_(len(out), 10)
+    eq_(out[0], series[0])
+    eq_(out[-1], series[-1])
+    eq_(series[37] in out, True)
+    eq_(out, sorted(out))
+
+    eq_(downsample.lttb(series[:5], 10), series[:5])
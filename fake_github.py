@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+'''A tiny in-process fake of the GitHub REST API, for tests.
+
+It serves just enough of the API for the tracker and backfiller: users, repos,
+paginated issue/pull lists, per-issue events, issue search counts, the label
+totals GraphQL query, stargazers and ETag-based conditional requests. Setting
+throttled to N makes the next N requests fail with GitHub's secondary rate
+limit response. Setting quota to N allows N more requests, counting down in
+X-RateLimit-Remaining, after which requests fail as if it were exhausted.
+
+    server = FakeGitHub()
+    server.add_repo('danvk', 'dygraphs', stargazers=10, issues=[...])
+    server.start()
+    g = Github(base_url=server.url)
+    ...
+    server.stop()
+'''
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import hashlib
+import json
+import re
+import threading
+import time
+import urlparse
+import urllib
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_issue(number, labels=(), state='open', pull=False, created_at='2015-01-01T00:00:00Z',
+               closed_at=None, events=None):
+    '''Build a minimal GitHub issue JSON object.'''
+    issue = {
+        'number': number,
+        'title': 'Issue %d' % number,
+        'state': state,
+        'labels': [{'name': label} for label in labels],
+        'created_at': created_at,
+        'updated_at': created_at,
+        'closed_at': closed_at,
+        'html_url': 'https://github.com/owner/repo/%s/%d' % ('pull' if pull else 'issues', number),
+    }
+    if pull:
+        issue['pull_request'] = {}
+    if events is not None:
+        issue['events'] = events
+    return issue
+
+
+class FakeGitHub(object):
+    def __init__(self):
+        self.repos = {}
+        self.lock = threading.Lock()
+        self.log = []  # (path, status) for every request served
+        self.throttled = 0
+        self.quota = None
+        self.server = None
+
+    def add_repo(self, owner, name, stargazers=0, issues=()):
+        issues = list(issues)
+        event_id = 0
+        for issue in issues:
+            if 'events' in issue:
+                events = []
+                for event in issue['events']:
+                    event_id += 1
+                    events.append(dict(event, id=event.get('id', event_id)))
+                issue['events'] = events
+        self.repos[(owner, name)] = {
+            'stargazers': stargazers,
+            'issues': issues,
+        }
+
+    def issues(self, owner, name):
+        return self.repos[(owner, name)]['issues']
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.handle(self)
+
+            def do_POST(self):
+                fake.handle_post(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def statuses(self):
+        '''Returns the list of HTTP statuses served so far.'''
+        with self.lock:
+            return [status for _, status in self.log]
+
+    def routes(self):
+        return [
+            (r'^/users/([^/]+)$', self.get_user),
+            (r'^/repos/([^/]+)/([^/]+)$', self.get_repo),
+            (r'^/repos/([^/]+)/([^/]+)/issues$', self.list_issues),
+            (r'^/repos/([^/]+)/([^/]+)/issues/(\d+)/events$', self.list_issue_events),
+            (r'^/repos/([^/]+)/([^/]+)/issues/events$', self.list_repo_issue_events),
+            (r'^/repos/([^/]+)/([^/]+)/pulls$', self.list_pulls),
+            (r'^/repos/([^/]+)/([^/]+)/stargazers$', self.list_stargazers),
+            (r'^/search/issues$', self.search_issues),
+        ]
+
+    def handle_post(self, request):
+        body = json.loads(request.rfile.read(int(request.headers['Content-Length'])))
+        if request.path != '/graphql':
+            return self.respond(request, 404, {'message': 'Not Found'})
+        self.respond(request, 200, self.label_totals(body['variables']))
+
+    def handle(self, request):
+        parsed = urlparse.urlparse(request.path)
+        params = dict(urlparse.parse_qsl(parsed.query))
+        with self.lock:
+            throttle = self.throttled > 0
+            if throttle:
+                self.throttled -= 1
+            exhausted = self.quota == 0
+            if self.quota:
+                self.quota -= 1
+        if exhausted:
+            return self.respond(request, 403, {'message': 'API rate limit exceeded'})
+        if throttle:
+            return self.respond(request, 403,
+                                {'message': 'You have exceeded a secondary rate limit.'},
+                                {'Retry-After': '0'})
+        for pattern, route in self.routes():
+            m = re.match(pattern, parsed.path)
+            if m:
+                try:
+                    body, headers = route(params, *m.groups())
+                except KeyError:
+                    return self.respond(request, 404, {'message': 'Not Found'})
+                return self.respond(request, 200, body, headers,
+                                    parsed.path, params)
+        self.respond(request, 404, {'message': 'Not Found'})
+
+    def respond(self, request, status, body, headers=None, path=None, params=None):
+        data = json.dumps(body)
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if status == 200 and request.headers.get('If-None-Match') == etag:
+            status = 304
+            data = ''
+        with self.lock:
+            self.log.append((request.path, status))
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json; charset=utf-8')
+        request.send_header('ETag', etag)
+        request.send_header('X-RateLimit-Limit', '5000')
+        if self.quota is None:
+            request.send_header('X-RateLimit-Remaining', '4999')
+            request.send_header('X-RateLimit-Reset', '0')
+        else:
+            request.send_header('X-RateLimit-Remaining', str(self.quota))
+            request.send_header('X-RateLimit-Reset', str(int(time.time()) + 3600))
+        for k, v in (headers or {}).iteritems():
+            request.send_header(k, v)
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def paginate(self, items, params, path):
+        '''Slice items the way GitHub does, returning (page, headers).'''
+        per_page = int(params.get('per_page', 30))
+        page = int(params.get('page', 1))
+        start = (page - 1) * per_page
+        headers = {}
+        if start + per_page < len(items):
+            next_params = dict(params, page=page + 1)
+            headers['Link'] = '<%s%s?%s>; rel="next"' % (
+                    self.url, path, urllib.urlencode(sorted(next_params.items())))
+        return items[start:start + per_page], headers
+
+    def get_user(self, params, login):
+        return {'login': login, 'url': '%s/users/%s' % (self.url, login)}, {}
+
+    def get_repo(self, params, owner, name):
+        repo = self.repos[(owner, name)]
+        return {
+            'name': name,
+            'full_name': '%s/%s' % (owner, name),
+            'owner': {'login': owner},
+            'url': '%s/repos/%s/%s' % (self.url, owner, name),
+            'stargazers_count': repo['stargazers'],
+            'open_issues_count': len([i for i in repo['issues'] if i['state'] == 'open']),
+        }, {}
+
+    def filter_state(self, issues, params):
+        state = params.get('state', 'open')
+        if state == 'all':
+            return issues
+        return [issue for issue in issues if issue['state'] == state]
+
+    def list_issues(self, params, owner, name):
+        issues = self.filter_state(self.repos[(owner, name)]['issues'], params)
+        if 'since' in params:
+            issues = [issue for issue in issues if issue['updated_at'] >= params['since']]
+        if params.get('sort') == 'created':
+            issues = sorted(issues, key=lambda issue: issue['created_at'],
+                            reverse=params.get('direction', 'desc') == 'desc')
+        issues = [dict((k, v) for k, v in issue.iteritems() if k != 'events') for issue in issues]
+        return self.paginate(issues, params, '/repos/%s/%s/issues' % (owner, name))
+
+    def list_issue_events(self, params, owner, name, number):
+        issue = [i for i in self.repos[(owner, name)]['issues'] if i['number'] == int(number)][0]
+        events = [dict(event, issue={'number': issue['number']})
+                  for event in issue.get('events', [])]
+        return self.paginate(events, params,
+                             '/repos/%s/%s/issues/%s/events' % (owner, name, number))
+
+    def list_repo_issue_events(self, params, owner, name):
+        '''Every issue's events, newest first, like GitHub's repo-wide stream.'''
+        events = []
+        for issue in self.repos[(owner, name)]['issues']:
+            events.extend(dict(event, issue={'number': issue['number']})
+                          for event in issue.get('events', []))
+        events.sort(key=lambda event: event['id'], reverse=True)
+        return self.paginate(events, params, '/repos/%s/%s/issues/events' % (owner, name))
+
+    def list_stargazers(self, params, owner, name):
+        '''The star+json form, with users starring on successive days of January 2015.'''
+        stars = [{'starred_at': '2015-01-%02dT12:00:00Z' % (1 + i % 31),
+                  'user': {'login': 'user%d' % i}}
+                 for i in range(self.repos[(owner, name)]['stargazers'])]
+        stars.sort(key=lambda star: star['starred_at'])
+        return self.paginate(stars, params, '/repos/%s/%s/stargazers' % (owner, name))
+
+    def search_issues(self, params):
+        '''Supports queries of the form "repo:owner/name is:open no:label".'''
+        terms = params['q'].split()
+        owner, name = [t for t in terms if t.startswith('repo:')][0][5:].split('/')
+        issues = self.repos[(owner, name)]['issues']
+        if 'is:open' in terms:
+            issues = [issue for issue in issues if issue['state'] == 'open']
+        if 'no:label' in terms:
+            issues = [issue for issue in issues if not issue['labels']]
+        return {'total_count': len(issues), 'incomplete_results': False, 'items': []}, {}
+
+    def label_totals(self, variables, page_size=2):
+        '''Answers tracker.LABEL_TOTALS_QUERY, with small pages to exercise paging.'''
+        key = (variables['owner'], variables['name'])
+        if key not in self.repos:
+            return {'data': {'repository': None}}
+        repo = self.repos[key]
+        open_issues = [issue for issue in repo['issues'] if issue['state'] == 'open']
+        names = sorted({label['name'] for issue in repo['issues'] for label in issue['labels']})
+        start = int(variables.get('cursor') or 0)
+
+        def totals(issues):
+            return {'totalCount': len(issues)}
+
+        nodes = []
+        for name in names[start:start + page_size]:
+            labeled = [i for i in open_issues if name in [l['name'] for l in i['labels']]]
+            nodes.append({
+                'name': name,
+                'issues': totals([i for i in labeled if 'pull_request' not in i]),
+                'pullRequests': totals([i for i in labeled if 'pull_request' in i]),
+            })
+        return {'data': {'repository': {
+            'stargazers': {'totalCount': repo['stargazers']},
+            'issues': totals([i for i in open_issues if 'pull_request' not in i]),
+            'pullRequests': totals([i for i in open_issues if 'pull_request' in i]),
+            'labels': {
+                'pageInfo': {
+                    'hasNextPage': start + page_size < len(names),
+                    'endCursor': str(start + page_size),
+                },
+                'nodes': nodes,
+            },
+        }}}
+
+    def list_pulls(self, params, owner, name):
+        issues = self.filter_state(self.repos[(owner, name)]['issues'], params)
+        pulls = [{'number': issue['number'], 'state': issue['state']}
+                 for issue in issues if 'pull_request' in issue]
+        return self.paginate(pulls, params, '/repos/%s/%s/pulls' % (owner, name))
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+'''Fetch the events of many issues at once, for backfill.py.
+
+GitHub only lists an issue's events one issue at a time, so a backfill makes
+at least one request per issue. EventFetcher makes them from a pool of
+threads which share one keep-alive requests.Session, and:
+
+- pauses every worker when the token's quota is nearly used up, until it
+  resets (X-RateLimit-Remaining / X-RateLimit-Reset);
+- backs off when GitHub reports a secondary rate limit (403 or 429 with
+  Retry-After) or a server error, then retries;
+- hands each issue back as soon as it's complete, so the caller can save it
+  and a restarted backfill can skip it;
+- reports throughput and an ETA as it goes.
+
+repo_events reads the repo-wide event stream instead, which covers every
+issue at 100 events per request. issue_pages and stargazer_pages list a repo's
+issues and stargazers oldest first, a page at a time, and can pick up again
+from a saved next-page URL.
+'''
+
+from multiprocessing.pool import ThreadPool
+import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import tracker
+
+# Leave this many requests in the quota for everything else using the token.
+RATE_LIMIT_RESERVE = 50
+
+
+class RateLimitExhausted(Exception):
+    '''Raised by a RateLimiter which may not wait for the quota to reset.'''
+
+    def __init__(self, reset):
+        Exception.__init__(self, 'GitHub API quota exhausted until %s' %
+                           time.strftime('%H:%M:%S', time.localtime(reset)))
+        self.reset = reset
+
+
+class RateLimiter(object):
+    '''Shared by all of a fetcher's workers, which call wait() before each request.
+
+    When the quota is nearly used up, wait() sleeps until it resets, or if
+    wait_for_reset is False, raises RateLimitExhausted.
+    '''
+
+    def __init__(self, reserve=RATE_LIMIT_RESERVE, clock=time.time, sleep=time.sleep,
+                 wait_for_reset=True):
+        self.reserve = reserve
+        self.clock = clock
+        self.sleep = sleep
+        self.wait_for_reset = wait_for_reset
+        self.lock = threading.Lock()
+        self.resume_at = 0
+        self.quota_reset = 0
+
+    def wait(self):
+        with self.lock:
+            delay = self.resume_at - self.clock()
+            exhausted = self.quota_reset > self.clock()
+        if exhausted:
+            raise RateLimitExhausted(self.quota_reset)
+        if delay > 0:
+            self.sleep(delay)
+
+    def pause_until(self, t):
+        with self.lock:
+            self.resume_at = max(self.resume_at, t)
+
+    def observe(self, response, attempt):
+        '''Update the limits from a response. Returns True if it should be retried.'''
+        headers = response.headers
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining is not None and reset and int(remaining) <= self.reserve:
+            if self.wait_for_reset:
+                sys.stderr.write('Rate limit nearly exhausted; pausing until %s\n' %
+                                 time.strftime('%H:%M:%S', time.localtime(int(reset))))
+                self.pause_until(int(reset) + 1)
+            else:
+                with self.lock:
+                    self.quota_reset = max(self.quota_reset, int(reset) + 1)
+
+        if response.status_code in (403, 429):
+            if 'Retry-After' in headers:
+                self.pause_until(self.clock() + int(headers['Retry-After']))
+                return True
+            return remaining == '0'
+        if response.status_code >= 500:
+            self.pause_until(self.clock() + 2 ** attempt)
+            return True
+        return False
+
+
+class Progress(object):
+    '''Writes "done/total, rate and ETA" lines, at most once every `every` seconds.'''
+
+    def __init__(self, total, out=sys.stderr, every=5.0, clock=time.time):
+        self.total = total
+        self.out = out
+        self.every = every
+        self.clock = clock
+        self.done = 0
+        self.start = self.last_report = clock()
+
+    def advance(self):
+        self.done += 1
+        now = self.clock()
+        if now - self.last_report < self.every and self.done < self.total:
+            return
+        self.last_report = now
+        rate = self.done / max(now - self.start, 1e-6)
+        eta = (self.total - self.done) / rate
+        self.out.write('Fetched events for %d/%d issues (%.1f issues/sec, ETA %dm%02ds)\n' % (
+                self.done, self.total, rate, eta / 60, eta % 60))
+
+
+class EventFetcher(object):
+    per_page = 100
+
+    def __init__(self, token=None, api_url=None, workers=8, retries=5, limiter=None):
+        self.api_url = api_url or tracker.GITHUB_API_URL
+        self.workers = workers
+        self.retries = retries
+        self.limiter = limiter or RateLimiter()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Accept'] = 'application/vnd.github.v3+json'
+        token = tracker.get_token(token)
+        if token:
+            self.session.headers['Authorization'] = 'token %s' % token
+
+    def get(self, url, params=None, headers=None):
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            response = self.session.get(url, params=params, headers=headers)
+            if not self.limiter.observe(response, attempt):
+                break
+        response.raise_for_status()
+        return response
+
+    def issue_events(self, owner, repo, number):
+        '''Returns the raw events of an issue, following every page.'''
+        url = '%s/repos/%s/%s/issues/%d/events' % (self.api_url, owner, repo, number)
+        params = {'per_page': self.per_page}
+        events = []
+        while url:
+            response = self.get(url, params)
+            events.extend(response.json())
+            url = response.links.get('next', {}).get('url')
+            params = None  # the next link already has them
+        for event in events:
+            event.pop('issue', None)
+        return events
+
+    def repo_events(self, owner, repo):
+        '''Yields every issue event in a repo, newest first, 100 per request.
+
+        Each event has an 'issue' key with the issue's JSON.
+        '''
+        url = '%s/repos/%s/%s/issues/events' % (self.api_url, owner, repo)
+        for events, _ in self.pages(url, {'per_page': self.per_page}):
+            for event in events:
+                yield event
+
+    def pages(self, url, params=None, headers=None):
+        '''Yields (JSON list, next page URL or None) for each page of a list.'''
+        while url:
+            response = self.get(url, params, headers)
+            next_url = response.links.get('next', {}).get('url')
+            yield response.json(), next_url
+            url = next_url
+            params = None  # the next link already has them
+
+    def issue_pages(self, owner, repo, url=None):
+        '''Yields (issues, next page URL) for each page of a repo's issues and PRs.
+
+        Issues are listed oldest first, so that new ones are only ever added to
+        the last page. Pass a next page URL to resume listing from there.
+        '''
+        params = None
+        if not url:
+            url = '%s/repos/%s/%s/issues' % (self.api_url, owner, repo)
+            params = {'state': 'all', 'sort': 'created', 'direction': 'asc',
+                      'per_page': self.per_page}
+        return self.pages(url, params)
+
+    def stargazer_pages(self, owner, repo, url=None):
+        '''Yields (stargazers, next page URL) for each page of a repo's stargazers.
+
+        Each stargazer has a 'starred_at' time. Pass a next page URL to resume
+        listing from there.
+        '''
+        params = None
+        if not url:
+            url = '%s/repos/%s/%s/stargazers' % (self.api_url, owner, repo)
+            params = {'per_page': self.per_page}
+        return self.pages(url, params, {'Accept': 'application/vnd.github.v3.star+json'})
+
+    def fetch_events(self, owner, repo, issues, on_issue):
+        '''Add an 'events' list to each issue's JSON.
+
+        on_issue is called (on this thread) with each completed issue, in
+        whatever order they finish.
+        '''
+        def fetch(issue):
+            issue = dict(issue)
+            issue['events'] = self.issue_events(owner, repo, issue['number'])
+            return issue
+
+        progress = Progress(len(issues))
+        pool = ThreadPool(self.workers)
+        try:
+            for issue in pool.imap_unordered(fetch, issues):
+                on_issue(issue)
+                progress.advance()
+        finally:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_
+
+from fake_github import FakeGitHub, make_issue
+import backfill
+import fetcher
+import issuecache
+import tracker
+
+
+server = None
+
+
+def labeled(name, t='2015-01-02T00:00:00Z'):
+    return {'event': 'labeled', 'created_at': t, 'label': {'name': name}}
+
+
+def setup_module():
+    global server
+    server = FakeGitHub()
+    issues = [make_issue(n, labels=['bug'], events=[labeled('bug')]) for n in range(1, 11)]
+    # enough events to need a second page
+    issues.append(make_issue(11, events=[labeled('bug'), {'event': 'unlabeled',
+                                                         'created_at': '2015-01-03T00:00:00Z',
+                                                         'label': {'name': 'bug'}}] * 60))
+    issues.append(make_issue(12, pull=True, state='closed', closed_at='2015-01-04T00:00:00Z',
+                             events=[{'event': 'closed', 'created_at': '2015-01-04T00:00:00Z'}]))
+    server.add_repo('danvk', 'dygraphs', stargazers=12, issues=issues)
+    server.start()
+    tracker.GITHUB_API_URL = server.url
+
+
+def teardown_module():
+    tracker.GITHUB_API_URL = 'https://api.github.com'
+    server.stop()
+
+
+def test_fetch_events():
+    server.throttled = 2
+    issues = [dict(issue, events=None) for issue in server.issues('danvk', 'dygraphs')]
+    done = []
+    fetcher.EventFetcher('token', workers=4).fetch_events('danvk', 'dygraphs', issues,
+                                                          done.append)
+
+    eq_(sorted(issue['number'] for issue in done), range(1, 13))
+    for issue in done:
+        expected = server.issues('danvk', 'dygraphs')[issue['number'] - 1]['events']
+        eq_(issue['events'], expected)  # every page, without the 'issue' key
+    eq_(server.statuses().count(403), 2)
+
+
+def test_rate_limiter_pauses_near_reserve():
+    now = [1000.0]
+    slept = []
+    limiter = fetcher.RateLimiter(reserve=10, clock=lambda: now[0], sleep=slept.append)
+
+    class Response(object):
+        status_code = 200
+        headers = {'X-RateLimit-Remaining': '9', 'X-RateLimit-Reset': '1060'}
+
+    eq_(limiter.observe(Response(), 0), False)
+    limiter.wait()
+    eq_(slept, [61.0])
+
+
+def use_temp_cache():
+    tmpdir = tempfile.mkdtemp()
+    backfill.CACHE_FILE = os.path.join(tmpdir, 'cache.db')
+    return tmpdir
+
+
+def test_backfill_resumes_from_cache():
+    tmpdir = use_temp_cache()
+    try:
+        g = tracker.get_github('token')
+        repo = g.get_user('danvk').get_repo('dygraphs')
+        eq_(len(list(backfill.fetch_all_issues(repo))), 11)
+
+        del server.log[:]
+        eq_([pull['number'] for pull in backfill.fetch_all_pulls(repo)], [12])
+        eq_([path for path, _ in server.log if '/events' in path], [])
+    finally:
+        shutil.rmtree(tmpdir)
+        backfill.CACHE_FILE = 'issue-tracker-backfill.db'
+
+
+def test_backfill_from_repo_events():
+    tmpdir = use_temp_cache()
+    try:
+        g = tracker.get_github('token')
+        repo = g.get_user('danvk').get_repo('dygraphs')
+        by_issue = list(backfill.fetch_all_issues_and_pulls(repo))
+
+        os.remove(backfill.CACHE_FILE)
+        backfill.SOURCE = backfill.REPO_SOURCE
+        del server.log[:]
+        by_repo = list(backfill.fetch_all_issues_and_pulls(repo))
+        # 132 events in total, so two pages of the stream and no per-issue requests
+        eq_(len([path for path, _ in server.log if '/events' in path]), 2)
+    finally:
+        backfill.SOURCE = backfill.ISSUES_SOURCE
+        shutil.rmtree(tmpdir)
+        backfill.CACHE_FILE = 'issue-tracker-backfill.db'
+
+    def key(issue):
+        return issue['number']
+    eq_(sorted(by_repo, key=key), sorted(by_issue, key=key))
+    eq_([backfill.issue_events(issue) for issue in sorted(by_repo, key=key)],
+        [backfill.issue_events(issue) for issue in sorted(by_issue, key=key)])
+
+
+def interrupt_at_page_3():
+    '''Pages of 5, with the quota running low after two requests.'''
+    fetcher.EventFetcher.per_page = 5
+    server.quota = fetcher.RATE_LIMIT_RESERVE + 2
+
+
+def test_backfill_resumes_listing_after_quota_runs_out():
+    tmpdir = use_temp_cache()
+    try:
+        g = tracker.get_github('token')
+        repo = g.get_user('danvk').get_repo('dygraphs')
+        interrupt_at_page_3()
+        try:
+            list(backfill.fetch_all_issues_and_pulls(repo))
+            assert False, 'Expected the quota to run out'
+        except fetcher.RateLimitExhausted:
+            pass
+        eq_(len(issuecache.IssueCache(backfill.CACHE_FILE).listed_numbers()), 10)
+
+        server.quota = None
+        del server.log[:]
+        eq_(sorted(issue['number'] for issue in backfill.fetch_all_issues_and_pulls(repo)),
+            range(1, 13))
+        listings = [path for path, _ in server.log
+                    if path.startswith('/repos/danvk/dygraphs/issues?')]
+        eq_(len(listings), 1)
+        assert 'page=3' in listings[0], listings
+    finally:
+        fetcher.EventFetcher.per_page = 100
+        server.quota = None
+        shutil.rmtree(tmpdir)
+        backfill.CACHE_FILE = 'issue-tracker-backfill.db'
+
+
+def test_backfill_stars_resumes_after_quota_runs_out():
+    tmpdir = use_temp_cache()
+    try:
+        expected = backfill.backfill_stars(None, 'danvk', 'dygraphs')
+        os.remove(backfill.CACHE_FILE)
+
+        interrupt_at_page_3()
+        try:
+            backfill.backfill_stars(None, 'danvk', 'dygraphs')
+            assert False, 'Expected the quota to run out'
+        except fetcher.RateLimitExhausted:
+            pass
+        server.quota = None
+        del server.log[:]
+        eq_(backfill.backfill_stars(None, 'danvk', 'dygraphs'), expected)
+        eq_(len(server.log), 1)
+        eq_(expected[-1][1], 12)
+    finally:
+        fetcher.EventFetcher.per_page = 100
+        server.quota = None
+        shutil.rmtree(tmpdir)
+        backfill.CACHE_FILE = 'issue-tracker-backfill.db'
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+'''Conditional-request (ETag / Last-Modified) cache for GitHub API calls.
+
+GitHub doesn't count "304 Not Modified" responses against the rate limit, so
+re-polling a repo whose issues haven't changed is nearly free if we remember
+the validators from the last response and send them back.
+
+The cache hooks into PyGithub at the connection level, so every request made
+through a Github object benefits, including paginated lists. Responses are
+keyed by host + URL + Authorization header (hashed, so tokens never hit disk)
+and persisted in a SQLite file. Entries which haven't been used for MAX_AGE_SECS
+are pruned, as are the least recently used beyond MAX_ENTRIES.
+
+This relies on PyGithub's Requester letting its connection classes be
+swapped out. If the installed PyGithub doesn't, install() warns and requests
+go uncached.
+'''
+
+from collections import namedtuple
+import hashlib
+import json
+import sqlite3
+import sys
+import threading
+import time
+
+import github.Requester
+
+
+# A cached response. headers is a dict with lower-cased keys.
+CacheEntry = namedtuple('CacheEntry', ['etag', 'last_modified', 'headers', 'body'])
+
+# Entries are dropped once they've gone this long without being stored or revalidated.
+MAX_AGE_SECS = 30 * 24 * 3600
+# At most this many entries are kept; the least recently used go first.
+MAX_ENTRIES = 100000
+# The store is pruned when it's opened and after every this many puts.
+PRUNE_INTERVAL = 1000
+
+
+class ResponseStore(object):
+    '''Persistent key -> CacheEntry mapping backed by a SQLite file.'''
+
+    def __init__(self, path, max_age_secs=MAX_AGE_SECS, max_entries=MAX_ENTRIES,
+                 clock=time.time):
+        self.path = path
+        self.max_age_secs = max_age_secs
+        self.max_entries = max_entries
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.puts = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                headers TEXT,
+                body BLOB,
+                used_at REAL)''')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(responses)')]
+        if 'used_at' not in columns:
+            # a cache file from before entries were pruned; its entries are pruned first
+            self.conn.execute('ALTER TABLE responses ADD COLUMN used_at REAL')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at)')
+        self.conn.commit()
+        self.prune()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                    'SELECT etag, last_modified, headers, body FROM responses WHERE key = ?',
+                    (key,)).fetchone()
+        if not row:
+            return None
+        etag, last_modified, headers, body = row
+        return CacheEntry(etag=etag, last_modified=last_modified,
+                          headers=json.loads(headers), body=bytes(body))
+
+    def put(self, key, entry):
+        with self.lock:
+            self.conn.execute(
+                    'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, entry.etag, entry.last_modified, json.dumps(entry.headers),
+                     sqlite3.Binary(entry.body), self.clock()))
+            self.conn.commit()
+            self.puts += 1
+            due = self.puts % PRUNE_INTERVAL == 0
+        if due:
+            self.prune()
+
+    def touch(self, key):
+        '''Mark an entry as used, e.g. when a 304 revalidates it.'''
+        with self.lock:
+            self.conn.execute('UPDATE responses SET used_at = ? WHERE key = ?',
+                              (self.clock(), key))
+            self.conn.commit()
+
+    def prune(self):
+        '''Drop entries older than max_age_secs, then all but the max_entries newest.
+
+        Returns the number dropped.
+        '''
+        with self.lock:
+            dropped = self.conn.execute(
+                    'DELETE FROM responses WHERE used_at IS NULL OR used_at < ?',
+                    (self.clock() - self.max_age_secs,)).rowcount
+            dropped += self.conn.execute(
+                    'DELETE FROM responses WHERE key NOT IN '
+                    '(SELECT key FROM responses ORDER BY used_at DESC LIMIT ?)',
+                    (self.max_entries,)).rowcount
+            self.conn.commit()
+        return dropped
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class ConditionalCache(object):
+    '''Tracks validators for GET responses and counts cache hits and misses.
+
+    A hit is a 304 served from the cache; a miss is a full 200 response.
+    counts() are this process's totals. Each thread also has counts of its
+    own, so that a fetch can report its hits and misses while other threads
+    fetch other repos.
+    '''
+
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.local = threading.local()
+
+    @staticmethod
+    def key(host, url, authorization):
+        return hashlib.sha1('%s\n%s\n%s' % (host, url, authorization or '')).hexdigest()
+
+    def record_hit(self):
+        with self.lock:
+            self.hits += 1
+        self.local.hits = getattr(self.local, 'hits', 0) + 1
+
+    def record_miss(self):
+        with self.lock:
+            self.misses += 1
+        self.local.misses = getattr(self.local, 'misses', 0) + 1
+
+    def counts(self):
+        '''Returns a (hits, misses) tuple.'''
+        with self.lock:
+            return self.hits, self.misses
+
+    def reset_counts(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+    def thread_counts(self):
+        '''Returns (hits, misses) for this thread since reset_thread_counts.'''
+        return getattr(self.local, 'hits', 0), getattr(self.local, 'misses', 0)
+
+    def reset_thread_counts(self):
+        self.local.hits = 0
+        self.local.misses = 0
+
+
+class CachedResponse(object):
+    '''Mimics the httplib response interface that PyGithub's Requester reads.'''
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self):
+        return self.body
+
+
+def make_connection_class(base_class, cache):
+    '''Subclass a PyGithub connection class to send conditional requests.'''
+
+    class CachingConnection(base_class):
+        def request(self, verb, url, input, headers):
+            self._cache_key = None
+            self._cache_entry = None
+            if verb == 'GET':
+                headers = dict(headers)
+                self._cache_key = cache.key(self.host, url, headers.get('Authorization'))
+                self._cache_entry = cache.store.get(self._cache_key)
+                if self._cache_entry:
+                    if self._cache_entry.etag:
+                        headers['If-None-Match'] = self._cache_entry.etag
+                    if self._cache_entry.last_modified:
+                        headers['If-Modified-Since'] = self._cache_entry.last_modified
+            return base_class.request(self, verb, url, input, headers)
+
+        def getresponse(self):
+            response = base_class.getresponse(self)
+            if not self._cache_key:
+                return response
+
+            headers = dict((k.lower(), v) for k, v in response.getheaders())
+            body = response.read()
+            if isinstance(body, unicode):
+                body = body.encode('utf-8')
+            entry = self._cache_entry
+
+            if response.status == 304 and entry:
+                cache.record_hit()
+                cache.store.touch(self._cache_key)
+                # The 304 carries fresh rate limit headers; everything else is as cached.
+                merged = dict(entry.headers)
+                merged.update(headers)
+                return CachedResponse(200, merged, entry.body)
+
+            if response.status == 200:
+                cache.record_miss()
+                etag = headers.get('etag')
+                last_modified = headers.get('last-modified')
+                if etag or last_modified:
+                    cache.store.put(self._cache_key, CacheEntry(
+                        etag=etag, last_modified=last_modified, headers=headers, body=body))
+            return CachedResponse(response.status, headers, body)
+
+    return CachingConnection
+
+
+_installed = None
+_warned = False
+
+
+def install(path):
+    '''Route all PyGithub requests through a conditional cache stored at path.
+
+    Returns the ConditionalCache. Installing twice returns the existing cache.
+    Returns None, and requests go uncached, if PyGithub has no way to inject
+    connection classes.
+    '''
+    global _installed, _warned
+    if _installed:
+        return _installed
+    requester = github.Requester.Requester
+    if not all(hasattr(requester, name) for name in (
+            'injectConnectionClasses', 'resetConnectionClasses',
+            '_Requester__httpConnectionClass', '_Requester__httpsConnectionClass')):
+        if not _warned:
+            sys.stderr.write('This PyGithub can\'t inject connection classes; '
+                             'GitHub responses won\'t be cached\n')
+            _warned = True
+        return None
+    cache = ConditionalCache(ResponseStore(path))
+    requester.injectConnectionClasses(
+            make_connection_class(requester._Requester__httpConnectionClass, cache),
+            make_connection_class(requester._Requester__httpsConnectionClass, cache))
+    _installed = cache
+    return cache
+
+
+def uninstall():
+    global _installed
+    if _installed:
+        github.Requester.Requester.resetConnectionClasses()
+        _installed.store.close()
+        _installed = None
+
+
+def installed_cache():
+    '''Returns the active ConditionalCache, or None.'''
+    return _installed
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import threading
+
+from nose.tools import eq_
+
+from fake_github import FakeGitHub, make_issue
+import github.Requester
+import httpcache
+import tracker
+
+
+server = None
+tmp_dir = None
+
+
+def setup_module():
+    global server, tmp_dir
+    server = FakeGitHub()
+    server.add_repo('danvk', 'dygraphs', stargazers=12, issues=[
+        make_issue(1, labels=['bug']),
+        make_issue(2, labels=['bug', 'docs']),
+        make_issue(3),
+        make_issue(4, pull=True),
+        make_issue(5, state='closed'),
+    ] + [make_issue(n, labels=['later']) for n in range(6, 70)])
+    server.start()
+    tracker.GITHUB_API_URL = server.url
+    tmp_dir = tempfile.mkdtemp()
+    tracker.HTTP_CACHE_PATH = os.path.join(tmp_dir, 'cache.sqlite')
+
+
+def teardown_module():
+    httpcache.uninstall()
+    tracker.HTTP_CACHE_PATH = None
+    tracker.GITHUB_API_URL = 'https://api.github.com'
+    server.stop()
+    shutil.rmtree(tmp_dir)
+
+
+def test_conditional_requests():
+    stats = tracker.fetch_stats_from_github('danvk', 'dygraphs')
+    cache = httpcache.installed_cache()
+    hits, misses = cache.counts()
+    eq_(hits, 0)
+    eq_(stats.stargazers, 12)
+    eq_(stats.open_issues, 68)
+    eq_(stats.open_pulls, 1)
+    eq_(dict(stats.label_to_count), {'bug': 2, 'docs': 1, '': 2, 'later': 64})
+    eq_(set(server.statuses()), {200})
+
+    # Nothing changed, so every request should be revalidated with a 304.
+    cache.reset_counts()
+    del server.log[:]
+    stats2 = tracker.fetch_stats_from_github('danvk', 'dygraphs')
+    eq_(stats2, stats)
+    eq_(set(server.statuses()), {304})
+    eq_(cache.counts(), (len(server.log), 0))
+
+    # Changing one issue invalidates only the affected pages.
+    server.issues('danvk', 'dygraphs')[2]['labels'] = [{'name': 'docs'}]
+    cache.reset_counts()
+    del server.log[:]
+    stats3 = tracker.fetch_stats_from_github('danvk', 'dygraphs')
+    eq_(stats3.label_to_count['docs'], 2)
+    eq_('' in stats3.label_to_count, True)
+    hits, misses = cache.counts()
+    eq_(misses, 1)
+    eq_(hits, len(server.log) - 1)
+
+
+def test_key_depends_on_token():
+    key = httpcache.ConditionalCache.key
+    eq_(key('api.github.com', '/repos/a/b', 'token x') == key('api.github.com', '/repos/a/b', 'token y'),
+        False)
+
+
+def test_fetches_count_their_own_requests():
+    tracker.fetch_stats_from_github('danvk', 'dygraphs')
+    cache = httpcache.installed_cache()
+    cache.reset_counts()
+    del server.log[:]
+    tracker.fetch_stats_from_github('danvk', 'dygraphs')
+    eq_(cache.thread_counts(), (len(server.log), 0))
+
+    # another thread's fetch doesn't show up in this thread's counts
+    thread = threading.Thread(target=tracker.fetch_stats_from_github, args=('danvk', 'dygraphs'))
+    thread.start()
+    thread.join()
+    eq_(cache.thread_counts(), (len(server.log) / 2, 0))
+    eq_(cache.counts(), (len(server.log), 0))
+
+
+def test_prune():
+    now = [1000.0]
+    store = httpcache.ResponseStore(os.path.join(tmp_dir, 'prune.sqlite'), max_age_secs=100,
+                                    max_entries=2, clock=lambda: now[0])
+    entry = httpcache.CacheEntry(etag='"x"', last_modified=None, headers={}, body='{}')
+    for key in ('a', 'b', 'c'):
+        store.put(key, entry)
+        now[0] += 10
+    store.touch('a')
+    eq_(store.prune(), 1)  # b is the least recently used
+    eq_(store.get('b'), None)
+
+    now[0] += 95
+    eq_(store.prune(), 1)  # c has expired, but a was touched since
+    eq_(store.get('c'), None)
+    eq_(store.get('a'), entry)
+    store.close()
+
+
+def test_install_without_connection_class_injection():
+    requester = github.Requester.Requester
+    inject = requester.__dict__['injectConnectionClasses']
+    httpcache.uninstall()
+    del requester.injectConnectionClasses
+    try:
+        eq_(httpcache.install(tracker.HTTP_CACHE_PATH), None)
+        eq_(httpcache.installed_cache(), None)
+    finally:
+        requester.injectConnectionClasses = inject
+    stats = tracker.fetch_stats_from_github('danvk', 'dygraphs')  # uncached, but it works
+    eq_(stats.stargazers, 12)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""A single-file cache of fetched issues and their events, for backfill.py.
+
+Usage:
+  issuecache.py import <cache_dir> <cache_file>
+
+The import command copies an old-style cache directory (one pretty-printed
+<number>.json file per issue) into a cache file.
+
+Each issue is stored as one row of a SQLite table, keyed by its number and
+holding zlib-compressed JSON of just the fields issue_events and the
+issue/PR split need. Writes happen in a transaction, so an interrupted
+backfill never leaves a partial issue behind, and loading the whole cache is
+a single sequential scan.
+
+The file also holds a backfill's checkpoints: the issues listed so far (in
+the same form, without events) and named JSON values such as the next page
+to list. These are cleared once a backfill finishes.
+"""
+
+import glob
+import json
+import os
+import sqlite3
+import threading
+import zlib
+
+from docopt import docopt
+
+
+def slim_event(event):
+    out = {'event': event['event'], 'created_at': event['created_at']}
+    if 'id' in event:
+        out['id'] = event['id']
+    if event.get('label'):
+        out['label'] = {'name': event['label']['name']}
+    return out
+
+
+def slim_issue(issue):
+    '''Drop everything from an issue's JSON that the backfill doesn't read.'''
+    out = {
+        'number': issue['number'],
+        'state': issue['state'],
+        'created_at': issue['created_at'],
+        'closed_at': issue.get('closed_at'),
+        'labels': [{'name': label['name']} for label in issue['labels']],
+        'events': [slim_event(event) for event in issue.get('events', [])],
+    }
+    if 'pull_request' in issue:
+        out['pull_request'] = {}
+    return out
+
+
+def encode(issue):
+    return zlib.compress(json.dumps(issue, separators=(',', ':')))
+
+
+def decode(data):
+    return json.loads(zlib.decompress(bytes(data)))
+
+
+class IssueCache(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS issues (
+                number INTEGER PRIMARY KEY,
+                data BLOB)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS listed (
+                number INTEGER PRIMARY KEY,
+                data BLOB)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS checkpoints (
+                name TEXT PRIMARY KEY,
+                value TEXT)''')
+        self.conn.commit()
+
+    def numbers(self):
+        '''Returns the set of cached issue numbers.'''
+        with self.lock:
+            return {number for number, in self.conn.execute('SELECT number FROM issues')}
+
+    def load_all(self):
+        '''Returns every cached issue, in number order.'''
+        with self.lock:
+            rows = self.conn.execute('SELECT data FROM issues ORDER BY number').fetchall()
+        return [decode(data) for data, in rows]
+
+    def iter_all(self, batch_size=1000):
+        '''Yields every cached issue, in number order, batch_size rows at a time.'''
+        for number, data in self.iter_raw(batch_size):
+            yield decode(data)
+
+    def iter_raw(self, batch_size=1000):
+        '''Like iter_all, but yields (number, encoded issue) pairs, without decoding.'''
+        last = -1
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                        'SELECT number, data FROM issues WHERE number > ? ORDER BY number LIMIT ?',
+                        (last, batch_size)).fetchall()
+            for number, data in rows:
+                yield number, bytes(data)
+            if len(rows) < batch_size:
+                return
+            last = rows[-1][0]
+
+    def put_many(self, issues):
+        '''Cache (slimmed copies of) a list of issues in one transaction.'''
+        rows = [(issue['number'], sqlite3.Binary(encode(slim_issue(issue))))
+                for issue in issues]
+        with self.lock:
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO issues VALUES (?, ?)', rows)
+
+    def put(self, issue):
+        self.put_many([issue])
+
+    def get_checkpoint(self, name):
+        '''Returns the value saved with set_checkpoint or put_listed, or None.'''
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM checkpoints WHERE name = ?',
+                                    (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_checkpoint(self, name, value):
+        with self.lock:
+            with self.conn:
+                self._set_checkpoint(name, value)
+
+    def _set_checkpoint(self, name, value):
+        self.conn.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?)',
+                          (name, json.dumps(value)))
+
+    def put_listed(self, issues, name, value):
+        '''Record a page of listed issues and a checkpoint, in one transaction.'''
+        rows = [(issue['number'], sqlite3.Binary(encode(slim_issue(dict(issue, events=[])))))
+                for issue in issues]
+        with self.lock:
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO listed VALUES (?, ?)', rows)
+                self._set_checkpoint(name, value)
+
+    def listed_numbers(self):
+        with self.lock:
+            return {number for number, in self.conn.execute('SELECT number FROM listed')}
+
+    def unfetched(self):
+        '''Returns the listed issues which aren't cached yet, without events.'''
+        with self.lock:
+            rows = self.conn.execute('''SELECT listed.data FROM listed
+                    LEFT JOIN issues ON issues.number = listed.number
+                    WHERE issues.number IS NULL ORDER BY listed.number''').fetchall()
+        return [decode(data) for data, in rows]
+
+    def clear_checkpoints(self):
+        with self.lock:
+            with self.conn:
+                self.conn.execute('DELETE FROM listed')
+                self.conn.execute('DELETE FROM checkpoints')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def import_dir(cache_dir, cache, batch_size=1000):
+    '''Copy the <number>.json files in an old cache directory into an IssueCache.'''
+    paths = glob.glob(os.path.join(cache_dir, '*.json'))
+    for i in range(0, len(paths), batch_size):
+        cache.put_many([json.load(open(path)) for path in paths[i:i + batch_size]])
+    return len(paths)
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    cache = IssueCache(arguments['<cache_file>'])
+    num_issues = import_dir(arguments['<cache_dir>'], cache)
+    print 'Imported %d issues into %s' % (num_issues, arguments['<cache_file>'])
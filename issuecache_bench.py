@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Compare backfill cache load times: one JSON file per issue vs issuecache.py.
+
+Usage:
+  issuecache_bench.py [--issues=N] [--events=N] [--dir=DIR] [--drop-caches]
+  issuecache_bench.py measure (dir | file) <path> [--issues=N]
+
+Options:
+  -h --help      Show this screen.
+  --issues=N     Number of synthetic issues [default: 20000].
+  --events=N     Events per issue [default: 8].
+  --dir=DIR      Where to write the caches (a temporary directory by default).
+  --drop-caches  Drop the OS page cache before each cold load. Needs root.
+
+Each cold load runs in a fresh process, which reads the cache the way
+backfill.py does: the old layout checks for and parses each <number>.json,
+while the cache file is read with numbers() and load_all(). The warm load
+repeats the read in the same process.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+import issuecache
+
+
+def make_issue(number, num_events):
+    '''An issue shaped like GitHub's JSON, including fields the backfill ignores.'''
+    user = {'login': 'user%d' % (number % 100), 'id': number % 100,
+            'url': 'https://api.github.com/users/user%d' % (number % 100),
+            'avatar_url': 'https://avatars.githubusercontent.com/u/%d?v=3' % (number % 100)}
+    events = []
+    for i in range(num_events):
+        event = {'id': number * 100 + i, 'actor': user, 'commit_id': None,
+                 'url': 'https://api.github.com/repos/o/r/issues/events/%d' % (number * 100 + i),
+                 'created_at': '2015-%02d-%02dT12:00:00Z' % (1 + i % 12, 1 + number % 28),
+                 'event': 'labeled' if i % 2 == 0 else 'unlabeled',
+                 'label': {'name': 'label-%d' % (i / 2), 'color': 'ededed'}}
+        events.append(event)
+    return {
+        'number': number, 'id': number * 7, 'state': 'closed' if number % 3 else 'open',
+        'title': 'Issue number %d' % number, 'body': 'Some details about the problem. ' * 20,
+        'user': user, 'assignee': None, 'milestone': None, 'locked': False, 'comments': 3,
+        'created_at': '2015-01-01T00:00:00Z', 'updated_at': '2015-06-01T00:00:00Z',
+        'closed_at': '2015-06-01T00:00:00Z' if number % 3 else None,
+        'labels': [], 'events': events,
+        'url': 'https://api.github.com/repos/o/r/issues/%d' % number,
+        'html_url': 'https://github.com/o/r/issues/%d' % number,
+    }
+
+
+def load_dir(path, numbers):
+    issues = []
+    for number in numbers:
+        cache_file = os.path.join(path, '%d.json' % number)
+        if os.path.exists(cache_file):
+            issues.append(json.load(open(cache_file)))
+    return issues
+
+
+def load_file(path, numbers):
+    cache = issuecache.IssueCache(path)
+    cached = cache.numbers()
+    return [issue for issue in cache.load_all() if issue['number'] in cached]
+
+
+def measure(layout, path, num_issues):
+    load = load_dir if layout == 'dir' else load_file
+    numbers = range(1, num_issues + 1)
+    times = []
+    for _ in range(2):
+        start_secs = time.time()
+        issues = load(path, numbers)
+        times.append(time.time() - start_secs)
+    assert len(issues) == num_issues, len(issues)
+    print times[0], times[1]
+
+
+def disk_bytes(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    num_issues = int(arguments['--issues'])
+    if arguments['measure']:
+        measure('dir' if arguments['dir'] else 'file', arguments['<path>'], num_issues)
+        sys.exit(0)
+
+    num_events = int(arguments['--events'])
+    root = arguments['--dir'] or tempfile.mkdtemp()
+    cache_dir = os.path.join(root, 'issues')
+    cache_file = os.path.join(root, 'issues.db')
+    try:
+        os.mkdir(cache_dir)
+        cache = issuecache.IssueCache(cache_file)
+        batch = []
+        for number in range(1, num_issues + 1):
+            issue = make_issue(number, num_events)
+            json.dump(issue, open(os.path.join(cache_dir, '%d.json' % number), 'w'),
+                      indent=2, sort_keys=True)
+            batch.append(issue)
+            if len(batch) == 1000:
+                cache.put_many(batch)
+                batch = []
+        cache.put_many(batch)
+        cache.close()
+
+        for layout, path in (('dir', cache_dir), ('file', cache_file)):
+            if arguments['--drop-caches']:
+                subprocess.check_call('sync && echo 3 > /proc/sys/vm/drop_caches', shell=True)
+            output = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__), 'measure', layout, path,
+                     '--issues=%d' % num_issues])
+            cold, warm = [float(x) for x in output.split()]
+            print '%-4s %9.1f MB  cold load %6.2f secs  warm load %6.2f secs' % (
+                    layout, disk_bytes(path) / 1e6, cold, warm)
+    finally:
+        if not arguments['--dir']:
+            shutil.rmtree(root)
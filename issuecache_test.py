@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import json
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_
+
+from fake_github import make_issue
+import backfill
+import issuecache
+
+
+def make_full_issue(number, **kwargs):
+    issue = make_issue(number, labels=['bug'], events=[
+        {'event': 'labeled', 'created_at': '2015-01-02T00:00:00Z', 'id': 10 + number,
+         'label': {'name': 'bug', 'color': 'f00'}, 'actor': {'login': 'danvk'}},
+    ], **kwargs)
+    issue['body'] = 'A long description ' * 50
+    return issue
+
+
+def test_import_and_load():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cache_dir = os.path.join(tmpdir, 'issues')
+        os.mkdir(cache_dir)
+        issues = [make_full_issue(1), make_full_issue(2, pull=True)]
+        for issue in issues:
+            json.dump(issue, open(os.path.join(cache_dir, '%d.json' % issue['number']), 'w'),
+                      indent=2, sort_keys=True)
+
+        cache = issuecache.IssueCache(os.path.join(tmpdir, 'cache.db'))
+        eq_(issuecache.import_dir(cache_dir, cache), 2)
+        eq_(cache.numbers(), {1, 2})
+
+        loaded = cache.load_all()
+        eq_([issue['number'] for issue in loaded], [1, 2])
+        eq_('body' in loaded[0], False)
+        eq_('pull_request' in loaded[1], True)
+        eq_([backfill.issue_events(issue) for issue in loaded],
+            [backfill.issue_events(issue) for issue in issues])
+        eq_(list(cache.iter_all(batch_size=1)), loaded)
+    finally:
+        shutil.rmtree(tmpdir)
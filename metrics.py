@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+'''In-process counters and timers, exported in Prometheus' text format.
+
+app.py serves REGISTRY.render() at /metrics. What's measured:
+
+- DB queries: count and latency, via SQLAlchemy cursor events (instrument_engine).
+- GitHub API calls: count, latency and the last X-RateLimit-Remaining seen,
+  for both PyGithub (install_pygithub) and requests sessions (requests_hook).
+- Requests to the app itself, per route (see app.py).
+
+Every gunicorn worker keeps its own numbers, so a scrape sees one worker's.
+Each observation is a dict lookup and an addition under a lock, cheap enough
+to leave on; see metrics_bench.py. Set METRICS=0 to turn it all off.
+
+Per-thread tallies of DB and GitHub time (see RequestTally) let each request
+report what it cost, e.g. in the JSON request logs. The number of DB queries
+is counted by db.query_count.
+'''
+
+import bisect
+import os
+import threading
+import time
+
+ENABLED = os.environ.get('METRICS', '1') != '0'
+
+# Upper bounds of the latency histograms' buckets, in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                                            .replace('"', '\\"'))
+                             for name, value in zip(names, values))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}  # tuple of label values --> value
+
+    def samples(self):
+        '''Yields (name suffix, label names, label values, value) tuples.'''
+        with self.lock:
+            items = sorted(self.values.items())
+        for label_values, value in items:
+            yield '', self.labels, label_values, value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, names, values, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, format_labels(names, values),
+                                        format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, label_values=(), amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, label_values=()):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class CallbackMetric(Metric):
+    '''A gauge or counter whose value is read from a function at each scrape.'''
+
+    def __init__(self, name, help, kind, fn):
+        Metric.__init__(self, name, help)
+        self.kind = kind
+        self.fn = fn
+
+    def samples(self):
+        yield '', (), (), self.fn()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, label_values=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                # one count per bucket (not cumulative), one for +Inf, then the sum
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            items = sorted((k, list(v)) for k, v in self.values.iteritems())
+        names = self.labels + ('le',)
+        for label_values, counts in items:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                yield '_bucket', names, label_values + (format_value(bound),), total
+            yield '_sum', self.labels, label_values, counts[-1]
+            yield '_count', self.labels, label_values, total
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, kind, fn):
+        return self.register(CallbackMetric(name, help, kind, fn))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+db_queries = REGISTRY.histogram('db_query_seconds', 'Time taken by DB queries.')
+github_calls = REGISTRY.histogram('github_request_seconds', 'Time taken by GitHub API calls.',
+                                  labels=('client', 'method', 'status'))
+github_rate_limit = REGISTRY.gauge('github_rate_limit_remaining',
+                                   'X-RateLimit-Remaining of the latest GitHub API response.')
+http_requests = REGISTRY.histogram('http_request_seconds', 'Time taken to handle requests.',
+                                   labels=('route', 'method', 'status'))
+
+
+class RequestTally(threading.local):
+    '''Time the current thread has spent on DB queries and GitHub calls since reset().'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.db_secs = 0.0
+        self.github_calls = 0
+        self.github_secs = 0.0
+
+
+tally = RequestTally()
+
+
+def instrument_engine(engine):
+    '''Time every query sent through a SQLAlchemy engine.'''
+    from sqlalchemy import event
+
+    # The start time goes on the execution context, which is dropped along with
+    # it if the query fails (and after_cursor_execute never comes).
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.metrics_query_start = time.time()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def end_query(conn, cursor, statement, parameters, context, executemany):
+        start_secs = getattr(context, 'metrics_query_start', None)
+        if start_secs is None:
+            return
+        elapsed = time.time() - start_secs
+        db_queries.observe(elapsed)
+        tally.db_secs += elapsed
+
+
+def observe_github_call(client, method, status, elapsed, remaining):
+    github_calls.observe(elapsed, (client, method, str(status)))
+    if remaining is not None:
+        github_rate_limit.set(int(remaining))
+    tally.github_calls += 1
+    tally.github_secs += elapsed
+
+
+def requests_hook(response, *args, **kwargs):
+    '''A requests response hook: session.hooks['response'].append(metrics.requests_hook).'''
+    if ENABLED:
+        observe_github_call('requests', response.request.method, response.status_code,
+                            response.elapsed.total_seconds(),
+                            response.headers.get('X-RateLimit-Remaining'))
+    return response
+
+
+def install_pygithub():
+    '''Time every request PyGithub makes. Installing twice has no further effect.'''
+    import github.Requester
+    requester = github.Requester.Requester
+    request_raw = requester._Requester__requestRaw
+    if getattr(request_raw, 'instrumented', False):
+        return
+
+    def timed_request_raw(self, cnx, verb, url, request_headers, input):
+        start_secs = time.time()
+        status = 'error'
+        headers = {}
+        try:
+            status, headers, output = request_raw(self, cnx, verb, url, request_headers, input)
+            return status, headers, output
+        finally:
+            observe_github_call('pygithub', verb, status, time.time() - start_secs,
+                                headers.get('x-ratelimit-remaining'))
+    timed_request_raw.instrumented = True
+    requester._Requester__requestRaw = timed_request_raw
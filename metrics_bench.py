@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""Measure what metrics.py adds to the cost of a request.
+
+Usage:
+  metrics_bench.py [--requests=N] [--runs=N] [--snapshots=N]
+  metrics_bench.py measure <requests>
+
+Options:
+  -h --help       Show this screen.
+  --requests=N    Requests to time per URL [default: 2000].
+  --runs=N        Processes to time each setting with, taking the fastest [default: 3].
+  --snapshots=N   Hourly snapshots to seed the bench/series repo with [default: 720].
+
+METRICS is read at import time, so each setting is timed by a fresh process
+(the measure command), which requests a few URLs through Flask's test client
+and prints the mean milliseconds per request for each. The response cache is
+left on, so the cached page is mostly per-request overhead.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+URLS = [
+    '/bench/series',                       # served from the response cache
+    '/bench/series/json?end=2000-01-02',   # a handful of queries
+    '/metrics',
+]
+
+
+def measure(num_requests):
+    import app
+    client = app.app.test_client()
+    for url in URLS:
+        assert client.get(url).status_code == 200, url  # warm up imports, pools and caches
+        start_secs = time.time()
+        for _ in xrange(num_requests):
+            client.get(url)
+        print '%s %.4f' % (url, (time.time() - start_secs) * 1000 / num_requests)
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    if 'DATABASE_URL' not in os.environ:
+        os.environ['DATABASE_URL'] = 'sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'bench.db')
+    if arguments['measure']:
+        measure(int(arguments['<requests>']))
+        sys.exit(0)
+
+    import db
+    import storage_bench
+
+    if not db.is_repo_tracked('bench', 'series'):
+        db.add_repo('bench', 'series', None)
+        with db.session_scope() as session:
+            repo_id = db.get_repo(session, 'bench', 'series').id
+        labels = list(db.BASE_LABELS) + ['label-%d' % i for i in range(10)]
+        storage_bench.seed_rows(db, repo_id, int(arguments['--snapshots']), labels)
+
+    times = {'0': {}, '1': {}}
+    for _ in range(int(arguments['--runs'])):
+        for setting in ('0', '1'):
+            env = dict(os.environ, METRICS=setting)
+            output = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__), 'measure',
+                     arguments['--requests']], env=env)
+            for line in output.splitlines():
+                url, ms = line.rsplit(' ', 1)
+                times[setting][url] = min(float(ms), times[setting].get(url, float('inf')))
+
+    print '%-40s %10s %10s %10s' % ('url', 'off (ms)', 'on (ms)', 'overhead')
+    for url in URLS:
+        off, on = times['0'][url], times['1'][url]
+        print '%-40s %10.3f %10.3f %9.1f%%' % (url, off, on, 100 * (on - off) / off)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import os
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from nose.tools import eq_
+
+import app
+import db
+from fake_github import FakeGitHub, make_issue
+import metrics
+import tracker
+
+
+def test_render():
+    registry = metrics.Registry()
+    counter = registry.counter('widgets_total', 'Widgets made.', labels=('color',))
+    counter.inc(('red',))
+    counter.inc(('say "hi"',), amount=2)
+    histogram = registry.histogram('wait_seconds', 'Time waited.', buckets=(0.1, 1.0))
+    for secs in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(secs)
+    registry.callback('queue_depth', 'Things waiting.', 'gauge', lambda: 4)
+    eq_(registry.render(), '''\
+# HELP widgets_total Widgets made.
+# TYPE widgets_total counter
+widgets_total{color="red"} 1.0
+widgets_total{color="say \\"hi\\""} 2.0
+# HELP wait_seconds Time waited.
+# TYPE wait_seconds histogram
+wait_seconds_bucket{le="0.1"} 1.0
+wait_seconds_bucket{le="1.0"} 3.0
+wait_seconds_bucket{le="+Inf"} 4.0
+wait_seconds_sum 4.25
+wait_seconds_count 4.0
+# HELP queue_depth Things waiting.
+# TYPE queue_depth gauge
+queue_depth 4.0
+''')
+
+
+def test_github_calls_are_timed():
+    server = FakeGitHub()
+    server.add_repo('danvk', 'timed', stargazers=3, issues=[make_issue(1, labels=['bug'])])
+    server.quota = 100
+    server.start()
+    tracker.GITHUB_API_URL = server.url
+    tracker.GITHUB_GRAPHQL_URL = server.url + '/graphql'
+    try:
+        metrics.tally.reset()
+        tracker.fetch_stats_from_github('danvk', 'timed', 'token', mode=tracker.PAGING_MODE)
+        eq_(metrics.tally.github_calls, len(server.log))
+        calls = len(server.log)
+        tracker.fetch_stats_from_github('danvk', 'timed', 'token', mode=tracker.AGGREGATE_MODE)
+        eq_(metrics.tally.github_calls, len(server.log))
+    finally:
+        tracker.GITHUB_API_URL = 'https://api.github.com'
+        tracker.GITHUB_GRAPHQL_URL = tracker.GITHUB_API_URL + '/graphql'
+        server.stop()
+    # the quota counts down with each call
+    assert 90 <= metrics.github_rate_limit.values[()] < 100
+    text = metrics.REGISTRY.render()
+    assert 'github_request_seconds_count{client="pygithub",method="GET",status="200"}' in text
+    assert 'github_request_seconds_count{client="requests",method="POST",status="200"}' in text
+    assert calls < len(server.log)
+
+
+def test_requests_are_timed():
+    db.add_repo('danvk', 'metered', 'token')
+    client = app.app.test_client()
+    json_requests = ('/<owner>/<repo>/json', 'GET', '200')
+    before = list(metrics.http_requests.values.get(json_requests, [0]))
+    before_queries = sum(metrics.db_queries.values.get((), [0])[:-1])
+    response = client.get('/danvk/metered/json')
+    eq_(response.status_code, 200)
+    eq_(sum(metrics.db_queries.values[()][:-1]),
+        before_queries + int(response.headers['X-DB-Queries']))
+    eq_(sum(metrics.http_requests.values[json_requests][:-1]), sum(before[:-1]) + 1)
+
+    response = client.get('/metrics')
+    eq_(response.mimetype, 'text/plain')
+    lines = response.data.splitlines()
+    assert any(line.startswith('http_request_seconds_count{route="/<owner>/<repo>/json"')
+               for line in lines)
+    assert any(line.startswith('db_query_seconds_count ') for line in lines)
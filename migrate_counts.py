@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""Copy counts from the rows layout (counts_by_label) to the wide layout (snapshots).
+
+Usage:
+  migrate_counts.py [<owner/repo>...] [--batch-size=N]
+
+Options:
+  -h --help       Show this screen.
+  --batch-size=N  Number of snapshots to insert per statement [default: 1000].
+
+With no repos listed, every tracked repo is migrated. Each repo is migrated in
+a single transaction which replaces any snapshots it already has, so this is
+safe to re-run. Set COUNTS_LAYOUT=wide once it's done.
+"""
+
+import time
+
+from docopt import docopt
+
+import db
+
+
+def iter_snapshots(session, repo_id):
+    '''Yields (time, dict of label --> count), in time order, from counts_by_label.'''
+    rows = (session.query(db.CountsByLabel.time, db.CountsByLabel.label, db.CountsByLabel.count)
+                   .filter(db.CountsByLabel.repo_id == repo_id)
+                   .order_by(db.CountsByLabel.time)
+                   .yield_per(10000))
+    current_time = None
+    label_to_count = {}
+    for t, label, count in rows:
+        if t != current_time:
+            if label_to_count:
+                yield current_time, label_to_count
+            current_time = t
+            label_to_count = {}
+        label_to_count[label] = count
+    if label_to_count:
+        yield current_time, label_to_count
+
+
+def migrate_repo(repo, batch_size):
+    start_secs = time.time()
+    # The rows are read on a session of their own, so the inserts don't
+    # interrupt the cursor.
+    session = db.Session()
+    reader = db.make_session()
+    try:
+        session.query(db.Snapshots).filter(db.Snapshots.repo_id == repo.id).delete()
+
+        num_rows = 0
+        batch = []
+        for t, label_to_count in iter_snapshots(reader, repo.id):
+            num_rows += len(label_to_count)
+            batch.append({'repo_id': repo.id, 'time': t,
+                          'counts': db.encode_counts(label_to_count)})
+            if len(batch) >= batch_size:
+                session.execute(db.Snapshots.__table__.insert(), batch)
+                batch = []
+        if batch:
+            session.execute(db.Snapshots.__table__.insert(), batch)
+        session.commit()
+    finally:
+        reader.close()
+        session.close()
+
+    print 'Migrated %d rows for %s/%s in %f secs' % (
+            num_rows, repo.owner, repo.repo, time.time() - start_secs)
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    repos = list(db.tracked_repos())
+    if arguments['<owner/repo>']:
+        wanted = set(arguments['<owner/repo>'])
+        repos = [r for r in repos if '%s/%s' % (r.owner, r.repo) in wanted]
+    for repo in repos:
+        migrate_repo(repo, int(arguments['--batch-size']))
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""Create any indexes declared in db.py which the database doesn't have yet.
+
+Usage:
+  migrate_indexes.py
+
+Options:
+  -h --help       Show this screen.
+
+New tables get their indexes when they're created, but an index added to an
+existing table needs this to be run once after deploying. On Postgres the
+indexes are built with CREATE INDEX CONCURRENTLY, so the app and update.py can
+keep writing while it runs. It's safe to re-run: existing indexes are skipped.
+"""
+
+import time
+
+from docopt import docopt
+
+import db
+
+
+if __name__ == '__main__':
+    docopt(__doc__)
+    start_secs = time.time()
+    created = db.create_missing_indexes()
+    for name in created:
+        print 'Created %s' % name
+    print 'Created %d indexes in %f secs' % (len(created), time.time() - start_secs)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+'''Cache of rendered stats pages and JSON, shared by the views in app.py.
+
+A repo's series only change when update.py or a backfill writes to it, which
+happens a few times a day, but every page view used to re-read and re-format
+its whole history. Entries are keyed by the repo, its version in db (which
+every write bumps) and the request's query string, so a write in any process
+makes the old entries unreachable. Writes in this process also evict the
+repo's entries right away, via db.WRITE_HOOKS.
+
+There are two backends, both LRU with a cap on the total size of the bodies:
+
+- MemoryBackend: a dict in this process. The default.
+- SQLiteBackend: a SQLite file which every gunicorn worker on a machine can
+  share. Used if RESPONSE_CACHE_PATH is set.
+'''
+
+from collections import OrderedDict, namedtuple
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MB', 64)) * 1024 * 1024
+
+# body is the encoded response; etag is a hash of it.
+Entry = namedtuple('Entry', ['etag', 'mimetype', 'body'])
+
+
+def make_key(owner, repo, version, variant):
+    '''variant distinguishes the views and query strings of a single repo.'''
+    return '%s/%s@%s %s' % (owner, repo, version, variant)
+
+
+def make_entry(mimetype, body):
+    return Entry(etag=hashlib.sha1(body).hexdigest(), mimetype=mimetype, body=body)
+
+
+class MemoryBackend(object):
+    '''LRU cache in this process's memory.'''
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.entries = OrderedDict()  # key --> (repo, Entry), least recently used first
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None:
+                return None
+            self.entries[key] = value
+            return value[1]
+
+    def put(self, key, repo, entry):
+        if len(entry.body) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.num_bytes -= len(old[1].body)
+            self.entries[key] = (repo, entry)
+            self.num_bytes += len(entry.body)
+            while self.num_bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.num_bytes -= len(evicted.body)
+
+    def invalidate(self, repo):
+        with self.lock:
+            for key, (entry_repo, entry) in self.entries.items():
+                if entry_repo == repo:
+                    del self.entries[key]
+                    self.num_bytes -= len(entry.body)
+
+
+class SQLiteBackend(object):
+    '''LRU cache in a SQLite file, which several processes can share.'''
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                repo TEXT,
+                etag TEXT,
+                mimetype TEXT,
+                body BLOB,
+                size INTEGER,
+                used REAL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        self.conn.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                    'SELECT etag, mimetype, body FROM responses WHERE key = ?', (key,)).fetchone()
+            if not row:
+                return None
+            self.conn.execute('UPDATE responses SET used = ? WHERE key = ?', (time.time(), key))
+            self.conn.commit()
+        etag, mimetype, body = row
+        return Entry(etag=etag, mimetype=mimetype, body=bytes(body))
+
+    def put(self, key, repo, entry):
+        if len(entry.body) > self.max_bytes:
+            return
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (key, repo, entry.etag, entry.mimetype,
+                               sqlite3.Binary(entry.body), len(entry.body), time.time()))
+            num_bytes, = self.conn.execute('SELECT SUM(size) FROM responses').fetchone()
+            if num_bytes > self.max_bytes:
+                evict = []
+                for old_key, size in self.conn.execute(
+                        'SELECT key, size FROM responses ORDER BY used'):
+                    if num_bytes <= self.max_bytes:
+                        break
+                    evict.append((old_key,))
+                    num_bytes -= size
+                self.conn.executemany('DELETE FROM responses WHERE key = ?', evict)
+            self.conn.commit()
+
+    def invalidate(self, repo):
+        with self.lock:
+            self.conn.execute('DELETE FROM responses WHERE repo = ?', (repo,))
+            self.conn.commit()
+
+
+def make_backend():
+    path = os.environ.get('RESPONSE_CACHE_PATH')
+    if path:
+        return SQLiteBackend(path)
+    return MemoryBackend()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import os
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from datetime import datetime
+import json
+import shutil
+import tempfile
+
+from nose.tools import eq_
+
+import app
+import db
+import responsecache
+import tracker
+
+
+def entry(body):
+    return responsecache.make_entry('application/json', body)
+
+
+def check_backend(backend):
+    backend.put('a', 'danvk/a', entry('x' * 4))
+    backend.put('b', 'danvk/b', entry('y' * 4))
+    eq_(backend.get('a').body, 'xxxx')  # now b is the least recently used
+    backend.put('c', 'danvk/a', entry('z' * 4))
+    eq_(backend.get('b'), None)
+    eq_(backend.get('c').etag, entry('zzzz').etag)
+
+    backend.invalidate('danvk/a')
+    eq_(backend.get('a'), None)
+    eq_(backend.get('c'), None)
+
+
+def test_memory_backend():
+    check_backend(responsecache.MemoryBackend(max_bytes=10))
+
+
+def test_sqlite_backend():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        check_backend(responsecache.SQLiteBackend(os.path.join(tmpdir, 'cache.db'),
+                                                  max_bytes=10))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_stats_json_cache():
+    db.add_repo('danvk', 'cached', 'token')
+    db.store_results([('danvk', 'cached', tracker.RepoStats(10, 5, 1, {}), datetime(2015, 1, 1))])
+    client = app.app.test_client()
+
+    first = client.get('/danvk/cached/json')
+    eq_(first.status_code, 200)
+    etag = first.headers['ETag']
+    eq_(client.get('/danvk/cached/json', headers={'If-None-Match': etag}).status_code, 304)
+
+    db.store_results([('danvk', 'cached', tracker.RepoStats(11, 5, 1, {}), datetime(2015, 1, 2))])
+    second = client.get('/danvk/cached/json', headers={'If-None-Match': etag})
+    eq_(second.status_code, 200)
+    eq_(len(json.loads(second.data)['stargazers']), 2)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Measure dashboard and JSON endpoint latency over synthetic history.
+
+Usage:
+  series_bench.py [--days=N] [--labels=N] [--requests=N] [--layout=LAYOUT] [--no-cache]
+
+Options:
+  -h --help        Show this screen.
+  --days=N         Days of daily history to seed [default: 3650].
+  --labels=N       Labels per day, including the three base series [default: 100].
+  --requests=N     Requests to time per endpoint [default: 50].
+  --layout=LAYOUT  Counts layout to seed and read, rows or wide [default: rows].
+  --no-cache       Disable the response cache, to time the database reads.
+
+This adds a repo named bench/series to the database in DATABASE_URL (SQLite
+or Postgres), so point it at a scratch database. If DATABASE_URL isn't set, a
+temporary SQLite file is used.
+"""
+
+import os
+import tempfile
+import time
+
+from docopt import docopt
+
+
+def time_requests(client, url, num_requests):
+    latencies = []
+    for _ in range(num_requests):
+        start_secs = time.time()
+        response = client.get(url)
+        latencies.append(time.time() - start_secs)
+        assert response.status_code == 200, response.status_code
+    return latencies, len(response.data)
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    if 'DATABASE_URL' not in os.environ:
+        os.environ['DATABASE_URL'] = 'sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'bench.db')
+    import app
+    import db
+    import responsecache
+    import storage_bench
+    from update import percentile
+
+    db.COUNTS_LAYOUT = arguments['--layout']
+    num_days = int(arguments['--days'])
+    num_labels = int(arguments['--labels'])
+
+    if not db.is_repo_tracked('bench', 'series'):
+        db.add_repo('bench', 'series', None)
+        with db.session_scope() as session:
+            repo_id = db.get_repo(session, 'bench', 'series').id
+        labels = list(db.BASE_LABELS) + ['label-%d' % i for i in range(num_labels - 3)]
+        seed = (storage_bench.seed_wide if db.COUNTS_LAYOUT == db.WIDE_LAYOUT
+                else storage_bench.seed_rows)
+        seed(db, repo_id, num_days, labels)
+
+    if arguments['--no-cache']:
+        app.response_cache = responsecache.MemoryBackend(max_bytes=0)
+
+    client = app.app.test_client()
+    # The page and its one data request, which is served from the stored
+    # dashboard. Any other query (here, a start) pivots the series.
+    for name, url in [('page', '/bench/series'),
+                      ('dashboard', '/bench/series/json?' + app.DASHBOARD_QUERY),
+                      ('json', '/bench/series/json'),
+                      ('json+labels', '/bench/series/json?include_labels=True&start=1970-01-01')]:
+        latencies, size = time_requests(client, url, int(arguments['--requests']))
+        print '%-12s p50=%.4f secs  p99=%.4f secs  (%d bytes)' % (
+                name, percentile(latencies, 50), percentile(latencies, 99), size)
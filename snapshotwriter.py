@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+'''Coalesce snapshot writes from many repos into a few transactions.
+
+Storing one repo's snapshot is a transaction of its own, and most of its cost
+is per transaction rather than per row. A SnapshotWriter queues snapshots from
+any number of threads. A background thread stores whatever is waiting with
+db.store_results, in one transaction and one multi-row insert, once max_rows
+snapshots are queued or the oldest has waited max_delay_ms.
+
+    writer = SnapshotWriter(max_rows=100, max_delay_ms=500)
+    writer.put(owner, repo, stats)             # returns at once
+    writer.put(owner, repo, stats, wait=True)  # returns once it's stored
+    writer.close()                             # stores everything still queued
+
+metrics() reports the queue depth and how long flushes take.
+'''
+
+from collections import deque
+from datetime import datetime
+import sys
+import threading
+import time
+import traceback
+
+import db
+
+
+class StoreError(Exception):
+    pass
+
+
+class SnapshotWriter(object):
+    def __init__(self, store=db.store_results, max_rows=100, max_delay_ms=500,
+                 clock=time.time):
+        '''store is called with lists of (owner, repo, tracker.RepoStats, time) tuples.'''
+        self.store = store
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000.0
+        self.clock = clock
+        self.changed = threading.Condition()
+        self.pending = []
+        self.oldest = None  # when the oldest pending snapshot was queued
+        self.queued = 0  # snapshots queued, ever
+        self.done = 0  # snapshots stored (or which failed to be), ever
+        self.flush_to = 0  # write everything up to this count without waiting
+        self.failed = deque(maxlen=100)  # [start, end) ranges of the counts which failed
+        self.closed = False
+        self.thread = None
+        self.max_queue_depth = 0
+        self.flushes = 0
+        self.errors = 0
+        self.flush_secs_total = 0.0
+        self.flush_secs_max = 0.0
+        self.last_flush_secs = 0.0
+
+    def put(self, owner, repo, stats, t=None, wait=False):
+        '''Queue a snapshot of a repo's tracker.RepoStats, taken at t (default now).
+
+        With wait set, this returns once the snapshot has been stored, along
+        with whatever else was queued by then, and raises StoreError if it
+        couldn't be.
+        '''
+        self.put_many([(owner, repo, stats, t or datetime.utcnow())], wait=wait)
+
+    def put_many(self, results, wait=False):
+        '''Queue a list of (owner, repo, tracker.RepoStats, time) tuples.'''
+        with self.changed:
+            if self.closed:
+                raise ValueError('SnapshotWriter is closed')
+            if self.thread is None:
+                # started on first use, so that a writer made before a fork works in the child
+                self.thread = threading.Thread(target=self.run, name='SnapshotWriter')
+                self.thread.daemon = True
+                self.thread.start()
+            if not self.pending:
+                self.oldest = self.clock()
+            self.pending.extend(results)
+            first = self.queued
+            self.queued += len(results)
+            last = self.queued
+            self.max_queue_depth = max(self.max_queue_depth, len(self.pending))
+            self.changed.notify_all()
+            if wait:
+                self.wait_for(last)
+                if any(start < last and first < end for start, end in self.failed):
+                    raise StoreError('Unable to store snapshots of %s' % ', '.join(
+                            '%s/%s' % (owner, repo) for owner, repo, _, _ in results))
+
+    def flush(self):
+        '''Store everything queued so far, without waiting for more.'''
+        with self.changed:
+            self.flush_to = self.queued
+            self.changed.notify_all()
+            self.wait_for(self.queued)
+
+    def close(self):
+        '''Store everything still queued, then stop the background thread.'''
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+        if self.thread:
+            self.thread.join()
+
+    def wait_for(self, count):
+        while self.done < count:
+            self.changed.wait()
+
+    def next_batch(self):
+        '''Returns the next batch to store, waiting until one is due, or None once closed.'''
+        with self.changed:
+            while True:
+                if self.pending:
+                    wait_secs = self.oldest + self.max_delay - self.clock()
+                    if (len(self.pending) >= self.max_rows or wait_secs <= 0 or
+                            self.closed or self.flush_to > self.done):
+                        batch = self.pending[:self.max_rows]
+                        del self.pending[:self.max_rows]
+                        if not self.pending:
+                            self.oldest = None
+                        return batch
+                    self.changed.wait(wait_secs)
+                elif self.closed:
+                    return None
+                else:
+                    self.changed.wait()
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            start_secs = self.clock()
+            try:
+                self.store(batch)
+                failed = False
+            except Exception:
+                sys.stderr.write('Unable to store %d snapshots:\n%s' % (
+                        len(batch), traceback.format_exc()))
+                failed = True
+            elapsed = self.clock() - start_secs
+            with self.changed:
+                if failed:
+                    self.failed.append((self.done, self.done + len(batch)))
+                self.done += len(batch)
+                self.flushes += 1
+                self.errors += failed
+                self.flush_secs_total += elapsed
+                self.flush_secs_max = max(self.flush_secs_max, elapsed)
+                self.last_flush_secs = elapsed
+                self.changed.notify_all()
+
+    def metrics(self):
+        '''Returns a dict of the writer's counters and gauges.'''
+        with self.changed:
+            return {
+                'queue_depth': len(self.pending),
+                'max_queue_depth': self.max_queue_depth,
+                'snapshots_queued': self.queued,
+                'snapshots_done': self.done,
+                'flushes': self.flushes,
+                'flush_errors': self.errors,
+                'flush_secs_total': self.flush_secs_total,
+                'flush_secs_max': self.flush_secs_max,
+                'last_flush_secs': self.last_flush_secs,
+            }
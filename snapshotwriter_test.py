@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+import os
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from datetime import datetime
+
+from nose.tools import eq_
+
+import db
+import snapshotwriter
+import tracker
+
+
+def test_batches_by_size_and_stores_the_rest_on_close():
+    batches = []
+    writer = snapshotwriter.SnapshotWriter(store=batches.append, max_rows=2,
+                                           max_delay_ms=60000)
+    for i in range(5):
+        writer.put('danvk', 'repo%d' % i, tracker.RepoStats(i, 0, 0, {}))
+    writer.close()
+    eq_([len(batch) for batch in batches], [2, 2, 1])
+    eq_([repo for batch in batches for _, repo, _, _ in batch],
+        ['repo%d' % i for i in range(5)])
+    metrics = writer.metrics()
+    eq_((metrics['queue_depth'], metrics['snapshots_done'], metrics['flushes']), (0, 5, 3))
+
+
+def test_put_can_wait_until_stored():
+    batches = []
+    writer = snapshotwriter.SnapshotWriter(store=batches.append, max_delay_ms=10)
+    writer.put('danvk', 'waited', tracker.RepoStats(1, 0, 0, {}), wait=True)
+    eq_(len(batches), 1)
+    writer.close()
+
+
+def test_failed_store_is_reported_to_waiters():
+    calls = []
+
+    def store(batch):
+        calls.append(batch)
+        if len(calls) == 1:
+            raise IOError('database is down')
+
+    writer = snapshotwriter.SnapshotWriter(store=store, max_delay_ms=0)
+    try:
+        writer.put('danvk', 'failed', tracker.RepoStats(1, 0, 0, {}), wait=True)
+        assert False, 'Expected a StoreError'
+    except snapshotwriter.StoreError:
+        pass
+    writer.put('danvk', 'stored', tracker.RepoStats(1, 0, 0, {}), wait=True)
+    writer.close()
+    eq_(writer.metrics()['flush_errors'], 1)
+    eq_(len(calls), 2)
+
+
+def test_writer_stores_like_store_results():
+    results = [
+        (tracker.RepoStats(10, 5, 1, {'bug': 3, '': 2}), datetime(2015, 1, 1)),
+        (tracker.RepoStats(11, 4, 2, {'bug': 2}), datetime(2015, 1, 2)),
+    ]
+    db.add_repo('danvk', 'direct', 'token')
+    db.add_repo('danvk', 'written', 'token')
+    db.store_results([('danvk', 'direct', stats, t) for stats, t in results])
+
+    writer = snapshotwriter.SnapshotWriter(max_delay_ms=60000)
+    for stats, t in results:
+        writer.put('danvk', 'written', stats, t)
+    writer.flush()
+    eq_(writer.metrics()['flushes'], 1)
+    writer.close()
+    eq_(db.get_stats_series('danvk', 'written', include_labels=True),
+        db.get_stats_series('danvk', 'direct', include_labels=True))
@@ -2,10 +2,6 @@
 
 function firstColumnToDate(row) { row[0] = new Date(row[0]); }
 
-issues_by_day.forEach(firstColumnToDate);
-pulls_by_day.forEach(firstColumnToDate);
-stars_by_day.forEach(firstColumnToDate);
-
 function extend(obj, new_attrs) {
   var out = {};
   for (var k in obj) {
@@ -34,29 +30,35 @@ var BASE_CHART_OPTIONS = {
   }
 };
 
-var g_stars = new Dygraph('stars', stars_by_day,
-    extend(BASE_CHART_OPTIONS, {
-      labels: ['Date', 'Stargazers'],
-      fillGraph: true
-    }));
-
-var g_open_issues = new Dygraph('issues', issues_by_day,
-    extend(BASE_CHART_OPTIONS, {
-      labels: ['Date', 'Open Issues'],
-      fillGraph: true
-    }));
-
-var g_pulls = new Dygraph('pulls', pulls_by_day,
-    extend(BASE_CHART_OPTIONS, {
-      labels: ['Date', 'Open Pull Requests'],
-      fillGraph: true
-    }));
-
 function labelUrl(label) {
   return 'https://github.com/' + owner + '/' + repo + '/labels/' + label;
 }
 
-$.getJSON(window.location + '/json?include_labels=True').then(function(data) {
+// Everything comes from one request for the precomputed dashboard payload
+// (see app.DASHBOARD_QUERY).
+$.getJSON(window.location + '/json?' + dashboardQuery).then(function(data) {
+  data.open_issues.forEach(firstColumnToDate);
+  data.open_pulls.forEach(firstColumnToDate);
+  data.stargazers.forEach(firstColumnToDate);
+
+  var g_stars = new Dygraph('stars', data.stargazers,
+      extend(BASE_CHART_OPTIONS, {
+        labels: ['Date', 'Stargazers'],
+        fillGraph: true
+      }));
+
+  var g_open_issues = new Dygraph('issues', data.open_issues,
+      extend(BASE_CHART_OPTIONS, {
+        labels: ['Date', 'Open Issues'],
+        fillGraph: true
+      }));
+
+  var g_pulls = new Dygraph('pulls', data.open_pulls,
+      extend(BASE_CHART_OPTIONS, {
+        labels: ['Date', 'Open Pull Requests'],
+        fillGraph: true
+      }));
+
   $('#labels-loading-message').hide();
   $('#labels-charts').show();
 
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Compare the write and read cost of the rows and wide count layouts.
+
+Usage:
+  storage_bench.py [--rows=N] [--labels=N] [--polls=N] [--reads=N]
+
+Options:
+  -h --help   Show this screen.
+  --rows=N    Number of (label, time) counts to seed in each layout [default: 10000000].
+  --labels=N  Labels per snapshot, including the three base series [default: 100].
+  --polls=N   Number of store_result calls to time in each layout [default: 50].
+  --reads=N   Number of get_stats_series calls to time in each layout [default: 5].
+
+This adds repos named bench/rows and bench/wide to the database in
+DATABASE_URL, so point it at a scratch database. If DATABASE_URL isn't set, a
+temporary SQLite file is used.
+"""
+
+from datetime import datetime, timedelta
+import os
+import random
+import tempfile
+import time
+
+from docopt import docopt
+
+
+def timed(fn, *args):
+    start_secs = time.time()
+    fn(*args)
+    return time.time() - start_secs
+
+
+def seed_rows(db, repo_id, num_snapshots, labels):
+    batch = []
+    start = datetime(2000, 1, 1)
+    for i in xrange(num_snapshots):
+        t = start + timedelta(hours=i)
+        for label in labels:
+            batch.append({'repo_id': repo_id, 'label': label, 'time': t,
+                          'count': random.randint(0, 500)})
+        if len(batch) >= 10000:
+            db.engine.execute(db.CountsByLabel.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.engine.execute(db.CountsByLabel.__table__.insert(), batch)
+
+
+def seed_wide(db, repo_id, num_snapshots, labels):
+    ids = db.label_ids(labels).values()
+    batch = []
+    start = datetime(2000, 1, 1)
+    for i in xrange(num_snapshots):
+        t = start + timedelta(hours=i)
+        counts = db.pack_counts({label_id: random.randint(0, 500) for label_id in ids})
+        batch.append({'repo_id': repo_id, 'time': t, 'counts': counts})
+        if len(batch) >= 1000:
+            db.engine.execute(db.Snapshots.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.engine.execute(db.Snapshots.__table__.insert(), batch)
+
+
+def median(values):
+    return sorted(values)[len(values) / 2]
+
+
+def run(db, tracker, layout, num_rows, num_labels, num_polls, num_reads):
+    db.COUNTS_LAYOUT = layout
+    repo_name = layout
+    if not db.is_repo_tracked('bench', repo_name):
+        db.add_repo('bench', repo_name, None)
+    with db.session_scope() as session:
+        repo_id = db.get_repo(session, 'bench', repo_name).id
+
+    labels = list(db.BASE_LABELS) + ['label-%d' % i for i in range(num_labels - 3)]
+    num_snapshots = num_rows / num_labels
+    seed = seed_wide if layout == db.WIDE_LAYOUT else seed_rows
+    seed_secs = timed(seed, db, repo_id, num_snapshots, labels)
+
+    stats = tracker.RepoStats(stargazers=1, open_issues=2, open_pulls=3,
+                              label_to_count={label: 1 for label in labels[3:]})
+    poll_secs = [timed(db.store_result, 'bench', repo_name, stats) for _ in range(num_polls)]
+    base_secs = [timed(db.get_stats_series, 'bench', repo_name, False) for _ in range(num_reads)]
+    label_secs = [timed(db.get_stats_series, 'bench', repo_name, True) for _ in range(num_reads)]
+
+    print '%-5s  seed %9d rows: %8.1f secs (%8.0f rows/sec)' % (
+            layout, num_snapshots * num_labels, seed_secs,
+            num_snapshots * num_labels / seed_secs)
+    print '%-5s  store_result:            median %8.4f secs' % (layout, median(poll_secs))
+    print '%-5s  get_stats_series:        median %8.4f secs' % (layout, median(base_secs))
+    print '%-5s  get_stats_series+labels: median %8.4f secs' % (layout, median(label_secs))
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    if 'DATABASE_URL' not in os.environ:
+        os.environ['DATABASE_URL'] = 'sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'bench.db')
+    import db
+    import tracker
+
+    for layout in (db.ROWS_LAYOUT, db.WIDE_LAYOUT):
+        run(db, tracker, layout,
+            num_rows=int(arguments['--rows']),
+            num_labels=int(arguments['--labels']),
+            num_polls=int(arguments['--polls']),
+            num_reads=int(arguments['--reads']))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""Compare the peak memory of buffered and streamed /json responses.
+
+Usage:
+  stream_bench.py [--days=N] [--labels=N] [--layout=LAYOUT]
+  stream_bench.py measure <url>
+
+Options:
+  -h --help        Show this screen.
+  --days=N         Days of daily history to seed [default: 3650].
+  --labels=N       Labels per day, including the three base series [default: 100].
+  --layout=LAYOUT  Counts layout to seed and read, rows or wide [default: rows].
+
+Peak RSS only ever goes up, so each request is made by a fresh process
+(the measure command), which reports how much its peak grew while serving and
+reading the response. Like series_bench.py, this adds a bench/series repo to
+the database in DATABASE_URL, or to a temporary SQLite file.
+"""
+
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+from docopt import docopt
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(url):
+    '''Request url and print (peak RSS growth in KB, response bytes).'''
+    import app
+    app.response_cache = app.responsecache.MemoryBackend(max_bytes=0)
+    client = app.app.test_client()
+    client.get('/bench/series/json?include_labels=1&end=2000-01-02')  # warm up imports and pools
+
+    before_kb = max_rss_kb()
+    response = client.get(url, buffered=False)
+    num_bytes = 0
+    for chunk in response.response:
+        num_bytes += len(chunk)
+    assert response.status_code == 200, response.status_code
+    print max_rss_kb() - before_kb, num_bytes
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    if 'DATABASE_URL' not in os.environ:
+        os.environ['DATABASE_URL'] = 'sqlite:///%s' % os.path.join(tempfile.mkdtemp(), 'bench.db')
+    if arguments['measure']:
+        measure(arguments['<url>'])
+        sys.exit(0)
+
+    import db
+    import storage_bench
+
+    db.COUNTS_LAYOUT = arguments['--layout']
+    num_labels = int(arguments['--labels'])
+    if not db.is_repo_tracked('bench', 'series'):
+        db.add_repo('bench', 'series', None)
+        with db.session_scope() as session:
+            repo_id = db.get_repo(session, 'bench', 'series').id
+        labels = list(db.BASE_LABELS) + ['label-%d' % i for i in range(num_labels - 3)]
+        seed = (storage_bench.seed_wide if db.COUNTS_LAYOUT == db.WIDE_LAYOUT
+                else storage_bench.seed_rows)
+        seed(db, repo_id, int(arguments['--days']), labels)
+
+    env = dict(os.environ, COUNTS_LAYOUT=db.COUNTS_LAYOUT)
+    for name, url in [('buffered', '/bench/series/json?include_labels=1'),
+                      ('streamed', '/bench/series/json?include_labels=1&stream=1')]:
+        output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), 'measure', url], env=env)
+        growth_kb, num_bytes = output.split()[-2:]
+        print '%-9s peak RSS growth: %8.1f MB  (%d bytes)' % (
+                name, int(growth_kb) / 1024.0, int(num_bytes))
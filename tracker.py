@@ -1,14 +1,48 @@
 #!/usr/bin/env python
 
 from github import Github
+import requests
 
 import os
 import time
 from collections import namedtuple, defaultdict
+from datetime import datetime, timedelta
+
+import httpcache
+import metrics
+
+if metrics.ENABLED:
+    metrics.install_pygithub()
 
 OWNER = 'danvk'
 REPO = 'dygraphs'
 
+GITHUB_API_URL = os.environ.get('GITHUB_API_URL', 'https://api.github.com')
+
+GITHUB_GRAPHQL_URL = os.environ.get('GITHUB_GRAPHQL_URL', GITHUB_API_URL + '/graphql')
+
+# How to gather stats for a repo:
+# - paging: list every open issue and PR (the default; works without a token).
+# - aggregate: ask GraphQL for per-label totals, plus one search for unlabeled
+#   issues. A handful of requests, regardless of the number of open issues.
+# - incremental: remember every open issue's labels and only fetch issues which
+#   have been updated since the last poll. See fetch_incremental_stats.
+# - webhook: like incremental, but GitHub pushes changes to /<owner>/<repo>/webhook
+#   as they happen (see webhooks.py). Polls read the live counts this keeps,
+#   and only go to GitHub to reconcile them.
+PAGING_MODE = 'paging'
+AGGREGATE_MODE = 'aggregate'
+INCREMENTAL_MODE = 'incremental'
+WEBHOOK_MODE = 'webhook'
+FETCH_MODES = (PAGING_MODE, AGGREGATE_MODE, INCREMENTAL_MODE, WEBHOOK_MODE)
+
+# Incremental polls ask for issues updated a bit before the previous poll
+# started, to allow for clock skew. Re-reading an issue is harmless.
+SINCE_OVERLAP = timedelta(minutes=5)
+
+# If set, GitHub responses are cached here and revalidated with conditional requests.
+HTTP_CACHE_PATH = os.environ.get('HTTP_CACHE_PATH')
+
 
 # Records statistics about the repo at a particular instant in time.
 RepoStats = namedtuple('RepoStats',
@@ -20,19 +54,40 @@ RepoStats = namedtuple('RepoStats',
         ])
 
 
-def get_github():
-    token = os.environ.get('GITHUB_TOKEN')
+def get_token(token=None):
+    if not token:
+        token = os.environ.get('GITHUB_TOKEN')
     if not token and os.path.exists('.github-token'):
         token = open('.github-token').read().strip()
+    return token
+
+
+def get_github(token=None):
+    if HTTP_CACHE_PATH:
+        httpcache.install(HTTP_CACHE_PATH)
+    token = get_token(token)
     if token:
-        return Github(token)
+        return Github(token, base_url=GITHUB_API_URL)
     else:
-        return Github()
+        return Github(base_url=GITHUB_API_URL)
 
 
-def fetch_stats_from_github(owner, repo_name):
+def fetch_stats_from_github(owner, repo_name, token=None, mode=PAGING_MODE):
+    if mode == AGGREGATE_MODE:
+        try:
+            return fetch_aggregate_stats_from_github(owner, repo_name, token)
+        except (AggregateFetchError, requests.RequestException) as e:
+            print 'Aggregate fetch for %s/%s failed (%s); falling back to paging' % (
+                    owner, repo_name, e)
+    return fetch_paged_stats_from_github(owner, repo_name, token)
+
+
+def fetch_paged_stats_from_github(owner, repo_name, token=None):
     start_secs = time.time()
-    g = get_github()
+    g = get_github(token)
+    cache = httpcache.installed_cache()
+    if cache:
+        cache.reset_thread_counts()  # so that only this fetch's requests are counted
     repo = g.get_user(owner).get_repo(repo_name)
 
     stargazers = repo.stargazers_count
@@ -48,6 +103,102 @@ def fetch_stats_from_github(owner, repo_name):
     end_secs = time.time()
     print 'Fetched %d GitHub issues from %s/%s in %f secs' % (
             open_issues, owner, repo_name, end_secs - start_secs)
+    if cache:
+        print 'HTTP cache: %d hits, %d misses' % cache.thread_counts()
+
+    return RepoStats(stargazers=stargazers,
+                     open_issues=open_issues,
+                     open_pulls=open_pulls,
+                     label_to_count=label_to_count)
+
+
+class AggregateFetchError(Exception):
+    pass
+
+
+LABEL_TOTALS_QUERY = '''
+query($owner: String!, $name: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    stargazers { totalCount }
+    issues(states: OPEN) { totalCount }
+    pullRequests(states: OPEN) { totalCount }
+    labels(first: 100, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        name
+        issues(states: OPEN) { totalCount }
+        pullRequests(states: OPEN) { totalCount }
+      }
+    }
+  }
+}
+'''
+
+
+def graphql(session, query, variables):
+    r = session.post(GITHUB_GRAPHQL_URL, json={'query': query, 'variables': variables})
+    r.raise_for_status()
+    response = r.json()
+    if response.get('errors'):
+        raise AggregateFetchError(response['errors'][0].get('message'))
+    return response['data']
+
+
+def count_search_results(session, query):
+    '''Returns the total_count for an issue search, without paging through it.'''
+    r = session.get(GITHUB_API_URL + '/search/issues', params={'q': query, 'per_page': 1})
+    r.raise_for_status()
+    response = r.json()
+    if response.get('incomplete_results'):
+        raise AggregateFetchError('incomplete search results for %s' % query)
+    return response['total_count']
+
+
+def fetch_aggregate_stats_from_github(owner, repo_name, token=None):
+    '''Like fetch_paged_stats_from_github, but using totals rather than listings.
+
+    This issues one GraphQL query per 100 labels plus a single search request.
+    Like the REST API, it counts pull requests as issues, both in open_issues
+    and per label. GraphQL requires authentication.
+    '''
+    start_secs = time.time()
+    token = get_token(token)
+    if not token:
+        raise AggregateFetchError('a GitHub token is required for GraphQL')
+
+    session = requests.Session()
+    session.headers['Authorization'] = 'bearer %s' % token
+    session.hooks['response'].append(metrics.requests_hook)
+
+    label_to_count = defaultdict(int)
+    cursor = None
+    while True:
+        data = graphql(session, LABEL_TOTALS_QUERY,
+                       {'owner': owner, 'name': repo_name, 'cursor': cursor})
+        repo = data['repository']
+        if not repo:
+            raise AggregateFetchError('no such repo %s/%s' % (owner, repo_name))
+        for node in repo['labels']['nodes']:
+            count = node['issues']['totalCount'] + node['pullRequests']['totalCount']
+            if count:
+                label_to_count[node['name']] = count
+        page_info = repo['labels']['pageInfo']
+        if not page_info['hasNextPage']:
+            break
+        cursor = page_info['endCursor']
+
+    unlabeled = count_search_results(
+            session, 'repo:%s/%s is:open no:label' % (owner, repo_name))
+    if unlabeled:
+        label_to_count[''] = unlabeled  # empty label = unlabeled
+
+    stargazers = repo['stargazers']['totalCount']
+    open_pulls = repo['pullRequests']['totalCount']
+    open_issues = repo['issues']['totalCount'] + open_pulls
+
+    end_secs = time.time()
+    print 'Fetched totals for %d GitHub issues from %s/%s in %f secs' % (
+            open_issues, owner, repo_name, end_secs - start_secs)
 
     return RepoStats(stargazers=stargazers,
                      open_issues=open_issues,
@@ -55,6 +206,132 @@ def fetch_stats_from_github(owner, repo_name):
                      label_to_count=label_to_count)
 
 
+# The last-seen state of a single issue or pull request.
+IssueState = namedtuple('IssueState', ['is_open', 'is_pull', 'labels'])
+
+
+# The outcome of an incremental poll.
+# changes maps issue number --> IssueState for every issue that was fetched.
+# If reconciled is set, changes holds the complete state of the repo and drift
+# is a dict of label --> (stored count - actual count) for every label that was off.
+IncrementalResult = namedtuple('IncrementalResult',
+        [
+            'stats',
+            'changes',
+            'synced_at',
+            'reconciled',
+            'drift'
+        ])
+
+
+def is_pull_request_url(html_url):
+    '''Whether an issue's html_url is that of a pull request.'''
+    return '/pull/' in (html_url or '')
+
+
+def issue_state(issue):
+    '''Convert a PyGithub Issue into an IssueState.'''
+    # A plain issue has no pull_request, and reading that attribute makes
+    # PyGithub re-fetch the whole issue to "complete" it: a request per issue.
+    # html_url is always in the listing, and a PR's points at /pull/.
+    return IssueState(is_open=(issue.state == 'open'),
+                      is_pull=is_pull_request_url(issue.html_url),
+                      labels=tuple(sorted(label.name for label in issue.labels)))
+
+
+def add_issue_counts(label_to_count, state, sign):
+    '''Add (sign=+1) or remove (sign=-1) an issue's contribution to label counts.'''
+    if not state or not state.is_open:
+        return
+    for label in state.labels or ('',):  # empty label = unlabeled
+        label_to_count[label] += sign
+
+
+def label_counts(states):
+    '''Returns label --> count of open issues for a dict of number --> IssueState.'''
+    label_to_count = defaultdict(int)
+    for state in states.itervalues():
+        add_issue_counts(label_to_count, state, +1)
+    return label_to_count
+
+
+def apply_issue_changes(states, label_to_count, changes):
+    '''Update states and label_to_count in place for a dict of changed IssueStates.'''
+    for number, new_state in changes.iteritems():
+        add_issue_counts(label_to_count, states.get(number), -1)
+        add_issue_counts(label_to_count, new_state, +1)
+        states[number] = new_state
+    for label in [label for label, count in label_to_count.iteritems() if count == 0]:
+        del label_to_count[label]
+
+
+def label_drift(stored_states, actual_states):
+    '''Returns label --> (stored count - actual count) for labels which disagree.'''
+    stored = label_counts(stored_states)
+    actual = label_counts(actual_states)
+    drift = {}
+    for label in set(stored.keys()) | set(actual.keys()):
+        delta = stored.get(label, 0) - actual.get(label, 0)
+        if delta:
+            drift[label] = delta
+    return drift
+
+
+def fetch_incremental_stats(owner, repo_name, states, since, token=None, reconcile=False):
+    '''Fetch stats using the issue states stored after the previous poll.
+
+    states is a dict of issue number --> IssueState and since is the synced_at
+    time from the previous IncrementalResult. Only issues updated since then are
+    fetched, which is typically one or two pages.
+
+    Some changes don't touch an issue's updated_at (label renames, deleted or
+    transferred issues), so states can drift. If there's no previous state or
+    reconcile is set, this lists every open issue instead and reports how far
+    the stored counts had drifted.
+    '''
+    start_secs = time.time()
+    synced_at = datetime.utcnow() - SINCE_OVERLAP
+    g = get_github(token)
+    repo = g.get_user(owner).get_repo(repo_name)
+    stargazers = repo.stargazers_count
+
+    if reconcile or since is None:
+        changes = {issue.number: issue_state(issue) for issue in repo.get_issues(state='open')}
+        new_states = changes
+        drift = label_drift(states, changes) if since is not None else {}
+        reconciled = True
+    else:
+        changes = {issue.number: issue_state(issue)
+                   for issue in repo.get_issues(state='all', since=since)}
+        new_states = dict(states)
+        drift = None
+        reconciled = False
+
+    if reconciled:
+        label_to_count = label_counts(new_states)
+    else:
+        label_to_count = label_counts(states)
+        apply_issue_changes(new_states, label_to_count, changes)
+
+    open_states = [state for state in new_states.itervalues() if state.is_open]
+    open_issues = len(open_states)
+    open_pulls = len([state for state in open_states if state.is_pull])
+
+    end_secs = time.time()
+    print 'Fetched %d changed GitHub issues from %s/%s in %f secs%s' % (
+            len(changes), owner, repo_name, end_secs - start_secs,
+            ' (full reconcile)' if reconciled else '')
+
+    return IncrementalResult(stats=RepoStats(stargazers=stargazers,
+                                             open_issues=open_issues,
+                                             open_pulls=open_pulls,
+                                             label_to_count=label_to_count),
+                             changes=changes,
+                             synced_at=synced_at,
+                             reconciled=reconciled,
+                             drift=drift)
+
+
 def user_for_token(token):
     g = Github(token)
     return g.get_user().login
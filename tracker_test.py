@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+from nose.tools import eq_
+
+from fake_github import FakeGitHub, make_issue
+import tracker
+
+
+server = None
+
+
+def setup_module():
+    global server
+    server = FakeGitHub()
+    server.add_repo('danvk', 'dygraphs', stargazers=7, issues=[
+        make_issue(1, labels=['bug']),
+        make_issue(2, labels=['bug', 'docs']),
+        make_issue(3),
+        make_issue(4, pull=True),
+        make_issue(5, labels=['bug'], pull=True),
+        make_issue(6, labels=['wontfix'], state='closed'),
+        make_issue(7, labels=['enhancement']),
+    ])
+    server.start()
+    tracker.GITHUB_API_URL = server.url
+    tracker.GITHUB_GRAPHQL_URL = server.url + '/graphql'
+
+
+def teardown_module():
+    tracker.GITHUB_API_URL = 'https://api.github.com'
+    tracker.GITHUB_GRAPHQL_URL = tracker.GITHUB_API_URL + '/graphql'
+    server.stop()
+
+
+def test_aggregate_matches_paging():
+    paged = tracker.fetch_stats_from_github('danvk', 'dygraphs', 'token',
+                                            mode=tracker.PAGING_MODE)
+    del server.log[:]
+    aggregate = tracker.fetch_stats_from_github('danvk', 'dygraphs', 'token',
+                                                mode=tracker.AGGREGATE_MODE)
+    eq_(aggregate, paged)
+    eq_(dict(aggregate.label_to_count), {'bug': 3, 'docs': 1, 'enhancement': 1, '': 2})
+    # two pages of labels + one search
+    eq_(len(server.log), 3)
+
+
+def test_aggregate_falls_back_to_paging():
+    server.add_repo('danvk', 'small', issues=[make_issue(1, labels=['bug'])])
+    tracker.GITHUB_GRAPHQL_URL = server.url + '/not-graphql'
+    try:
+        stats = tracker.fetch_stats_from_github('danvk', 'small', 'token',
+                                                mode=tracker.AGGREGATE_MODE)
+    finally:
+        tracker.GITHUB_GRAPHQL_URL = server.url + '/graphql'
+    eq_(dict(stats.label_to_count), {'bug': 1})
+    eq_(stats.open_issues, 1)
+
+
+def test_apply_issue_changes():
+    State = tracker.IssueState
+    states = {
+        1: State(True, False, ('bug',)),
+        2: State(True, False, ()),
+        3: State(True, True, ('bug', 'docs')),
+    }
+    counts = tracker.label_counts(states)
+    eq_(dict(counts), {'bug': 2, 'docs': 1, '': 1})
+
+    tracker.apply_issue_changes(states, counts, {
+        1: State(False, False, ('bug',)),      # closed
+        2: State(True, False, ('docs',)),      # labeled
+        4: State(True, False, ()),             # new
+    })
+    eq_(dict(counts), {'bug': 1, 'docs': 2, '': 1})
+    eq_(dict(counts), dict(tracker.label_counts(states)))
+
+
+def test_incremental_fetch():
+    issues = [make_issue(n, labels=['bug'] if n % 3 == 0 else [], pull=(n % 5 == 0))
+              for n in range(1, 80)]
+    server.add_repo('danvk', 'incremental', stargazers=3, issues=issues)
+
+    first = tracker.fetch_incremental_stats('danvk', 'incremental', {}, None)
+    eq_(first.reconciled, True)
+    eq_(first.drift, {})
+    eq_(first.stats, tracker.fetch_stats_from_github('danvk', 'incremental'))
+
+    # Close one issue and relabel another.
+    issues[2].update(state='closed', updated_at='2030-01-01T00:00:00Z')
+    issues[3].update(labels=[{'name': 'docs'}], updated_at='2030-01-01T00:00:00Z')
+    del server.log[:]
+    second = tracker.fetch_incremental_stats('danvk', 'incremental', first.changes,
+                                             first.synced_at)
+    eq_(second.reconciled, False)
+    eq_(sorted(second.changes.keys()), [3, 4])
+    eq_(len(server.log), 3)  # user, repo, and a single page of issues
+    eq_(second.stats, tracker.fetch_stats_from_github('danvk', 'incremental'))
+
+    # Label changes which don't bump updated_at are only caught by a reconcile.
+    states = dict(first.changes)
+    states.update(second.changes)
+    issues[5]['labels'] = []
+    third = tracker.fetch_incremental_stats('danvk', 'incremental', states,
+                                            second.synced_at, reconcile=True)
+    eq_(third.reconciled, True)
+    eq_(third.drift, {'bug': 1, '': -1})
+    eq_(third.stats, tracker.fetch_stats_from_github('danvk', 'incremental'))
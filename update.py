@@ -1,12 +1,245 @@
 #!/usr/bin/env python
-'''This is the Heroku scheduler task.'''
+"""This is the Heroku scheduler task.
+
+It fetches fresh stats for every tracked repo, several repos at a time, and
+writes them to the database in batches.
+
+Usage:
+  update.py [--workers=N] [--per-token=N] [--retries=N] [--batch-size=N] [--flush-ms=N] [--reconcile]
+  update.py set-mode <owner> <repo> (paging | aggregate | incremental | webhook)
+  update.py rebuild-rollups [<owner/repo>...]
+
+Options:
+  -h --help       Show this screen.
+  --workers=N     Maximum number of repos to fetch at once [default: 8].
+  --per-token=N   Maximum number of concurrent fetches which share a single
+                  GitHub token [default: 4].
+  --retries=N     Number of times to retry a failed fetch, with exponential
+                  backoff [default: 3].
+  --batch-size=N  Maximum number of repo snapshots to write per DB commit [default: 20].
+  --flush-ms=N    Longest a fetched snapshot waits to be joined by others before
+                  it's written [default: 1000].
+  --reconcile     Force incremental repos to re-list every open issue and
+                  report any drift in their stored counts.
+
+Repos are fetched by paging through their open issues unless set-mode has
+switched them to aggregate, incremental or webhook mode (see tracker.FETCH_MODES).
+Webhook repos are only fetched from GitHub to reconcile their live counts.
+
+New counts update the daily, weekly and monthly rollups as they're written.
+Once every repo has been fetched, the dashboards of those whose counts changed
+are rebuilt (see app.refresh_stale_dashboards).
+rebuild-rollups recomputes them from the raw counts, for history written
+before the rollups existed. With no repos listed, every tracked repo is rebuilt.
+Until a repo tracked before then has been rebuilt, its ?resolution= reads use
+the raw counts rather than its partial rollups.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+import math
+import sys
+import threading
+import time
+
+from docopt import docopt
+import github
 
 import app
 import db
+import snapshotwriter
+import tracker
+
+# Seconds to wait before the first retry. This doubles with each attempt.
+BACKOFF_SECS = 2.0
+
+
+# The outcome of fetching one repo. Exactly one of stats and error is set.
+FetchResult = namedtuple('FetchResult',
+        [
+            'owner',
+            'repo',
+            'stats',
+            'time',
+            'latency_secs',
+            'error'
+        ])
+
+
+# Summary statistics for a full run over all tracked repos.
+RunSummary = namedtuple('RunSummary',
+        [
+            'num_repos',
+            'failures',
+            'elapsed_secs',
+            'latencies'
+        ])
+
+
+def percentile(values, p):
+    '''Nearest-rank percentile of a list of numbers, p in [0, 100].'''
+    if not values:
+        return None
+    values = sorted(values)
+    k = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, k)]
+
+
+def fetch_with_retries(fetch, owner, repo, token, retries, backoff_secs=BACKOFF_SECS):
+    '''Call fetch(owner, repo, token), retrying failures with exponential backoff.'''
+    attempt = 0
+    while True:
+        try:
+            return fetch(owner, repo, token)
+        except github.UnknownObjectException:
+            raise  # the repo is gone; retrying won't bring it back.
+        except Exception as e:
+            if attempt >= retries:
+                raise
+            delay = backoff_secs * (2 ** attempt)
+            sys.stderr.write('Fetch of %s/%s failed (%s); retrying in %.1f secs\n' % (
+                owner, repo, e, delay))
+            time.sleep(delay)
+            attempt += 1
+
+
+def run_updates(repos, fetch, store, workers=8, per_token=4, retries=3,
+                batch_size=20, backoff_secs=BACKOFF_SECS):
+    '''Fetch stats for many repos concurrently and store them in batches.
+
+    repos is a list of (owner, repo, token) tuples. fetch(owner, repo, token)
+    returns a tracker.RepoStats and is called from worker threads.
+    store(results) receives lists of (owner, repo, stats, time) tuples and is
+    only ever called from the calling thread.
+
+    fetch may use the DB too, as long as each call opens its own session: for
+    incremental and webhook repos, app.fetch_stats reads and stores the repo's
+    issue states (db.store_issue_states) from the worker thread. Those tables
+    aren't touched by store, so this can't conflict with a SnapshotWriter's
+    flushes, but the DB pool needs a connection per worker plus one for store.
+
+    A result's latency_secs is the time spent in fetch, over all its attempts.
+
+    Returns a RunSummary.
+    '''
+    # One semaphore per token, created up front so that workers never race to create them.
+    token_slots = {token: threading.BoundedSemaphore(per_token)
+                   for _, _, token in repos}
+
+    def work(owner_repo_token):
+        owner, repo, token = owner_repo_token
+        fetch_secs = [0.0]
+
+        # The token's slot is only held during each attempt, so that a repo
+        # which is waiting to retry doesn't hold up the token's other repos.
+        def fetch_in_slot(owner, repo, token):
+            with token_slots[token]:
+                start_secs = time.time()
+                try:
+                    return fetch(owner, repo, token)
+                finally:
+                    fetch_secs[0] += time.time() - start_secs
+
+        try:
+            stats = fetch_with_retries(fetch_in_slot, owner, repo, token, retries, backoff_secs)
+            error = None
+        except Exception as e:
+            stats = None
+            error = e
+        return FetchResult(owner=owner, repo=repo, stats=stats, time=datetime.utcnow(),
+                           latency_secs=fetch_secs[0], error=error)
+
+    start_secs = time.time()
+    failures = []
+    latencies = []
+    batch = []
+    pool = ThreadPool(max(1, min(workers, len(repos))))
+    try:
+        for result in pool.imap_unordered(work, repos):
+            if result.error:
+                sys.stderr.write('Unable to update %s/%s: %s\n' % (
+                    result.owner, result.repo, result.error))
+                failures.append(result)
+                continue
+            latencies.append(result.latency_secs)
+            batch.append((result.owner, result.repo, result.stats, result.time))
+            if len(batch) >= batch_size:
+                store(batch)
+                batch = []
+        if batch:
+            store(batch)
+    finally:
+        pool.close()
+        pool.join()
+
+    return RunSummary(num_repos=len(repos),
+                      failures=failures,
+                      elapsed_secs=time.time() - start_secs,
+                      latencies=latencies)
+
+
+def print_writer_metrics(metrics):
+    flushes = metrics['flushes']
+    print 'Wrote %d snapshots in %d commits (mean %.3f secs, max %.3f secs, max queue %d)' % (
+            metrics['snapshots_done'], flushes,
+            metrics['flush_secs_total'] / flushes if flushes else 0.0,
+            metrics['flush_secs_max'], metrics['max_queue_depth'])
+    if metrics['flush_errors']:
+        print '%d commits failed' % metrics['flush_errors']
+
+
+def print_summary(summary):
+    elapsed = summary.elapsed_secs
+    print 'Updated %d repos in %.1f secs (%.2f repos/sec)' % (
+            summary.num_repos - len(summary.failures), elapsed,
+            summary.num_repos / elapsed if elapsed else 0.0)
+    print '%d failures%s' % (
+            len(summary.failures),
+            ': ' + ', '.join('%s/%s' % (f.owner, f.repo) for f in summary.failures)
+            if summary.failures else '')
+    if summary.latencies:
+        print 'Fetch latency: p50=%.2f secs, p99=%.2f secs' % (
+                percentile(summary.latencies, 50), percentile(summary.latencies, 99))
 
 
 if __name__ == '__main__':
-    for tracked_repo in db.tracked_repos():
-        owner = tracked_repo.owner
-        repo = tracked_repo.repo
-        app.observe_and_add(owner, repo)
+    arguments = docopt(__doc__)
+    if arguments['set-mode']:
+        mode = [m for m in tracker.FETCH_MODES if arguments[m]][0]
+        db.set_fetch_mode(arguments['<owner>'], arguments['<repo>'], mode)
+        sys.exit(0)
+    if arguments['rebuild-rollups']:
+        wanted = set(arguments['<owner/repo>'])
+        for r in db.tracked_repos():
+            if not wanted or '%s/%s' % (r.owner, r.repo) in wanted:
+                db.rebuild_rollups(r.owner, r.repo)
+                print 'Rebuilt rollups for %s/%s' % (r.owner, r.repo)
+        sys.exit(0)
+
+    repos = [(r.owner, r.repo, r.token) for r in db.tracked_repos()]
+    modes = db.fetch_modes()
+
+    def fetch(owner, repo, token):
+        mode = modes.get((owner, repo), tracker.PAGING_MODE)
+        return app.fetch_stats(owner, repo, token, mode=mode,
+                               reconcile=arguments['--reconcile'])
+
+    # Snapshots are handed to the writer as soon as they're fetched, and it
+    # batches them up while the other fetches continue.
+    writer = snapshotwriter.SnapshotWriter(max_rows=int(arguments['--batch-size']),
+                                           max_delay_ms=int(arguments['--flush-ms']))
+    summary = run_updates(repos,
+                          fetch=fetch,
+                          store=writer.put_many,
+                          workers=int(arguments['--workers']),
+                          per_token=int(arguments['--per-token']),
+                          retries=int(arguments['--retries']),
+                          batch_size=1)
+    writer.close()
+    print_summary(summary)
+    print_writer_metrics(writer.metrics())
+    print 'Rebuilt %d dashboards' % app.refresh_stale_dashboards(
+            [(owner, repo) for owner, repo, _ in repos])
+    if summary.failures or writer.metrics()['flush_errors']:
+        sys.exit(1)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import os
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import threading
+import time
+
+from nose.tools import eq_
+
+import tracker
+import update
+
+
+def make_stats(n):
+    return tracker.RepoStats(stargazers=n, open_issues=n, open_pulls=0, label_to_count={})
+
+
+def test_percentile():
+    eq_(update.percentile([], 50), None)
+    eq_(update.percentile([3, 1, 2], 50), 2)
+    eq_(update.percentile(range(1, 101), 99), 99)
+    eq_(update.percentile(range(1, 101), 100), 100)
+
+
+def test_run_updates_batches_and_failures():
+    repos = [('danvk', 'repo%d' % i, 'token') for i in range(7)]
+
+    def fetch(owner, repo, token):
+        if repo == 'repo3':
+            raise ValueError('boom')
+        return make_stats(int(repo[4:]))
+
+    batches = []
+    summary = update.run_updates(repos, fetch, batches.append,
+                                 workers=3, retries=0, batch_size=4)
+
+    eq_([len(b) for b in batches], [4, 2])
+    stored = sorted(repo for batch in batches for _, repo, _, _ in batch)
+    eq_(stored, ['repo0', 'repo1', 'repo2', 'repo4', 'repo5', 'repo6'])
+    eq_([(f.owner, f.repo) for f in summary.failures], [('danvk', 'repo3')])
+    eq_(len(summary.latencies), 6)
+
+
+def test_run_updates_retries():
+    attempts = []
+
+    def flaky_fetch(owner, repo, token):
+        attempts.append(repo)
+        if len(attempts) < 3:
+            raise IOError('transient')
+        return make_stats(1)
+
+    batches = []
+    summary = update.run_updates([('danvk', 'dygraphs', None)], flaky_fetch, batches.append,
+                                 retries=2, backoff_secs=0)
+    eq_(len(attempts), 3)
+    eq_(summary.failures, [])
+    eq_(len(batches), 1)
+
+
+def test_run_updates_caps_concurrency_per_token():
+    lock = threading.Lock()
+    active = {'a': 0, 'b': 0}
+    peak = {'a': 0, 'b': 0}
+
+    def fetch(owner, repo, token):
+        with lock:
+            active[token] += 1
+            peak[token] = max(peak[token], active[token])
+        time.sleep(0.02)
+        with lock:
+            active[token] -= 1
+        return make_stats(0)
+
+    repos = [('o', 'r%d' % i, 'a' if i % 2 else 'b') for i in range(12)]
+    update.run_updates(repos, fetch, lambda batch: None, workers=6, per_token=2)
+    eq_(peak, {'a': 2, 'b': 2})
+
+
+def test_run_updates_frees_token_during_backoff():
+    events = []
+    failed = []
+
+    def fetch(owner, repo, token):
+        if repo == 'flaky' and not failed:
+            failed.append(True)
+            events.append('flaky failed')
+            raise IOError('transient')
+        events.append(repo)
+        return make_stats(0)
+
+    repos = [('o', 'flaky', 'a'), ('o', 'steady', 'a')]
+    summary = update.run_updates(repos, fetch, lambda batch: None, workers=2, per_token=1,
+                                 retries=1, backoff_secs=0.2)
+    eq_(summary.failures, [])
+    # steady doesn't have to wait for flaky's retry
+    assert events.index('steady') < events.index('flaky'), events
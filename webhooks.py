@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+'''Turn GitHub webhook deliveries into changes to a repo's live counts.
+
+A repo in webhook mode (tracker.WEBHOOK_MODE) has GitHub POST its issues,
+pull_request, label, watch and star events to /<owner>/<repo>/webhook. Each
+delivery is parsed here into a WebhookUpdate. db.apply_webhook then adjusts
+the counts of just the labels it touches, using the last-seen state of each
+changed issue (the open_issues table, shared with incremental mode).
+
+Deliveries are signed with the hook's secret (see verify_signature) and carry
+a unique X-GitHub-Delivery id, which db.apply_webhook records so that a
+redelivery is only counted once. A repo's deliveries are applied one at a
+time, each against the issue states the last one stored, so simultaneous
+deliveries (GitHub sends opened and labeled together) can't both count the
+same change. Deliveries can still arrive out of order, so an issue may
+briefly show a stale state. Each delivery carries the issue's whole state, so
+the next one for it, or the next reconcile, puts it right.
+
+A reconcile lists every open issue, which takes a while, and a delivery
+applied meanwhile may be newer than what the listing saw. So each delivery is
+stored along with its id, and db.store_issue_states applies the ones received
+since the listing started again on top of it.
+
+The live counts are kept in the database rather than in process memory: the
+app runs as several gunicorn workers, and each would only see the deliveries
+that it handled.
+'''
+
+from collections import namedtuple
+import hashlib
+import hmac
+import json
+
+import tracker
+
+# Events which can change a repo's counts. GitHub also sends a 'ping' when a hook is added.
+EVENTS = ('issues', 'pull_request', 'label', 'watch', 'star')
+
+
+# The changes carried by one delivery.
+# changes maps issue number --> tracker.IssueState for each issue it reports on.
+# stargazers is the repo's star count, or None if the payload doesn't say.
+# renames maps old label name --> new name, or None if the label was deleted.
+WebhookUpdate = namedtuple('WebhookUpdate', ['changes', 'stargazers', 'renames'])
+
+
+def sign(secret, body):
+    '''Returns the X-Hub-Signature-256 header GitHub would send with body.'''
+    return 'sha256=' + hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def verify_signature(secret, body, signature_256=None, signature=None):
+    '''Check a delivery's X-Hub-Signature-256 header, or failing that its SHA-1 X-Hub-Signature.'''
+    if signature_256:
+        return hmac.compare_digest(sign(secret, body), str(signature_256))
+    if signature:
+        expected = 'sha1=' + hmac.new(secret, body, hashlib.sha1).hexdigest()
+        return hmac.compare_digest(expected, str(signature))
+    return False
+
+
+def issue_state(issue, is_pull=False, removed=False):
+    '''Convert an issue or pull request's JSON into a tracker.IssueState.'''
+    return tracker.IssueState(is_open=(issue['state'] == 'open' and not removed),
+                              is_pull=(is_pull or 'pull_request' in issue),
+                              labels=tuple(sorted(label['name']
+                                                  for label in issue.get('labels') or [])))
+
+
+def parse_event(event, payload):
+    '''Returns the WebhookUpdate for a delivery of one of EVENTS.
+
+    Raises ValueError for other events, and KeyError if the payload is missing
+    something its event should have.
+    '''
+    if event not in EVENTS:
+        raise ValueError('Unsupported event %s' % event)
+    action = payload.get('action')
+    changes = {}
+    renames = {}
+    if event == 'issues':
+        issue = payload['issue']
+        # deleted and transferred issues no longer count towards the repo
+        changes[issue['number']] = issue_state(issue,
+                                               removed=action in ('deleted', 'transferred'))
+    elif event == 'pull_request':
+        pull = payload['pull_request']
+        changes[pull['number']] = issue_state(pull, is_pull=True)
+    elif event == 'label':
+        if action == 'edited' and 'name' in payload.get('changes', {}):
+            renames[payload['changes']['name']['from']] = payload['label']['name']
+        elif action == 'deleted':
+            renames[payload['label']['name']] = None
+    # Every event reports the repo's current star count, which covers watch and star.
+    stargazers = (payload.get('repository') or {}).get('stargazers_count')
+    return WebhookUpdate(changes=changes, stargazers=stargazers, renames=renames)
+
+
+def encode_update(update):
+    '''Serialize a WebhookUpdate as JSON, for decode_update.'''
+    return json.dumps({'changes': {str(number): list(state)
+                                   for number, state in update.changes.iteritems()},
+                       'stargazers': update.stargazers,
+                       'renames': update.renames})
+
+
+def decode_update(s):
+    '''The WebhookUpdate which encode_update serialized.'''
+    obj = json.loads(s)
+    changes = {int(number): tracker.IssueState(is_open, is_pull, tuple(labels))
+               for number, (is_open, is_pull, labels) in obj['changes'].iteritems()}
+    return WebhookUpdate(changes=changes, stargazers=obj['stargazers'], renames=obj['renames'])
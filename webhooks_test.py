@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+import os
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from datetime import datetime, timedelta
+import json
+import threading
+
+from nose.tools import eq_
+
+import app
+import db
+import tracker
+import webhooks
+
+# Recorded deliveries, trimmed to the fields the tracker reads plus a few others.
+issue_opened = '''
+{
+  "action": "opened",
+  "issue": {
+    "url": "https://api.github.com/repos/danvk/hooked/issues/3",
+    "number": 3,
+    "title": "Range selector is off by one",
+    "user": {"login": "kberg", "id": 1073243},
+    "labels": [],
+    "state": "open",
+    "comments": 0,
+    "created_at": "2016-02-01T18:22:09Z",
+    "updated_at": "2016-02-01T18:22:09Z",
+    "closed_at": null
+  },
+  "repository": {
+    "id": 1034985,
+    "name": "hooked",
+    "full_name": "danvk/hooked",
+    "stargazers_count": 10,
+    "open_issues_count": 3
+  },
+  "sender": {"login": "kberg", "id": 1073243}
+}
+'''
+
+issue_labeled = '''
+{
+  "action": "labeled",
+  "issue": {
+    "number": 3,
+    "labels": [{"id": 57, "name": "bug", "color": "fc2929"}],
+    "state": "open",
+    "created_at": "2016-02-01T18:22:09Z",
+    "updated_at": "2016-02-01T18:25:40Z",
+    "closed_at": null
+  },
+  "label": {"id": 57, "name": "bug", "color": "fc2929"},
+  "repository": {"full_name": "danvk/hooked", "stargazers_count": 10},
+  "sender": {"login": "danvk", "id": 98301}
+}
+'''
+
+issue_closed = '''
+{
+  "action": "closed",
+  "issue": {
+    "number": 1,
+    "labels": [{"id": 57, "name": "bug", "color": "fc2929"}],
+    "state": "closed",
+    "created_at": "2016-01-05T10:00:00Z",
+    "updated_at": "2016-02-02T09:12:00Z",
+    "closed_at": "2016-02-02T09:12:00Z"
+  },
+  "repository": {"full_name": "danvk/hooked", "stargazers_count": 10},
+  "sender": {"login": "danvk", "id": 98301}
+}
+'''
+
+pull_opened = '''
+{
+  "action": "opened",
+  "number": 4,
+  "pull_request": {
+    "url": "https://api.github.com/repos/danvk/hooked/pulls/4",
+    "number": 4,
+    "state": "open",
+    "title": "Fix the range selector",
+    "labels": [{"id": 58, "name": "docs", "color": "ededed"}],
+    "created_at": "2016-02-02T11:00:00Z",
+    "merged_at": null
+  },
+  "repository": {"full_name": "danvk/hooked", "stargazers_count": 10},
+  "sender": {"login": "kberg", "id": 1073243}
+}
+'''
+
+label_renamed = '''
+{
+  "action": "edited",
+  "label": {"id": 57, "name": "defect", "color": "fc2929"},
+  "changes": {"name": {"from": "bug"}},
+  "repository": {"full_name": "danvk/hooked", "stargazers_count": 10},
+  "sender": {"login": "danvk", "id": 98301}
+}
+'''
+
+watch_started = '''
+{
+  "action": "started",
+  "repository": {"full_name": "danvk/hooked", "stargazers_count": 11},
+  "sender": {"login": "someone", "id": 12345}
+}
+'''
+
+SECRET = 'It\'s a Secret to Everybody'
+
+
+def test_verify_signature():
+    body = '{"zen": "Design for failure."}'
+    eq_(webhooks.verify_signature(SECRET, body, webhooks.sign(SECRET, body)), True)
+    eq_(webhooks.verify_signature(SECRET, body + ' ', webhooks.sign(SECRET, body)), False)
+    eq_(webhooks.verify_signature('other', body, webhooks.sign(SECRET, body)), False)
+    eq_(webhooks.verify_signature(SECRET, body), False)
+
+
+def test_parse_event():
+    eq_(webhooks.parse_event('issues', json.loads(issue_labeled)),
+        webhooks.WebhookUpdate(changes={3: tracker.IssueState(True, False, ('bug',))},
+                               stargazers=10, renames={}))
+    eq_(webhooks.parse_event('pull_request', json.loads(pull_opened)).changes,
+        {4: tracker.IssueState(True, True, ('docs',))})
+    eq_(webhooks.parse_event('label', json.loads(label_renamed)).renames, {'bug': 'defect'})
+    eq_(webhooks.parse_event('watch', json.loads(watch_started)),
+        webhooks.WebhookUpdate(changes={}, stargazers=11, renames={}))
+
+
+def deliver(client, event, body, delivery_id, secret=SECRET):
+    return client.post('/danvk/hooked/webhook', data=body, content_type='application/json',
+                       headers={'X-GitHub-Event': event,
+                                'X-GitHub-Delivery': delivery_id,
+                                'X-Hub-Signature-256': webhooks.sign(secret, body)})
+
+
+def test_webhook_deliveries_update_live_counts():
+    app.WEBHOOK_SECRET = SECRET
+    db.add_repo('danvk', 'hooked', 'token')
+    db.set_fetch_mode('danvk', 'hooked', tracker.WEBHOOK_MODE)
+    client = app.app.test_client()
+    eq_(deliver(client, 'issues', issue_opened, 'd0').data, 'unsynced')
+
+    # what a reconcile would store: issues 1 and 2 are open, one labeled
+    states = {1: tracker.IssueState(True, False, ('bug',)),
+              2: tracker.IssueState(True, False, ())}
+    db.store_issue_states('danvk', 'hooked', states, datetime.utcnow(), reconciled=True,
+                          live_stats=tracker.RepoStats(10, 2, 0, tracker.label_counts(states)))
+
+    eq_(deliver(client, 'issues', issue_opened, 'd1').data, 'snapshot')
+    for event, body, delivery_id in (('issues', issue_labeled, 'd2'),
+                                     ('issues', issue_closed, 'd3'),
+                                     ('pull_request', pull_opened, 'd4'),
+                                     ('label', label_renamed, 'd5'),
+                                     ('watch', watch_started, 'd6')):
+        eq_(deliver(client, event, body, delivery_id).data, 'applied')
+    eq_(deliver(client, 'issues', issue_labeled, 'd2').data, 'duplicate')
+    eq_(deliver(client, 'issues', issue_labeled, 'd7', secret='wrong').status_code, 403)
+    eq_(deliver(client, 'ping', '{"zen": "Keep it logically awesome."}', 'd8').data, 'pong')
+
+    stats, _ = db.get_live_stats('danvk', 'hooked')
+    eq_(stats, tracker.RepoStats(stargazers=11, open_issues=3, open_pulls=1,
+                                 label_to_count={'defect': 1, '': 1, 'docs': 1}))
+    # the live counts agree with the issue states they were built from
+    states, _, _ = db.get_issue_states('danvk', 'hooked')
+    eq_(tracker.label_counts({n: tracker.IssueState(*s) for n, s in states.iteritems()}),
+        stats.label_to_count)
+
+    # polls read the live counts rather than GitHub until a reconcile is due
+    eq_(app.fetch_stats('danvk', 'hooked'), stats)
+
+    # only the first delivery in the snapshot interval stored a snapshot
+    _, open_issues, _, _ = db.get_stats_series('danvk', 'hooked')
+    eq_([count for _, count in open_issues], [3])
+    later = datetime.utcnow() + app.WEBHOOK_SNAPSHOT_INTERVAL + timedelta(seconds=1)
+    update = webhooks.parse_event('watch', json.loads(watch_started))
+    eq_(db.apply_webhook('danvk', 'hooked', 'd9', update, app.WEBHOOK_SNAPSHOT_INTERVAL,
+                         now=later), 'snapshot')
+    _, open_issues, open_pulls, by_label = db.get_stats_series('danvk', 'hooked',
+                                                                include_labels=True)
+    eq_([count for _, count in open_issues], [3, 3])
+    eq_([count for _, count in open_pulls], [0, 1])
+    eq_(by_label[0], ['Date', '(unlabeled)', 'bug', 'defect', 'docs'])
+    eq_(by_label[-1][1:], [1, 0, 1, 1])
+
+
+def test_simultaneous_deliveries_are_applied_in_turn():
+    db.add_repo('danvk', 'raced', 'token')
+    db.set_fetch_mode('danvk', 'raced', tracker.WEBHOOK_MODE)
+    db.store_issue_states('danvk', 'raced', {}, datetime.utcnow(), reconciled=True,
+                          live_stats=tracker.RepoStats(10, 0, 0, {}))
+
+    # hold the first delivery part-way through applying its change
+    update_issue_state = db.update_issue_state
+    applying = threading.Event()
+    proceed = threading.Event()
+
+    def paused_update_issue_state(*args):
+        if not applying.is_set():
+            applying.set()
+            proceed.wait()
+        return update_issue_state(*args)
+
+    results = []
+
+    def apply_in_thread(delivery_id, event, body):
+        update = webhooks.parse_event(event, json.loads(body))
+        results.append(db.apply_webhook('danvk', 'raced', delivery_id, update,
+                                        app.WEBHOOK_SNAPSHOT_INTERVAL))
+
+    db.update_issue_state = paused_update_issue_state
+    try:
+        opened = threading.Thread(target=apply_in_thread, args=('r1', 'issues', issue_opened))
+        labeled = threading.Thread(target=apply_in_thread, args=('r2', 'issues', issue_labeled))
+        opened.daemon = labeled.daemon = True
+        opened.start()
+        applying.wait()
+        labeled.start()
+        labeled.join(0.2)
+        eq_(labeled.is_alive(), True)  # waiting for the first delivery to commit
+    finally:
+        proceed.set()
+        opened.join(5)
+        labeled.join(5)
+        db.update_issue_state = update_issue_state
+
+    eq_(sorted(results), ['applied', 'snapshot'])
+    stats, _ = db.get_live_stats('danvk', 'raced')
+    eq_(stats, tracker.RepoStats(stargazers=10, open_issues=1, open_pulls=0,
+                                 label_to_count={'bug': 1}))
+
+
+def test_deliveries_during_a_reconcile_are_applied_again():
+    db.add_repo('danvk', 'relisted', 'token')
+    db.set_fetch_mode('danvk', 'relisted', tracker.WEBHOOK_MODE)
+    states = {1: tracker.IssueState(True, False, ('bug',)),
+              2: tracker.IssueState(True, False, ())}
+    db.store_issue_states('danvk', 'relisted', states, datetime.utcnow(), reconciled=True,
+                          live_stats=tracker.RepoStats(10, 2, 0, tracker.label_counts(states)))
+
+    # issue 1 is closed after the reconcile has listed it, but before it's stored
+    def fetch_incremental_stats(owner, repo, states, since, token=None, reconcile=False):
+        synced_at = datetime.utcnow() - tracker.SINCE_OVERLAP
+        listed = dict(states)
+        update = webhooks.parse_event('issues', json.loads(issue_closed))
+        db.apply_webhook('danvk', 'relisted', 'c1', update, app.WEBHOOK_SNAPSHOT_INTERVAL)
+        return tracker.IncrementalResult(
+                stats=tracker.RepoStats(10, 2, 0, tracker.label_counts(listed)),
+                changes=listed, synced_at=synced_at, reconciled=True, drift={})
+
+    real_fetch = tracker.fetch_incremental_stats
+    tracker.fetch_incremental_stats = fetch_incremental_stats
+    try:
+        stats = app.fetch_stats('danvk', 'relisted', reconcile=True)
+    finally:
+        tracker.fetch_incremental_stats = real_fetch
+
+    expected = tracker.RepoStats(stargazers=10, open_issues=1, open_pulls=0,
+                                 label_to_count={'': 1})
+    eq_(stats, expected)
+    eq_(db.get_live_stats('danvk', 'relisted')[0], expected)
+    eq_(db.get_issue_states('danvk', 'relisted')[0].keys(), [2])
+
+
+def test_encode_update():
+    update = webhooks.WebhookUpdate(changes={3: tracker.IssueState(True, True, ('bug', 'docs'))},
+                                    stargazers=12, renames={'bug': 'defect', 'wontfix': None})
+    eq_(webhooks.decode_update(webhooks.encode_update(update)), update)